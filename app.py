@@ -1,10 +1,17 @@
 import streamlit as st
-import streamlit.components.v1 as components
-import PIL.Image
 import os
-import json
+import html
+import time
 from dotenv import load_dotenv, set_key
-from grok_engine import GrokAgenticEngine
+from key_pool import load_api_keys
+
+# Every widget interaction reruns this script, so module-level work stays cheap:
+# the engine (groq, openai, numpy) is imported on the first pipeline run by the
+# cached factory below, Pillow only when a preview or thumbnail is made, and
+# per-upload work lives in st.session_state.
+
+# Longest edge of the on-page preview; the engine always gets the original bytes
+PREVIEW_EDGE = 1200
 
 # Page Configuration
 st.set_page_config(
@@ -13,7 +20,7 @@ st.set_page_config(
     layout="wide"
 )
 
-# Custom CSS for Strict Monochrome Aesthetic
+# Custom CSS for Strict Monochrome Aesthetic (re-sent each rerun, Streamlit drops elements a run doesn't emit)
 st.markdown("""
 <style>
     /* Main Background */
@@ -95,6 +102,13 @@ st.markdown("""
         border-color: #333333;
         opacity: 0.6;
     }
+    .agent-stream {
+        margin-top: 8px;
+        max-height: 260px;
+        overflow-y: auto;
+        font-size: 0.8em;
+        color: #AAAAAA;
+    }
     .agent-title {
         font-weight: bold;
         text-transform: uppercase;
@@ -105,6 +119,101 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource(show_spinner=False)
+def load_settings():
+    """Read .env once per server; update_env keeps os.environ in step after that."""
+    load_dotenv()
+    return True
+
+@st.cache_resource(show_spinner=False)
+def get_engine(api_key):
+    """One engine (and connection pool) per key for the whole server, not per button press."""
+    from grok_engine import GrokAgenticEngine
+    from result_cache import default_cache
+    return GrokAgenticEngine(api_key=api_key, cache=default_cache(), stream=True)
+
+@st.cache_resource(show_spinner=False)
+def get_history():
+    from history import default_history
+    return default_history()
+
+def session_entry(name, uploaded_file, build):
+    """Per-session value for this upload, built once instead of on every rerun."""
+    entry = st.session_state.get(name)
+    if entry is None or entry[0] != uploaded_file.file_id:
+        entry = st.session_state[name] = (uploaded_file.file_id, build())
+    return entry[1]
+
+def preview_image(uploaded_file):
+    """Downscaled JPEG of the upload; decoding and re-encoding the full image is the slowest part of a rerun."""
+    from history import make_thumbnail
+    return session_entry("preview", uploaded_file, lambda: make_thumbnail(uploaded_file.getvalue(), edge=PREVIEW_EDGE))
+
+def render_result(run):
+    """The finished run for this upload, drawn from session state so reruns don't lose or redo it."""
+    result, trace = run["result"], run["trace"]
+    st.success("PIPELINE COMPLETE")
+    st.markdown("### FINAL REFINED PROMPT")
+
+    st.code(result, language="text")
+
+    # Pro Tips Section as requested by USER
+    st.markdown("""
+    <div style="background-color: #1a1a1a; border: 1px solid #FFFFFF; padding: 15px; border-radius: 5px; margin-top: 20px;">
+        <h3 style="color: #FFFFFF; margin-top: 0;">🚀 PRO TIPS FOR MASTER GENERATION</h3>
+        <ul style="color: #AAAAAA; list-style-type: none; padding-left: 0;">
+            <li>• <b>Aspect Ratio</b>: For cinematic results, use <code>--ar 16:9</code> or <code>--ar 21:9</code>.</li>
+            <li>• <b>Negative Prompting</b>: Explicitly exclude 'blurry, cartoonish, low-res' in your generator settings.</li>
+            <li>• <b>Lighting</b>: If the result is too flat, add 'volumetric god rays' or 'hard rim lighting' to the prompt.</li>
+            <li>• <b>Resolution</b>: Specify 'shot on 35mm film' or '8k octane render' for extreme texture definition.</li>
+        </ul>
+    </div>
+    """, unsafe_allow_html=True)
+
+    st.text_area("RAW TEXT (COPY-READY)", value=result, height=250)
+
+    with st.expander("RUN TRACE"):
+        totals = trace["totals"]
+        cost = f"${totals['cost_usd']:.5f}" if totals["cost_usd"] is not None else "n/a"
+        st.markdown(f"**{trace['latency']:.2f}s** total • {totals['calls']} calls • "
+                    f"{totals['prompt_tokens'] or 0} in / {totals['completion_tokens'] or 0} out tokens • {cost}")
+        st.table([
+            {"stage": stage["stage"], "seconds": round(stage["seconds"], 2), "cached": stage["cached"],
+             "tokens": (stage["prompt_tokens"] or 0) + (stage["completion_tokens"] or 0),
+             "retries": stage["retries"]}
+            for stage in trace["stages"]
+        ])
+
+def render_history_entry(entry):
+    """One history hit: thumbnail, when/how it was made, and the copy-ready prompt."""
+    thumb_col, text_col = st.columns([1, 4])
+    with thumb_col:
+        if entry["thumbnail"]:
+            st.image(entry["thumbnail"], use_column_width=True)
+    with text_col:
+        latency = entry["timings"].get("latency")
+        details = [time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["created"])), entry["mode"]]
+        if latency:
+            details.append(f"{latency:.1f}s")
+        if entry["source"]:
+            details.append(entry["source"])
+        st.caption(f"#{entry['id']} • " + " • ".join(details))
+        if entry["snippet"]:
+            st.markdown(f"<p class='secondary-text'>{html.escape(entry['snippet'])}</p>", unsafe_allow_html=True)
+        st.code(entry["prompt"], language="text")
+
+def history_panel(history):
+    """Search and browse earlier prompts, so nobody pays for a run twice."""
+    with st.expander("PROMPT HISTORY"):
+        search_col, mode_col = st.columns([3, 1])
+        query = search_col.text_input("SEARCH PROMPTS", placeholder="e.g. leather jacket neon rain", key="history_query")
+        mode = mode_col.selectbox("MODE", ["All"] + history.modes())
+        entries = history.search(query, limit=20, mode=None if mode == "All" else mode)
+        if not entries:
+            st.info("No matching prompts yet.")
+        for entry in entries:
+            render_history_entry(entry)
+
 def update_env(key, value):
     env_path = ".env"
     set_key(env_path, key, value)
@@ -117,13 +226,17 @@ def main():
     # Sidebar Configuration
     st.sidebar.title("SYSTEM CONTROL")
     
-    load_dotenv()
+    load_settings()
     
     with st.sidebar.expander("API CONFIGURATION", expanded=True):
         groq_key = st.text_input("Groq API Key", value=os.getenv("GROQ_API_KEY", ""), type="password")
         if st.button("SAVE KEY"):
             update_env("GROQ_API_KEY", groq_key)
             st.success("Configuration Saved.")
+        # Extra keys only come from GROQ_API_KEYS; they are counted, never shown
+        pooled = len(load_api_keys(groq_key))
+        if pooled > 1:
+            st.caption(f"KEY POOL: {pooled} keys sharing the load")
     
     st.sidebar.markdown("""
     ---
@@ -144,13 +257,25 @@ def main():
 
     uploaded_file = st.file_uploader("UPLOAD IMAGE FOR ANALYSIS", type=["jpg", "jpeg", "png", "webp", "jfif", "pjpeg", "pjs"])
 
+    history = get_history()
+
     if uploaded_file is not None:
+        # Exact repeats: offer the stored prompts before anyone starts a paid run
+        earlier = session_entry("earlier", uploaded_file, lambda: history.for_image(uploaded_file.getvalue())) if history else []
+        if earlier:
+            with st.expander(f"THIS IMAGE WAS PROCESSED BEFORE ({len(earlier)} RUN{'S' if len(earlier) > 1 else ''})", expanded=True):
+                for entry in earlier:
+                    render_history_entry(entry)
+
         col1, col2 = st.columns([1, 1], gap="large")
         
         with col1:
             st.markdown("### SOURCE MATERIAL")
-            image = PIL.Image.open(uploaded_file)
-            st.image(image, use_column_width=True)
+            preview = preview_image(uploaded_file)
+            if preview:
+                st.image(preview, use_column_width=True)
+            else:
+                st.warning("Preview unavailable for this file.")
             
         with col2:
             st.markdown("### AGENTIC PIPELINE")
@@ -158,58 +283,46 @@ def main():
             # Placeholder for agent status
             status_placeholder = st.empty()
             
-            def update_pipeline_ui(msg, agent_id=""):
+            def update_pipeline_ui(msg, agent_id="", partial=None):
+                # Streamed text is model output, so escape it before it goes into HTML;
+                # <br> instead of newlines keeps blank lines from ending the HTML block
+                live_text = ""
+                if partial:
+                    escaped = html.escape(partial).replace("\n", "<br>")
+                    live_text = f'<div class="agent-stream">{escaped}</div>'
                 with status_placeholder.container():
                     st.markdown(f"""
                     <div class="agent-box {'agent-active' if agent_id else ''}">
                         <div class="agent-title">{agent_id.replace('_', ' ') if agent_id else 'SYSTEM STATUS'}</div>
                         <div style="font-size: 0.9em;">{msg}</div>
+                        {live_text}
                     </div>
                     """, unsafe_allow_html=True)
 
             if st.button("INITIATE AUTONOMOUS LOOP"):
                 try:
-                    # Save uploaded file to temp path
-                    temp_path = "temp_image." + uploaded_file.name.split('.')[-1]
-                    with open(temp_path, "wb") as f:
-                        f.write(uploaded_file.getbuffer())
-                    
-                    # Initialize Engine
-                    engine = GrokAgenticEngine(api_key=current_key)
-                    
-                    # Run Loop
-                    result = engine.run_engine(temp_path, status_callback=update_pipeline_ui)
-                    
-                    # Clean up temp file
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
+                    # Reuse the warm engine for this key
+                    engine = get_engine(current_key)
                     
-                    # Display Results
-                    st.success("PIPELINE COMPLETE")
-                    st.markdown("### FINAL REFINED PROMPT")
-                    
-                    st.code(result, language="text")
-                    
-                    # Pro Tips Section as requested by USER
-                    st.markdown("""
-                    <div style="background-color: #1a1a1a; border: 1px solid #FFFFFF; padding: 15px; border-radius: 5px; margin-top: 20px;">
-                        <h3 style="color: #FFFFFF; margin-top: 0;">🚀 PRO TIPS FOR MASTER GENERATION</h3>
-                        <ul style="color: #AAAAAA; list-style-type: none; padding-left: 0;">
-                            <li>• <b>Aspect Ratio</b>: For cinematic results, use <code>--ar 16:9</code> or <code>--ar 21:9</code>.</li>
-                            <li>• <b>Negative Prompting</b>: Explicitly exclude 'blurry, cartoonish, low-res' in your generator settings.</li>
-                            <li>• <b>Lighting</b>: If the result is too flat, add 'volumetric god rays' or 'hard rim lighting' to the prompt.</li>
-                            <li>• <b>Resolution</b>: Specify 'shot on 35mm film' or '8k octane render' for extreme texture definition.</li>
-                        </ul>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    st.text_area("RAW TEXT (COPY-READY)", value=result, height=250)
+                    # Run Loop straight from the upload buffer; nothing is written to disk,
+                    # so concurrent sessions can't clobber each other's image
+                    result, trace = engine.run_engine(uploaded_file.getvalue(), status_callback=update_pipeline_ui, with_trace=True,
+                                                      source=uploaded_file.name)
+                    st.session_state["run"] = {"file_id": uploaded_file.file_id, "result": result, "trace": trace}
                     
                 except Exception as e:
                     st.error(f"PIPELINE FAILURE: {e}")
 
+            # Kept across reruns, so copying or scrolling the result never restarts the pipeline
+            run = st.session_state.get("run")
+            if run and run["file_id"] == uploaded_file.file_id:
+                render_result(run)
+
     else:
         st.info("Awaiting visual input...")
+
+    if history:
+        history_panel(history)
         
     st.markdown("---")
     st.markdown("<div style='text-align: center; color: #333; font-size: 0.7em;'>STRICT MONOCHROME DESIGN • POWERED BY XAI GROK</div>", unsafe_allow_html=True)
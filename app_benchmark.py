@@ -0,0 +1,152 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from benchmark import summarize, make_test_image, _fmt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# What the first script run pays (history backs the search panel on every page) vs what
+# waits for the first pipeline run (the engine) or the first preview/thumbnail (Pillow)
+IMPORT_GROUPS = {
+    "app_imports": ["streamlit", "dotenv", "key_pool", "history"],
+    "deferred_imports": ["grok_engine", "PIL.Image"],
+}
+
+# Stand-in for a finished pipeline run, shaped like telemetry.RunTrace.summary()
+SAMPLE_TRACE = {
+    "latency": 9.5,
+    "totals": {"calls": 3, "prompt_tokens": 2400, "completion_tokens": 900, "cost_usd": 0.0012},
+    "stages": [
+        {"stage": name, "seconds": 3.0, "cached": False, "prompt_tokens": 800, "completion_tokens": 300, "retries": 0}
+        for name in ("agent_1", "agent_2", "agent_3")
+    ],
+}
+SAMPLE_PROMPT = "A woman in a black leather jacket stands in neon rain, shot on 35mm film. " * 8
+
+
+def import_seconds(modules):
+    """Wall time to import `modules` in a fresh interpreter (a cold server start)."""
+    code = (
+        "import time\n"
+        "started = time.perf_counter()\n"
+        f"for name in {modules!r}: __import__(name)\n"
+        "print(time.perf_counter() - started)\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def reencode(data):
+    import PIL.Image
+    buffer = io.BytesIO()
+    PIL.Image.open(io.BytesIO(data)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def timed(action):
+    started = time.perf_counter()
+    action()
+    return time.perf_counter() - started
+
+
+def bench_reruns(runs, timeout):
+    """Cold first run, plain reruns and a history search, through Streamlit's headless AppTest."""
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(HERE, "app.py"), default_timeout=timeout)
+    cold = timed(app.run)
+    if app.exception:
+        raise RuntimeError(f"app.py raised: {app.exception[0].value}")
+    reruns = [timed(app.run) for _ in range(runs)]
+    searches = []
+    if app.text_input(key="history_query") is not None:
+        for index in range(runs):
+            box = app.text_input(key="history_query").input(f"jacket {index}")
+            searches.append(timed(box.run))
+    return {"cold_run": round(cold, 4), "rerun": summarize(reruns), "history_search": summarize(searches)}
+
+
+def bench_result_reruns(runs, timeout, data):
+    """
+    Reruns of the page people actually sit on: an upload that was processed
+    before, with its finished result shown. The result is put in session state
+    directly, so no pipeline (or API key) is needed.
+    """
+    from streamlit.testing.v1 import AppTest
+    from history import default_history
+
+    default_history().record(data, SAMPLE_PROMPT, "three-agent", trace=SAMPLE_TRACE, source="bench.jpg")
+    app = AppTest.from_file(os.path.join(HERE, "app.py"), default_timeout=timeout)
+    app.run()
+    app.file_uploader[0].upload("bench.jpg", data, "image/jpeg")
+    upload = timed(app.run)
+    if app.exception:
+        raise RuntimeError(f"app.py raised: {app.exception[0].value}")
+    file_id = app.session_state["preview"][0]
+    app.session_state["run"] = {"file_id": file_id, "result": SAMPLE_PROMPT, "trace": SAMPLE_TRACE}
+    app.run()
+    if not app.code:
+        raise RuntimeError("app.py did not render the finished result")
+    return {"upload_run": round(upload, 4), "result_rerun": summarize([timed(app.run) for _ in range(runs)])}
+
+
+def run_app_benchmark(runs, image_path=None, timeout=60, preview_edge=1200):
+    workdir = tempfile.TemporaryDirectory()
+    # A scratch history/cache and a dummy key, so the page renders past the key check without touching real data
+    os.environ.setdefault("GROQ_API_KEY", "bench-key")
+    os.environ["PROMPT_HISTORY_PATH"] = os.path.join(workdir.name, "history.sqlite3")
+    os.environ["PROMPT_CACHE_PATH"] = os.path.join(workdir.name, "cache.sqlite3")
+    image_path = image_path or make_test_image(os.path.join(workdir.name, "bench.jpg"))
+    report = {"created": datetime.now().isoformat(timespec="seconds"), "runs": runs, "image": image_path}
+    from history import make_thumbnail
+    try:
+        for group, modules in IMPORT_GROUPS.items():
+            report[group] = summarize([import_seconds(modules) for _ in range(max(1, runs // 4))])
+
+        # Preview: every rerun used to decode and re-encode the full upload for st.image;
+        # the thumbnail is now built once per upload and kept in the session
+        with open(image_path, "rb") as handle:
+            data = handle.read()
+        report["preview_reencode"] = summarize([timed(lambda: reencode(data)) for _ in range(runs)])
+        report["preview_build"] = summarize([timed(lambda: make_thumbnail(data, edge=preview_edge)) for _ in range(runs)])
+
+        report.update(bench_reruns(runs, timeout))
+        report.update(bench_result_reruns(runs, timeout, data))
+    finally:
+        workdir.cleanup()
+    return report
+
+
+def print_report(report):
+    print(f"{'measure':<18} {'p50':>8} {'p95':>8} {'max':>8}")
+    for name, stats in report.items():
+        if isinstance(stats, dict):
+            print(f"{name:<18} {_fmt(stats.get('p50')):>8} {_fmt(stats.get('p95')):>8} {_fmt(stats.get('max')):>8}")
+    print(f"{'cold_run':<18} {_fmt(report.get('cold_run')):>8}")
+    print(f"{'upload_run':<18} {_fmt(report.get('upload_run')):>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup and rerun timings of the Streamlit app, run headless.")
+    parser.add_argument("-n", "--runs", type=int, default=20, help="Reruns / samples per measure")
+    parser.add_argument("--image", help="Image for the preview timing (default: a generated 2400x1800 JPEG)")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds one script run may take")
+    parser.add_argument("-o", "--output", default=None, help="JSON report path")
+    args = parser.parse_args(argv)
+
+    report = run_app_benchmark(max(1, args.runs), image_path=args.image, timeout=args.timeout)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+import time
+import asyncio
+import inspect
+from client_pool import get_async_client
+from grok_engine import GrokAgenticEngine
+from rate_limiter import estimate_tokens
+from streaming import ThinkTagFilter, chunk_text, chunk_usage_info, acollect_stream
+from telemetry import CallMetrics, run_trace, annotate_run
+from providers import xai_provider
+from hedging import ahedged
+from ip_guard import aguarded_scrub
+from handoff import JSON_OBJECT, parse_handoff, dump_handoff, aguarded_scrub_handoff
+from deadline import Deadline, budget_context, current_budget
+
+
+class AsyncGrokAgenticEngine(GrokAgenticEngine):
+    """
+    asyncio twin of GrokAgenticEngine built on the Groq async client.
+
+    Prompts, models, caching and preprocessing are inherited unchanged; only the
+    I/O is non-blocking, so many images can be in flight at once via run_batch.
+    """
+
+    def __init__(self, api_key=None, cache=None, preprocessor=None, stream=False, ip_detector=None,
+                 near_dup_index=None, xai_api_key=None, hedge=None, fallback_chains=None, panel_detector=None,
+                 api_keys=None, structured=None, history=None, catalog=None):
+        super().__init__(api_key=api_key, cache=cache, preprocessor=preprocessor, stream=stream,
+                         ip_detector=ip_detector, near_dup_index=near_dup_index, xai_api_key=xai_api_key,
+                         hedge=hedge, fallback_chains=fallback_chains, panel_detector=panel_detector,
+                         api_keys=api_keys, structured=structured, history=history, catalog=catalog)
+
+    def _create_client(self):
+        # Async pools are tied to an event loop, so the client is looked up on use
+        return None
+
+    @property
+    def client(self):
+        """Pooled AsyncGroq client for the running event loop, unless one was assigned."""
+        return self._client or get_async_client(self.api_key)
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    def _key_client(self, api_key=None):
+        if api_key is None or api_key == self.api_key:
+            return self.client
+        return get_async_client(api_key)
+
+    def _xai_provider(self, api_key):
+        return xai_provider(api_key, use_async=True)
+
+    async def _safe_call(self, model, messages, temperature=0.2, response_format=None, stream=False):
+        """
+        Routed API call with retries and failover (see GrokAgenticEngine._safe_call),
+        without blocking the event loop.
+
+        With stream=True, returns an async generator of visible text chunks instead.
+        """
+        budget = current_budget()
+        if budget is not None:
+            messages = budget.annotate(messages)
+        if stream:
+            return self._stream_call(model, messages, temperature, response_format)
+        if self.hedge:
+            return await self._hedged_call(model, messages, temperature, response_format)
+        return await self._routed_call(model, messages, temperature, response_format)
+
+    async def _hedged_call(self, model, messages, temperature, response_format):
+        """Async GrokAgenticEngine._hedged_call; the slower of the two requests is cancelled."""
+        estimate = estimate_tokens(messages)
+        backend, spare, delay = self._hedge_plan(model, estimate)
+        if delay is None:
+            return await self._routed_call(model, messages, temperature, response_format, first=backend)
+        return await ahedged(
+            lambda: self._routed_call(model, messages, temperature, response_format, first=backend),
+            lambda: self._routed_call(model, messages, temperature, response_format, first=spare, hedge=True),
+            delay,
+            lambda: self.hedge.admit(spare, estimate),
+            self.hedge,
+        )
+
+    async def _routed_call(self, model, messages, temperature, response_format, first=None, hedge=False):
+        estimate = estimate_tokens(messages)
+        metrics = CallMetrics(model, hedge=hedge)
+        failures = {}
+        route = self._route(model)
+        backend = first or self._pick(route, estimate)
+        max_tokens = self._max_tokens()
+
+        while True:
+            client, limiter = backend.lease(estimate)
+            metrics.routed(backend.provider.name, backend.model)
+            health = backend.health
+            probe = health.begin()
+            try:
+                metrics.waited(await limiter.acquire_async(estimate))
+                params = self._request_params(backend.model, messages, temperature, response_format, max_tokens)
+                started = time.monotonic()
+                raw = await client.chat.completions.with_raw_response.create(**params)
+                limiter.update_from_headers(raw.headers)
+                response = await _parse(raw)
+                backend.health.success(time.monotonic() - started, self._completion_tokens(response.usage))
+                limiter.record_usage(estimate, self._total_tokens(response))
+                metrics.usage(response.usage)
+                metrics.finish()
+                return self._clean_content(response.choices[0].message.content)
+            except asyncio.CancelledError as e:
+                metrics.finish(error=e)
+                raise
+            except Exception as e:
+                backend = self._fail_over(route, backend, e, estimate, failures, limiter)
+                if backend is None:
+                    metrics.finish(error=e)
+                    raise e
+                metrics.retry()
+                # Clients don't retry on their own (max_retries=0), so back off here while it cools down
+                await asyncio.sleep(backend.health.cooling_for())
+            finally:
+                if probe:
+                    # Cancelled, abandoned or a bad request: no verdict, so the next call probes
+                    health.release()
+
+    async def _stream_call(self, model, messages, temperature=0.2, response_format=None):
+        """Streaming _safe_call: yields text chunks with <think> blocks stripped on the fly."""
+        estimate = estimate_tokens(messages)
+        metrics = CallMetrics(model, stream=True)
+        failures = {}
+        route = self._route(model)
+        backend = self._pick(route, estimate)
+        max_tokens = self._max_tokens()
+
+        while True:
+            emitted = False
+            client, limiter = backend.lease(estimate)
+            metrics.routed(backend.provider.name, backend.model)
+            health = backend.health
+            probe = health.begin()
+            try:
+                metrics.waited(await limiter.acquire_async(estimate))
+                params = self._request_params(backend.model, messages, temperature, response_format, max_tokens)
+                params["stream"] = True
+                params.update(backend.provider.stream_params)
+                started = time.monotonic()
+                raw = await client.chat.completions.with_raw_response.create(**params)
+                limiter.update_from_headers(raw.headers)
+                think_filter = ThinkTagFilter()
+                usage = None
+                first_chunk = None
+                async for chunk in await _parse(raw):
+                    usage = chunk_usage_info(chunk) or usage
+                    text = chunk_text(chunk)
+                    if text and first_chunk is None:
+                        first_chunk = time.monotonic() - started
+                    visible = think_filter.feed(text)
+                    if visible:
+                        if not emitted:
+                            metrics.first_token()
+                        emitted = True
+                        yield visible
+                tail = think_filter.flush()
+                if tail:
+                    yield tail
+                backend.health.success(time.monotonic() - started, self._completion_tokens(usage), first_chunk)
+                limiter.record_usage(estimate, getattr(usage, "total_tokens", None))
+                metrics.usage(usage)
+                metrics.finish()
+                return
+            except Exception as e:
+                # Once text has reached the caller a retry would duplicate it
+                backend = None if emitted else self._fail_over(route, backend, e, estimate, failures, limiter)
+                if backend is None:
+                    metrics.finish(error=e)
+                    raise e
+                metrics.retry()
+                # Clients don't retry on their own (max_retries=0), so back off here while it cools down
+                await asyncio.sleep(backend.health.cooling_for())
+            finally:
+                if probe:
+                    # Cancelled, abandoned or a bad request: no verdict, so the next call probes
+                    health.release()
+
+    async def _complete(self, model, messages, temperature, on_partial=None):
+        """_safe_call, streamed into on_partial when streaming is enabled."""
+        if not (self.stream and on_partial):
+            return await self._safe_call(model=model, messages=messages, temperature=temperature)
+        return await acollect_stream(await self._safe_call(model, messages, temperature, stream=True), on_partial)
+
+    async def _vision_stage(self, image_bytes, on_partial=None):
+        # Decoding and resizing are CPU-bound; keep them off the event loop
+        layout, parts = await asyncio.to_thread(self._prepare_vision, image_bytes)
+        if layout is not None:
+            return await self._vision_panels(layout, parts, on_partial)
+        prepared = parts[0][1]
+        return await self.agent_1_vision(prepared.base64(), prepared.mime_type, on_partial=on_partial)
+
+    async def _vision_panels(self, layout, parts, on_partial=None):
+        """Describe every panel concurrently; on_partial sees the merge grow as panels finish."""
+        descriptions = [None] * len(parts)
+
+        async def describe(index, position, prepared):
+            text = await self.agent_1_panel(prepared.base64(), prepared.mime_type, position, len(parts))
+            return index, text
+
+        tasks = [asyncio.ensure_future(describe(index, position, prepared))
+                 for index, (position, prepared) in enumerate(parts)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, text = await next_done
+                descriptions[index] = text
+                if on_partial:
+                    on_partial(self._merge_panels(layout, parts, descriptions))
+        finally:
+            for task in tasks:
+                task.cancel()
+        return self._merge_panels(layout, parts, descriptions)
+
+    async def agent_1_vision(self, base64_image, mime_type="image/jpeg", on_partial=None):
+        """Analyze image and generate detailed prompt."""
+        if self.structured:
+            return await self._handoff_call(self.vision_model, self._vision_messages(base64_image, mime_type, True),
+                                            self.vision_temperature)
+        return await self._complete(
+            model=self.vision_model,
+            messages=self._vision_messages(base64_image, mime_type),
+            temperature=self.vision_temperature,
+            on_partial=on_partial
+        )
+
+    async def agent_1_panel(self, base64_image, mime_type, position, count):
+        """Analyze one collage panel; not streamed, since panels finish out of order."""
+        if self.structured:
+            return await self._handoff_call(self.vision_model,
+                                            self._panel_messages(base64_image, mime_type, position, count, True),
+                                            self.vision_temperature)
+        return await self._safe_call(
+            model=self.vision_model,
+            messages=self._panel_messages(base64_image, mime_type, position, count),
+            temperature=self.vision_temperature
+        )
+
+    async def agent_2_enhance_accuracy(self, prompt, on_partial=None):
+        """Enhance prompt with hyper-accurate minute details, handling collages and grids."""
+        if self.structured:
+            return await self._handoff_call(self.primary_model, self._enhance_messages(prompt, True),
+                                            self.enhance_temperature)
+        return await self._complete(
+            model=self.primary_model,
+            messages=self._enhance_messages(prompt),
+            temperature=self.enhance_temperature,
+            on_partial=on_partial
+        )
+
+    async def agent_3_scrub_copyright(self, detailed_prompt, on_partial=None):
+        """Translate specific IPs into forensic visual descriptions without losing accuracy."""
+        if self.structured:
+            return await self._scrub_handoff(detailed_prompt, on_partial)
+        if not self.ip_detector:
+            return await self._scrub_full(detailed_prompt, on_partial)
+        result, report = await aguarded_scrub(
+            self.ip_detector,
+            detailed_prompt,
+            scrub_full=lambda text: self._scrub_full(text, on_partial),
+            scrub_fragments=self._scrub_fragments,
+        )
+        annotate_run(ip_report=report)
+        if on_partial and report["mode"] != "full":
+            on_partial(result)
+        return result
+
+    async def _scrub_full(self, detailed_prompt, on_partial=None):
+        return await self._complete(
+            model=self.primary_model,
+            messages=self._scrub_messages(detailed_prompt),
+            temperature=self.scrub_temperature,
+            on_partial=on_partial
+        )
+
+    async def _scrub_fragments(self, numbered_sentences):
+        return await self._safe_call(
+            model=self.primary_model,
+            messages=self._scrub_fragment_messages(numbered_sentences),
+            temperature=self.scrub_temperature
+        )
+
+    async def _handoff_call(self, model, messages, temperature):
+        reply = await self._safe_call(model=model, messages=messages, temperature=temperature,
+                                      response_format=JSON_OBJECT)
+        return dump_handoff(parse_handoff(reply))
+
+    async def _scrub_handoff(self, handoff_text, on_partial=None):
+        result, report = await aguarded_scrub_handoff(
+            self.ip_detector,
+            parse_handoff(handoff_text),
+            scrub_fragments=self._scrub_fragments,
+            scrub_full=self._scrub_full,
+        )
+        annotate_run(ip_report=report)
+        if on_partial:
+            on_partial(result)
+        return result
+
+    def _budgeted(self, deadline, stages, run):
+        async def budgeted(*inputs, **kwargs):
+            with budget_context(self._plan_budget(deadline, stages, inputs)):
+                return await run(*inputs, **kwargs)
+        return budgeted
+
+    async def run_engine(self, image, status_callback=None, with_trace=False, deadline=None, source=None):
+        """Async version of GrokAgenticEngine.run_engine."""
+        deadline = None if deadline is None else Deadline(deadline)
+        outputs = None
+        # Each task has its own context, so concurrent runs keep separate traces
+        with run_trace() as trace:
+            image_bytes = await asyncio.to_thread(self.preprocessor.load, image)
+
+            # Perceptual hashing decodes the image; keep it off the event loop
+            key, result, hashes = await asyncio.to_thread(self._lookup_run, image_bytes, status_callback)
+            trace.cached = result is not None
+            if result is None:
+                outputs = await self.build_pipeline(deadline).arun(self._pipeline_sources(image_bytes), status_callback=status_callback)
+                # Cache and near-duplicate index writes are synchronous SQLite commits
+                result = await asyncio.to_thread(self._finish_run, outputs, key, status_callback, hashes, deadline)
+            self._report_deadline(deadline, trace, status_callback)
+        summary = trace.summary()
+        # Thumbnailing decodes the image; keep it off the event loop
+        await asyncio.to_thread(self._record_history, image_bytes, result, outputs, summary, deadline,
+                                source or self._image_name(image))
+        return (result, summary) if with_trace else result
+
+    async def run_batch(self, paths, concurrency=4, status_callback=None):
+        """
+        Run many images through the pipeline with at most `concurrency` in flight.
+
+        `paths` may be any iterable (it is consumed lazily) of paths or other
+        inputs run_engine accepts. Yields
+        (path, result, error) tuples in completion order; exactly one of result
+        and error is None. `status_callback`, if given, receives (path, msg, agent_id),
+        plus the partial text when streaming.
+
+        Closing the generator early (break, aclose, cancellation) cancels the
+        images still in flight.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def process(path):
+            callback = None
+            if status_callback:
+                callback = lambda msg, agent_id="", *partial: status_callback(path, msg, agent_id, *partial)
+            try:
+                return path, await self.run_engine(path, status_callback=callback), None
+            except Exception as e:
+                return path, None, e
+            finally:
+                semaphore.release()
+
+        pending = set()
+        try:
+            for path in paths:
+                await semaphore.acquire()
+                pending.add(asyncio.create_task(process(path)))
+                finished = {task for task in pending if task.done()}
+                pending -= finished
+                for task in finished:
+                    yield task.result()
+
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _parse(raw):
+    # AsyncGroq raw responses parse asynchronously, the OpenAI SDK's (xAI) synchronously
+    parsed = raw.parse()
+    if inspect.isawaitable(parsed):
+        parsed = await parsed
+    return parsed
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from result_cache import default_cache
+
+load_dotenv()
+
+# Files a directory or glob source picks up; anything else (e.g. our own output) is skipped
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".jfif", ".pjpeg", ".pjp", ".gif", ".bmp")
+
+
+def iter_records(source, exclude=()):
+    """
+    Stream input records lazily from a JSONL file or a glob/directory of images.
+
+    JSONL lines need an "image" (or "path") field and may carry "id" and "mode".
+    Images are taken in sorted path order, leaving out non-images and the
+    paths in `exclude` (the output and its checkpoint). Resuming relies on
+    that order, so only add files that sort after the existing ones between runs.
+    """
+    if source.endswith(".jsonl"):
+        with open(source, "r", encoding="utf-8") as handle:
+            for line_number, line in enumerate(handle, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                image = record.get("image") or record.get("path")
+                if not image:
+                    raise ValueError(f"{source}:{line_number}: record has no 'image' field")
+                record.setdefault("id", str(line_number))
+                record["image"] = image
+                yield record
+        return
+
+    pattern = os.path.join(source, "*") if os.path.isdir(source) else source
+    excluded = {os.path.abspath(path) for path in exclude}
+    for path in sorted(glob.glob(pattern)):
+        if (os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS)
+                and os.path.abspath(path) not in excluded):
+            yield {"id": path, "image": path}
+
+
+class Checkpoint:
+    """
+    Records how many input records are finished, which of them failed (by
+    input position) and where the output ended, written atomically.
+    """
+
+    def __init__(self, output_path, signature):
+        self.path = output_path + ".ckpt"
+        self.signature = signature
+        self.done = 0
+        self.offset = 0
+        self.failed = []
+
+    def load(self):
+        """Return True if a checkpoint for the same job exists and has been loaded."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as handle:
+            state = json.load(handle)
+        if state.get("signature") != self.signature:
+            raise ValueError(
+                f"{self.path} belongs to a different job ({state.get('signature')}); "
+                "delete it or choose another --output."
+            )
+        self.done = state["done"]
+        self.offset = state["offset"]
+        self.failed = state.get("failed", [])
+        return True
+
+    def reset(self):
+        self.done = 0
+        self.offset = 0
+        self.failed = []
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as handle:
+            json.dump({"signature": self.signature, "done": self.done, "offset": self.offset,
+                       "failed": self.failed}, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.path)
+
+
+def make_worker(task, mode, cache):
+    if task == "engine":
+        from grok_engine import GrokAgenticEngine
+        engine = GrokAgenticEngine(cache=cache)
+
+        def work(record):
+            return engine.run_engine(record["image"])
+    else:
+        from prompt_gen import generate_prompt
+
+        def work(record):
+            return generate_prompt(record["image"], mode=record.get("mode", mode), cache=cache)
+
+    def run(record):
+        started = time.time()
+        result = {"id": record["id"], "image": record["image"], "task": task}
+        if task == "prompt":
+            result["mode"] = record.get("mode", mode)
+        try:
+            result["result"] = work(record)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["elapsed"] = round(time.time() - started, 3)
+        return result
+
+    return run
+
+
+def run_batch(source, output_path, task="prompt", mode="Human-Aesthetic Narrative",
+              concurrency=1, cache=None, progress=print):
+    """
+    Process every record from `source`, appending one JSON line per record to
+    `output_path` in input order. Safe to interrupt and re-run: finished
+    records are skipped using the checkpoint next to the output file, and
+    records that failed are tried again first. A retried record gets a new
+    line, so for each id the last line in the output is the one that counts.
+    Memory is bounded by `concurrency`, not by the input size.
+
+    Returns (records finished, records still failed).
+    """
+    checkpoint = Checkpoint(output_path, {"source": os.path.abspath(source), "task": task, "mode": mode})
+    resumed = checkpoint.load()
+    if resumed and (not os.path.exists(output_path) or os.path.getsize(output_path) < checkpoint.offset):
+        progress(f"{output_path} is missing or shorter than its checkpoint; starting over.")
+        checkpoint.reset()
+        resumed = False
+    if resumed:
+        progress(f"Resuming after {checkpoint.done} finished records ({len(checkpoint.failed)} to retry).")
+
+    worker = make_worker(task, mode, cache)
+    records = iter_records(source, exclude=(output_path, checkpoint.path, checkpoint.path + ".tmp"))
+    retries = []
+    failed = set(checkpoint.failed)
+    for index in range(checkpoint.done):
+        record = next(records, None)
+        if record is None:
+            break
+        if index in failed:
+            retries.append((index, record))
+    fresh = ((index, record) for index, record in enumerate(records, start=checkpoint.done))
+
+    # Drop anything written after the last checkpoint (a record cut off mid-crash)
+    out = open(output_path, "r+b" if resumed else "wb")
+    out.truncate(checkpoint.offset)
+    out.seek(checkpoint.offset)
+
+    window = deque()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        def commit(index, future):
+            result = future.result()
+            out.write((json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8"))
+            out.flush()
+            if index >= checkpoint.done:
+                checkpoint.done = index + 1
+            if "error" not in result and index in checkpoint.failed:
+                checkpoint.failed.remove(index)
+            elif "error" in result and index not in checkpoint.failed:
+                checkpoint.failed.append(index)
+            checkpoint.offset = out.tell()
+            checkpoint.save()
+            status = "ERROR" if "error" in result else "ok"
+            progress(f"[{index + 1}] {result['id']}: {status} ({result['elapsed']}s)")
+
+        for index, record in itertools.chain(retries, fresh):
+            window.append((index, executor.submit(worker, record)))
+            if len(window) >= concurrency:
+                commit(*window.popleft())
+        while window:
+            commit(*window.popleft())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        out.close()
+    return checkpoint.done, len(checkpoint.failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch prompt generation with resumable JSONL output.")
+    parser.add_argument("source", help="JSONL file of records, an image directory, or a glob such as 'refs/*.jpg'")
+    parser.add_argument("-o", "--output", required=True, help="Output JSONL path (a .ckpt file is kept beside it)")
+    parser.add_argument("--task", choices=["prompt", "engine"], default="prompt",
+                        help="'prompt' runs prompt_gen.generate_prompt, 'engine' runs GrokAgenticEngine.run_engine")
+    parser.add_argument("--mode", default="Human-Aesthetic Narrative", help="Default PROMPT_MODES entry for --task prompt")
+    parser.add_argument("-j", "--concurrency", type=int, default=1)
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the on-disk result cache")
+    args = parser.parse_args(argv)
+
+    cache = None if args.no_cache else default_cache()
+    try:
+        done, failures = run_batch(args.source, args.output, task=args.task, mode=args.mode,
+                                   concurrency=max(1, args.concurrency), cache=cache)
+    except KeyboardInterrupt:
+        print("\nInterrupted. Re-run the same command to resume.")
+        return 130
+    print(f"Finished {done} records ({failures} failed). Output: {args.output}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import PIL.Image
+from mock_groq_server import MockGroqServer, add_config_arguments, config_from_args
+
+TARGETS = ["engine", "prompt", "modes", "batch", "async"]
+
+
+def percentile(values, q):
+    """Linear-interpolated q-th percentile (0-100) of `values`."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def stage_classifier():
+    """Map a request body to its pipeline stage by its system prompt."""
+    from grok_engine import AGENT_1_SYSTEM_PROMPT, AGENT_2_SYSTEM_PROMPT, AGENT_3_SYSTEM_PROMPT
+    from prompt_gen import PROMPT_MODES, GUARDIAN_SYSTEM_PROMPT, EXTRACTION_SYSTEM_PROMPT, render_system_prompt
+
+    known = {prompt: "prompt_vision" for prompt in PROMPT_MODES.values()}
+    known.update({render_system_prompt(mode): "prompt_render" for mode in PROMPT_MODES})
+    known.update({
+        EXTRACTION_SYSTEM_PROMPT: "prompt_vision",
+        AGENT_1_SYSTEM_PROMPT: "agent_1",
+        AGENT_2_SYSTEM_PROMPT: "agent_2",
+        AGENT_3_SYSTEM_PROMPT: "agent_3",
+        GUARDIAN_SYSTEM_PROMPT: "guardian",
+    })
+
+    def stage_of(body):
+        for message in body.get("messages", []):
+            if message.get("role") == "system":
+                return known.get(message.get("content"), body.get("model", "unknown"))
+        return body.get("model", "unknown")
+
+    return stage_of
+
+
+def make_test_image(path, size=(2400, 1800)):
+    """Smooth gradient JPEG, big enough that preprocessing does real work."""
+    width, height = size
+    image = PIL.Image.linear_gradient("L").resize(size).convert("RGB")
+    image.paste((180, 90, 40), (width // 3, height // 4, width // 2, height // 2))
+    image.save(path, "JPEG", quality=92)
+    return path
+
+
+class StageTimer:
+    """status_callback that turns the pipeline's stage announcements into per-stage durations."""
+
+    def __init__(self):
+        self.current = None
+        self.started = None
+        self.durations = {}
+
+    def __call__(self, msg, agent_id="", *partial):
+        if partial or agent_id == self.current:
+            return
+        now = time.perf_counter()
+        if self.current is not None:
+            self.durations[self.current] = now - self.started
+        self.current = agent_id if agent_id != "done" else None
+        self.started = now
+
+
+def _merge_stage_times(timers):
+    stages = {}
+    for timer in timers:
+        for stage, seconds in timer.durations.items():
+            stages.setdefault(stage, []).append(seconds)
+    return {stage: summarize(values) for stage, values in sorted(stages.items())}
+
+
+def run_threaded(job, runs, concurrency):
+    """Run `job(index)` `runs` times on a thread pool; returns (latencies, errors, wall seconds)."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def timed(index):
+        started = time.perf_counter()
+        try:
+            job(index)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(runs)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def bench_engine(image_path, runs, concurrency, stream):
+    from grok_engine import GrokAgenticEngine
+    engine = GrokAgenticEngine(cache=None, stream=stream)
+    timers = []
+
+    def job(index):
+        timer = StageTimer()
+        timers.append(timer)
+        engine.run_engine(image_path, status_callback=timer)
+
+    latencies, errors, wall = run_threaded(job, runs, concurrency)
+    return latencies, errors, wall, _merge_stage_times(timers)
+
+
+def bench_prompt(image_path, runs, concurrency, stream):
+    from prompt_gen import generate_prompt
+    latencies, errors, wall = run_threaded(lambda index: generate_prompt(image_path, cache=None), runs, concurrency)
+    return latencies, errors, wall, {}
+
+
+def bench_modes(image_path, runs, concurrency, stream):
+    """Every PROMPT_MODES output per run through generate_prompts (compare: 3x the prompt target)."""
+    from prompt_gen import generate_prompts
+    latencies, errors, wall = run_threaded(lambda index: generate_prompts(image_path, cache=None), runs, concurrency)
+    return latencies, errors, wall, {}
+
+
+def bench_batch(image_path, runs, concurrency, stream):
+    from batch_cli import run_batch
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "records.jsonl")
+        output = os.path.join(workdir, "results.jsonl")
+        with open(source, "w", encoding="utf-8") as handle:
+            for index in range(runs):
+                handle.write(json.dumps({"id": f"bench-{index}", "image": image_path}) + "\n")
+        started = time.perf_counter()
+        run_batch(source, output, task="prompt", concurrency=concurrency, cache=None, progress=lambda msg: None)
+        wall = time.perf_counter() - started
+        latencies, errors = [], []
+        with open(output, "r", encoding="utf-8") as handle:
+            for line in handle:
+                record = json.loads(line)
+                if "error" in record:
+                    errors.append(record["error"])
+                else:
+                    latencies.append(record["elapsed"])
+    return latencies, errors, wall, {}
+
+
+def bench_async(image_path, runs, concurrency, stream):
+    from async_engine import AsyncGrokAgenticEngine
+    engine = AsyncGrokAgenticEngine(cache=None, stream=stream)
+    timers = {}
+    first_seen = {}
+
+    def on_status(path, msg, agent_id="", *partial):
+        first_seen.setdefault(path, time.perf_counter())
+        timers.setdefault(path, StageTimer())(msg, agent_id, *partial)
+
+    async def go(paths):
+        latencies, errors = [], []
+        async for path, result, error in engine.run_batch(paths, concurrency=concurrency, status_callback=on_status):
+            if error is not None:
+                errors.append(f"{type(error).__name__}: {error}")
+            else:
+                latencies.append(time.perf_counter() - first_seen[path])
+        return latencies, errors
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # run_batch reports by path, so every run gets its own copy of the image
+        paths = []
+        for index in range(runs):
+            path = os.path.join(workdir, f"bench-{index}{os.path.splitext(image_path)[1]}")
+            shutil.copyfile(image_path, path)
+            paths.append(path)
+        started = time.perf_counter()
+        latencies, errors = asyncio.run(go(paths))
+        wall = time.perf_counter() - started
+    return latencies, errors, wall, _merge_stage_times(timers.values())
+
+
+BENCHES = {"engine": bench_engine, "prompt": bench_prompt, "modes": bench_modes, "batch": bench_batch,
+           "async": bench_async}
+
+
+def server_summary(stats):
+    summary = {}
+    for stage, entry in sorted(stats.items()):
+        summary[stage] = {
+            "requests": entry["requests"],
+            "ok": entry["ok"],
+            "errors_429": entry["errors_429"],
+            "errors_5xx": entry["errors_5xx"],
+            # Every failed request is either retried (SDK or engine) or surfaces as a run error
+            "retries": entry["requests"] - entry["ok"],
+            "streamed": entry["streamed"],
+            "server_latency": summarize(entry["server_seconds"]),
+        }
+    return summary
+
+
+def limiter_delta(before, after):
+    delta = {}
+    for model, snap in after.items():
+        old = before.get(model, {})
+        delta[model] = {
+            "rejections": snap["rejections"] - old.get("rejections", 0),
+            "throttled_seconds": round(snap["throttled_seconds"] - old.get("throttled_seconds", 0.0), 3),
+        }
+    return delta
+
+
+def run_benchmark(targets, runs, concurrency, config, image_path=None, stream=False, rpm=100000, tpm=10 ** 8):
+    """Run each target against a fresh mock server and return the report dict."""
+    mock = MockGroqServer(config, stage_of=stage_classifier()).start()
+    # The Groq SDK picks these up when the pooled clients are first created
+    os.environ["GROQ_BASE_URL"] = mock.base_url
+    os.environ["GROQ_API_KEY"] = "mock-key"
+
+    from rate_limiter import configure_rate_limit, rate_limit_snapshot
+    for model in config.models:
+        if rpm or tpm:
+            configure_rate_limit(model, rpm, tpm)
+
+    workdir = tempfile.TemporaryDirectory()
+    # The mock's model list must never end up in the real catalog
+    os.environ["MODEL_CATALOG_PATH"] = os.path.join(workdir.name, "models.json")
+    image_path = image_path or make_test_image(os.path.join(workdir.name, "bench.jpg"))
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "runs": runs,
+        "concurrency": concurrency,
+        "stream": stream,
+        "image": image_path,
+        "mock": config.to_dict(),
+        "targets": {},
+    }
+    try:
+        for target in targets:
+            mock.reset()
+            limits_before = rate_limit_snapshot()
+            latencies, errors, wall, stages = BENCHES[target](image_path, runs, concurrency, stream)
+            report["targets"][target] = {
+                "wall_seconds": round(wall, 4),
+                "throughput_per_second": round(len(latencies) / wall, 4) if wall else None,
+                "latency": summarize(latencies),
+                "errors": len(errors),
+                "error_samples": errors[:5],
+                "stages": stages,
+                "server": server_summary(mock.stats()),
+                "rate_limiter": limiter_delta(limits_before, rate_limit_snapshot()),
+            }
+    finally:
+        mock.stop()
+        workdir.cleanup()
+    return report
+
+
+def print_report(report, baseline=None):
+    print(f"{'target':<8} {'ok':>5} {'err':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>7} {'retries':>8}")
+    for target, result in report["targets"].items():
+        latency = result["latency"]
+        retries = sum(stage["retries"] for stage in result["server"].values())
+        line = (f"{target:<8} {latency['count']:>5} {result['errors']:>4} {_fmt(latency.get('p50')):>8} "
+                f"{_fmt(latency.get('p95')):>8} {_fmt(latency.get('p99')):>8} "
+                f"{_fmt(result['throughput_per_second']):>7} {retries:>8}")
+        old = (baseline or {}).get("targets", {}).get(target)
+        if old and old["latency"].get("p50") and latency.get("p50"):
+            change = (latency["p50"] - old["latency"]["p50"]) / old["latency"]["p50"] * 100
+            line += f"   p50 {change:+.1f}% vs baseline"
+        print(line)
+        for stage, stats in result["stages"].items():
+            print(f"  {stage:<14} p50 {_fmt(stats.get('p50'))}  p95 {_fmt(stats.get('p95'))}  p99 {_fmt(stats.get('p99'))}")
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.3f}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline latency/throughput benchmark against a local mock Groq server.")
+    parser.add_argument("--targets", default="engine,prompt,batch,async",
+                        help=f"Comma-separated subset of {','.join(TARGETS)}")
+    parser.add_argument("-n", "--runs", type=int, default=20, help="Images per target")
+    parser.add_argument("-j", "--concurrency", type=int, default=4)
+    parser.add_argument("--image", help="Image to send (default: a generated 2400x1800 JPEG)")
+    parser.add_argument("--stream", action="store_true", help="Use streaming completions in the engines")
+    parser.add_argument("--rpm", type=int, default=100000, help="Client rate limit per model (0 keeps the free-tier defaults)")
+    parser.add_argument("--tpm", type=int, default=10 ** 8)
+    parser.add_argument("-o", "--output", default=None, help="JSON report path (default: benchmark_<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier JSON report to print p50 changes against")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    targets = [target.strip() for target in args.targets.split(",") if target.strip()]
+    unknown = [target for target in targets if target not in BENCHES]
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(unknown)}")
+
+    report = run_benchmark(targets, max(1, args.runs), max(1, args.concurrency), config_from_args(args),
+                           image_path=args.image, stream=args.stream, rpm=args.rpm, tpm=args.tpm)
+    output = args.output or f"benchmark_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as handle:
+        json.dump(report, handle, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as handle:
+            baseline = json.load(handle)
+    print_report(report, baseline)
+    print(f"\nReport written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
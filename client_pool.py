@@ -0,0 +1,130 @@
+import os
+import asyncio
+import weakref
+import threading
+import httpx
+from groq import Groq, AsyncGroq
+from openai import OpenAI, AsyncOpenAI
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE = 10
+DEFAULT_KEEPALIVE_EXPIRY = 120.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+# Long completions (agent_2) can take well over a minute to finish
+DEFAULT_READ_TIMEOUT = 180.0
+# The engines and prompt_gen retry themselves (limiter, failover, breaker, hedging);
+# SDK retries underneath would multiply requests and delay failover
+DEFAULT_SDK_MAX_RETRIES = 0
+
+
+class PoolConfig:
+    """Connection-pool limits and timeouts, read from GROQ_POOL_* / GROQ_*_TIMEOUT by default."""
+
+    def __init__(self, max_connections=None, max_keepalive=None, keepalive_expiry=None,
+                 connect_timeout=None, read_timeout=None, max_retries=None):
+        self.max_connections = int(max_connections or os.getenv("GROQ_POOL_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS))
+        self.max_keepalive = int(max_keepalive or os.getenv("GROQ_POOL_MAX_KEEPALIVE", DEFAULT_MAX_KEEPALIVE))
+        self.keepalive_expiry = float(keepalive_expiry or os.getenv("GROQ_POOL_KEEPALIVE_EXPIRY", DEFAULT_KEEPALIVE_EXPIRY))
+        self.connect_timeout = float(connect_timeout or os.getenv("GROQ_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT))
+        self.read_timeout = float(read_timeout or os.getenv("GROQ_READ_TIMEOUT", DEFAULT_READ_TIMEOUT))
+        if max_retries is None:
+            max_retries = os.getenv("GROQ_SDK_MAX_RETRIES", DEFAULT_SDK_MAX_RETRIES)
+        self.max_retries = int(max_retries)
+
+    def limits(self):
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def timeout(self):
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+
+_clients = {}
+# Async pools per event loop; entries vanish with their loop
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_client(api_key, base_url=None, config=None):
+    """
+    Shared Groq client for `api_key`, reusing one keep-alive connection pool
+    across engines, sessions and threads in this process.
+    """
+    return _shared_client(Groq, api_key, base_url, config)
+
+
+def get_openai_client(api_key, base_url, config=None):
+    """Shared OpenAI SDK client for an OpenAI-compatible API (xAI), pooled like get_client."""
+    return _shared_client(OpenAI, api_key, base_url, config)
+
+
+def _shared_client(sdk, api_key, base_url, config):
+    key = (sdk, api_key, base_url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            config = config or PoolConfig()
+            http_client = httpx.Client(limits=config.limits(), timeout=config.timeout())
+            client = sdk(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=http_client,
+                timeout=config.timeout(),
+                max_retries=config.max_retries,
+            )
+            _clients[key] = client
+        return client
+
+
+def get_async_client(api_key, base_url=None, config=None):
+    """
+    Shared AsyncGroq client for `api_key` on the running event loop.
+
+    httpx async pools are bound to the loop that opened their connections, so
+    each loop gets its own client. Outside a running loop a fresh, unshared
+    client is returned.
+    """
+    return _shared_async_client(AsyncGroq, api_key, base_url, config)
+
+
+def get_async_openai_client(api_key, base_url, config=None):
+    """AsyncOpenAI twin of get_openai_client, per event loop like get_async_client."""
+    return _shared_async_client(AsyncOpenAI, api_key, base_url, config)
+
+
+def _shared_async_client(sdk, api_key, base_url, config):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _new_async_client(sdk, api_key, base_url, config)
+    key = (sdk, api_key, base_url)
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = clients[key] = _new_async_client(sdk, api_key, base_url, config)
+        return client
+
+
+def _new_async_client(sdk, api_key, base_url, config):
+    config = config or PoolConfig()
+    http_client = httpx.AsyncClient(limits=config.limits(), timeout=config.timeout())
+    return sdk(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=http_client,
+        timeout=config.timeout(),
+        max_retries=config.max_retries,
+    )
+
+
+def close_all():
+    """Close every pooled sync client (async clients go away with their event loop)."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
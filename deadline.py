@@ -0,0 +1,161 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Output tokens a stage produces when left alone, until real runs say otherwise
+DEFAULT_STAGE_TOKENS = {
+    "agent_1": 700,
+    "agent_2": 1300,
+    "agent_3": 1300,
+}
+FALLBACK_STAGE_TOKENS = 800
+# Weight of the newest run in the per-stage length averages
+LENGTH_ALPHA = 0.2
+# Budgets never go below this (a prompt cut to a few lines is no use) or above the cap
+MIN_STAGE_TOKENS = 200
+MAX_STAGE_TOKENS = 4096
+# Share of the remaining time held back for local work and jitter
+SAFETY_MARGIN = 0.1
+# Roughly how many words a token buys, for the length note in the prompt
+WORDS_PER_TOKEN = 0.75
+
+BUDGET_NOTE = "\n\nLENGTH LIMIT: a latency budget applies. Write at most about {words} words and finish your last sentence."
+
+_current_budget = contextvars.ContextVar("stage_budget", default=None)
+
+_stage_tokens = dict(DEFAULT_STAGE_TOKENS)
+_stage_tokens_lock = threading.Lock()
+
+
+def expected_tokens(stage):
+    """Typical output tokens of `stage`, averaged over unbudgeted runs."""
+    with _stage_tokens_lock:
+        return _stage_tokens.get(stage, FALLBACK_STAGE_TOKENS)
+
+
+def observe_tokens(stage, tokens):
+    """Fold one unbudgeted output length into the stage's average."""
+    if not tokens:
+        return
+    with _stage_tokens_lock:
+        current = _stage_tokens.get(stage)
+        if current is None:
+            _stage_tokens[stage] = tokens
+        else:
+            _stage_tokens[stage] = current + LENGTH_ALPHA * (tokens - current)
+
+
+def text_tokens(text):
+    # Same 4-characters-per-token rule as rate_limiter.estimate_tokens
+    return len(text) // 4
+
+
+class StageBudget:
+    """Output-token cap and time allowance for the LLM calls of one stage."""
+
+    def __init__(self, stage, max_tokens, seconds, expected):
+        self.stage = stage
+        self.max_tokens = max_tokens
+        self.seconds = seconds
+        self.expected = expected
+        self.started = time.monotonic()
+        self.elapsed = None
+
+    def time_left(self):
+        return self.seconds - (time.monotonic() - self.started)
+
+    @property
+    def tight(self):
+        """True when the cap is below what the stage would normally write."""
+        return self.max_tokens < self.expected
+
+    def annotate(self, messages):
+        """`messages` with a length note on the system prompt, so the model wraps up instead of being cut off."""
+        if not self.tight or not messages or messages[0].get("role") != "system":
+            return messages
+        note = BUDGET_NOTE.format(words=int(self.max_tokens * WORDS_PER_TOKEN))
+        return [dict(messages[0], content=messages[0]["content"] + note)] + list(messages[1:])
+
+    def summary(self):
+        return {
+            "stage": self.stage,
+            "max_tokens": self.max_tokens,
+            "expected_tokens": self.expected,
+            "allowance": round(self.seconds, 3),
+            "seconds": None if self.elapsed is None else round(self.elapsed, 3),
+        }
+
+
+class Deadline:
+    """
+    A latency target for one run, turned into per-stage budgets as it goes.
+
+    Before each stage, plan() splits the time left between that stage and the
+    ones after it in proportion to their forecast duration (overhead plus
+    expected tokens at the backend's observed tokens/second), and converts the
+    stage's share into a max_tokens cap. Since the split always starts from
+    the time actually left, a stage that runs long tightens everything after it
+    and a fast one loosens it.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = float(seconds)
+        self.started = time.monotonic()
+        self.budgets = []
+        self.finished = None
+
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    def remaining(self):
+        return self.seconds - self.elapsed()
+
+    def plan(self, forecasts, floor=0):
+        """
+        StageBudget for the first of `forecasts`, a list of
+        (stage, expected tokens, overhead seconds, tokens per second) for the
+        stage about to run and every stage after it. `floor` is the least
+        max_tokens the stage can work with (e.g. a rewrite of its whole input).
+        """
+        stage, expected, overhead, rate = forecasts[0]
+        durations = [lead + tokens / speed for _, tokens, lead, speed in forecasts]
+        available = max(0.0, self.remaining()) * (1 - SAFETY_MARGIN)
+        share = available * durations[0] / sum(durations)
+        max_tokens = int((share - overhead) * rate)
+        max_tokens = max(MIN_STAGE_TOKENS, floor, min(MAX_STAGE_TOKENS, max_tokens))
+        budget = StageBudget(stage, max_tokens, share, expected)
+        self.budgets.append(budget)
+        return budget
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    @property
+    def met(self):
+        return self.elapsed() <= self.seconds
+
+    def summary(self):
+        return {
+            "deadline": self.seconds,
+            "elapsed": round(self.elapsed(), 3),
+            "met": self.met,
+            "stages": [budget.summary() for budget in self.budgets],
+        }
+
+
+def current_budget():
+    return _current_budget.get()
+
+
+@contextmanager
+def budget_context(budget):
+    """Apply `budget` to the LLM calls made inside the block."""
+    token = _current_budget.set(budget)
+    budget.started = time.monotonic()
+    try:
+        yield budget
+    finally:
+        budget.elapsed = time.monotonic() - budget.started
+        _current_budget.reset(token)
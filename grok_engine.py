@@ -1,65 +1,38 @@
 import os
-import json
-import base64
 import time
 import re
-from groq import Groq
+import sqlite3
+import groq
+import openai
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
+from client_pool import get_client
+from key_pool import default_key_pool
+from result_cache import sha256_bytes, fingerprint
+from pipeline import Stage, StagePipeline
+from image_prep import ImagePreprocessor
+from rate_limiter import estimate_tokens, error_headers
+from streaming import ThinkTagFilter, chunk_text, chunk_usage_info, collect_stream
+from telemetry import CallMetrics, run_trace, current_stage, current_trace, annotate_run
+from providers import Provider, Backend, Router, xai_provider, xai_models, parse_chain
+from hedging import default_hedge_policy, hedged
+from perceptual_index import default_index, image_hashes
+from history import default_history
+from model_catalog import default_catalog, catalog_client
+from panels import default_panel_detector, layout_summary
+from deadline import Deadline, budget_context, current_budget, expected_tokens, observe_tokens, text_tokens
+from ip_guard import default_detector, guarded_scrub, FRAGMENT_INSTRUCTIONS
+from handoff import (STRUCTURED_NOTE, JSON_OBJECT, structured_handoff_enabled, parse_handoff, dump_handoff,
+                     merge_panel_handoffs, guarded_scrub_handoff)
 
-class GrokAgenticEngine:
-    def __init__(self, api_key=None):
-        self.api_key = api_key or os.getenv("GROQ_API_KEY")
-        if not self.api_key:
-            raise ValueError("Groq API Key not found. Please provide it in settings.")
-        
-        self.client = Groq(
-            api_key=self.api_key
-        )
-        self.primary_model = "llama-3.3-70b-versatile"
-        self.fallback_model = "qwen/qwen3-32b" # Upgraded from 8B for better accuracy
-        self.vision_model = "meta-llama/llama-4-scout-17b-16e-instruct"
+# Tries a call gets on one rate-limited or flaky backend before the router moves on for good
+MAX_ATTEMPTS = 3
+# First backoff after a 5xx, timeout or dropped connection; doubles with each try
+TRANSIENT_BACKOFF = 0.5
+# Under a deadline agent_3 still gets room to rewrite all of agent_2's text
+SCRUB_HEADROOM = 1.15
 
-    def _safe_call(self, model, messages, temperature=0.2, response_format=None):
-        """Standard API call with retry and fallback for rate limits."""
-        max_retries = 3
-        retry_delay = 2 
-        
-        for attempt in range(max_retries):
-            try:
-                params = {
-                    "model": model,
-                    "messages": messages,
-                    "temperature": temperature
-                }
-                if response_format:
-                    params["response_format"] = response_format
-                
-                response = self.client.chat.completions.create(**params)
-                content = response.choices[0].message.content
-                
-                # Clean up <think> tags if present
-                if "<think>" in content:
-                    content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
-                
-                return content.strip()
-            except Exception as e:
-                error_str = str(e)
-                if "rate_limit_exceeded" in error_str or "429" in error_str:
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
-                        retry_delay *= 2
-                        continue
-                    elif model == self.primary_model:
-                        # Fallback to Qwen 32B if primary exhausted
-                        return self._safe_call(self.fallback_model, messages, temperature, response_format)
-                raise e
-
-    def encode_image(self, image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-
-    def agent_1_vision(self, base64_image):
-        """Analyze image and generate detailed prompt."""
-        system_prompt = """
+AGENT_1_SYSTEM_PROMPT = """
 You are Agent 1 of a Three-Agent Autonomous Prompt Engineering System.
 
 Your Task:
@@ -100,23 +73,8 @@ Write in natural, professional descriptive language.
 Do not use bullet points.
 Return one cohesive, generator-ready paragraph.
 """
-        return self._safe_call(
-            model=self.vision_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
-                    ],
-                }
-            ],
-            temperature=0.2
-        )
 
-    def agent_2_enhance_accuracy(self, prompt):
-        """Enhance prompt with hyper-accurate minute details, handling collages and grids."""
-        system_prompt = """
+AGENT_2_SYSTEM_PROMPT = """
 You are Agent 2: The Hyper-Fidelity Physics Engine & Grid Architect.
 
 Your task:
@@ -140,18 +98,8 @@ Rule:
 - NO HALLUCINATIONS: Stay grounded in the visual data, but "zoom in" on it for maximum accuracy.
 - Output ONE single, massive, hyper-dense, cinematic paragraph.
 """
-        return self._safe_call(
-            model=self.primary_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"INPUT DATA FROM AGENT 1:\n{prompt}\n\nTASK: PERFORM TOTAL PHYSICAL RECONSTRUCTION WITH 1000% DETAIL DENSITY."}
-            ],
-            temperature=0.1
-        )
 
-    def agent_3_scrub_copyright(self, detailed_prompt):
-        """Translate specific IPs into forensic visual descriptions without losing accuracy."""
-        system_prompt = """
+AGENT_3_SYSTEM_PROMPT = """
 You are Agent 3: The Forensic Visual Translator & IP Sanitizer.
 
 Your mission:
@@ -179,30 +127,837 @@ Before outputting, perform a "Legal Audit":
 - IF FOUND: DELETE THEM IMMEDIATELY and replace with physical description.
 - Your final output must be 100% STERILE of IP references.
 """
+
+AGENT_2_USER_TEMPLATE = "INPUT DATA FROM AGENT 1:\n{prompt}\n\nTASK: PERFORM TOTAL PHYSICAL RECONSTRUCTION WITH 1000% DETAIL DENSITY."
+
+AGENT_3_USER_TEMPLATE = "TRANSLATE ALL IP REFERENCES INTO FORENSIC VISUAL DESCRIPTIONS. PERFORM FINAL LEGAL AUDIT:\n\n{prompt}"
+
+# Prepended to agent_1's request for each panel of a collage
+PANEL_NOTE = """This image is {position} of a {count}-panel collage; the other panels are analyzed separately.
+Describe ONLY this panel, and name the art style even if it matches the rest of the collage."""
+
+COLLAGE_HEADER = "COLLAGE LAYOUT: {layout}. Each panel was analyzed on its own; keep this panel structure.\n\n"
+
+# Appended to every final prompt as requested by USER
+IDENTITY_MANDATE = "\n\ngenerate the input image using this prompt without changing the facial features and hair features of the input image."
+
+class GrokAgenticEngine:
+    def __init__(self, api_key=None, cache=None, preprocessor=None, stream=False, ip_detector=None,
+                 near_dup_index=None, xai_api_key=None, hedge=None, fallback_chains=None, panel_detector=None,
+                 api_keys=None, structured=None, history=None, catalog=None):
+        self.api_key = api_key or os.getenv("GROQ_API_KEY")
+        if not self.api_key:
+            raise ValueError("Groq API Key not found. Please provide it in settings.")
+        
+        self.client = self._create_client()
+        # Every Groq key we may use (api_key, api_keys, then GROQ_API_KEYS); calls are
+        # spread across them by remaining quota, see key_pool.KeyPool
+        self.key_pool = default_key_pool(self.api_key, api_keys or ())
+        self.primary_model = "llama-3.3-70b-versatile"
+        self.fallback_model = "qwen/qwen3-32b" # Upgraded from 8B for better accuracy
+        self.vision_model = "meta-llama/llama-4-scout-17b-16e-instruct"
+        # Agents hand over a compact JSON object (see handoff.py) instead of prose: agent_3
+        # only gets the fields that mention IP and the final prompt is put together locally
+        self.structured = structured_handoff_enabled() if structured is None else bool(structured)
+        # Provider model lists with each model's capabilities (see model_catalog.ModelCatalog),
+        # refreshed at most once per TTL; pass catalog=False to use the models above unchecked
+        self.catalog = default_catalog() if catalog is None else (catalog or None)
+        self._resolve_models()
+        # Sends each call to the fastest healthy Groq/xAI backend for its stage;
+        # fallback_chains overrides a stage's chain, see _build_router
+        self.router = self._build_router(xai_api_key, fallback_chains)
+        self.vision_temperature = 0.2
+        self.enhance_temperature = 0.1
+        self.scrub_temperature = 0.2
+
+        # Optional ResultCache (see result_cache.default_cache) for whole-run and per-stage results
+        self.cache = cache
+        self.preprocessor = preprocessor or ImagePreprocessor()
+        # Stream completions and report partial text through status_callback
+        self.stream = stream
+        # Local lexicon check that lets agent_3 skip clean text and scrub only flagged
+        # sentences; pass ip_detector=False to always send the full text to the LLM
+        self.ip_detector = default_detector() if ip_detector is None else ip_detector
+        # Perceptual-hash index that lets re-saved/resized copies of a processed image
+        # reuse its cached result; needs a cache, pass near_dup_index=False to turn it off
+        if near_dup_index is None and cache is not None:
+            near_dup_index = default_index()
+        self.near_dup_index = near_dup_index or None
+        # Opt-in HedgePolicy (see hedging.default_hedge_policy) that duplicates straggling
+        # plain-text calls; pass hedge=False to keep it off whatever the environment says
+        self.hedge = default_hedge_policy() if hedge is None else (hedge or None)
+        # Splits collages into panels that agent_1 describes concurrently at a lower
+        # resolution; pass panel_detector=False to always send the whole image
+        self.panel_detector = default_panel_detector() if panel_detector is None else (panel_detector or None)
+        # Searchable log of every fresh run (see history.HistoryStore); like the near-duplicate
+        # index it comes with a cache, pass history=False to keep runs out of it
+        if history is None and cache is not None:
+            history = default_history()
+        self.history = history or None
+
+    def _resolve_models(self):
+        """
+        Swap a retired stage model, or one that can't take the stage's input,
+        for a listed one now rather than after earlier stages spent tokens.
+        Only the catalog's stored list is read unless it is older than its TTL.
+        """
+        if not self.catalog:
+            return
+        client = catalog_client("groq", self.api_key)
+        self.vision_model = self.catalog.resolve("groq", self.vision_model, client, vision=True, json_mode=self.structured)
+        self.primary_model = self.catalog.resolve("groq", self.primary_model, client, json_mode=self.structured,
+                                                  fallbacks=[self.fallback_model])
+        # A fallback equal to the primary would be no fallback at all
+        self.fallback_model = self.catalog.resolve("groq", self.fallback_model, client, json_mode=self.structured,
+                                                   exclude=[self.primary_model])
+
+    def _safe_call(self, model, messages, temperature=0.2, response_format=None, stream=False):
+        """
+        Standard API call on the best backend for `model`'s route (see _build_router),
+        with retries and failover for rate limits and provider outages.
+
+        With stream=True, returns a generator of visible text chunks instead.
+        Inside a deadline run, the stage budget caps the output (see run_engine).
+        """
+        budget = current_budget()
+        if budget is not None:
+            messages = budget.annotate(messages)
+        if stream:
+            return self._stream_call(model, messages, temperature, response_format)
+        if self.hedge:
+            return self._hedged_call(model, messages, temperature, response_format)
+        return self._routed_call(model, messages, temperature, response_format)
+
+    def _hedged_call(self, model, messages, temperature, response_format):
+        """
+        Plain-text call, duplicated once it runs past the hedge policy's latency
+        percentile; the duplicate prefers another backend (e.g. the fallback model).
+
+        Both sides are streamed under the hood so the loser's response can be
+        closed once the other wins. JSON calls aren't streamed (see run_engine),
+        so they are never hedged here.
+        """
+        if response_format is not None:
+            return self._routed_call(model, messages, temperature, response_format)
+        estimate = estimate_tokens(messages)
+        backend, spare, delay = self._hedge_plan(model, estimate)
+        if delay is None:
+            return self._routed_call(model, messages, temperature, response_format, first=backend)
+        return hedged(
+            lambda leg: "".join(self._stream_call(model, messages, temperature, first=backend, leg=leg)).strip(),
+            lambda leg: "".join(self._stream_call(model, messages, temperature, first=spare, hedge=True,
+                                                  leg=leg)).strip(),
+            delay,
+            lambda: self.hedge.admit(spare, estimate),
+            self.hedge,
+        )
+
+    def _hedge_plan(self, model, estimate):
+        """(backend, spare backend for the duplicate, hedge delay or None to not hedge)."""
+        route = self._route(model)
+        backend = self._pick(route, estimate)
+        delay = self.hedge.delay(backend.health)
+        spare = self._pick(route, estimate, exclude=[backend]) or backend
+        return backend, spare, delay
+
+    def _routed_call(self, model, messages, temperature, response_format, first=None, hedge=False):
+        estimate = estimate_tokens(messages)
+        metrics = CallMetrics(model, hedge=hedge)
+        failures = {}
+        route = self._route(model)
+        backend = first or self._pick(route, estimate)
+        max_tokens = self._max_tokens()
+
+        while True:
+            client, limiter = backend.lease(estimate)
+            metrics.routed(backend.provider.name, backend.model)
+            health = backend.health
+            probe = health.begin()
+            try:
+                # Waits here (shared with every other caller of this model) instead of after a 429
+                metrics.waited(limiter.acquire(estimate))
+                params = self._request_params(backend.model, messages, temperature, response_format, max_tokens)
+                started = time.monotonic()
+                raw = client.chat.completions.with_raw_response.create(**params)
+                limiter.update_from_headers(raw.headers)
+                response = raw.parse()
+                backend.health.success(time.monotonic() - started, self._completion_tokens(response.usage))
+                limiter.record_usage(estimate, self._total_tokens(response))
+                metrics.usage(response.usage)
+                metrics.finish()
+                return self._clean_content(response.choices[0].message.content)
+            except Exception as e:
+                backend = self._fail_over(route, backend, e, estimate, failures, limiter)
+                if backend is None:
+                    metrics.finish(error=e)
+                    raise e
+                metrics.retry()
+                # Clients don't retry on their own (max_retries=0), so back off here while it cools down
+                time.sleep(backend.health.cooling_for())
+            finally:
+                if probe:
+                    # Cancelled, abandoned or a bad request: no verdict, so the next call probes
+                    health.release()
+
+    def _stream_call(self, model, messages, temperature=0.2, response_format=None, first=None, hedge=False, leg=None):
+        """
+        Streaming _safe_call: yields text chunks with <think> blocks stripped on the fly.
+
+        `leg` is the hedging.HedgeLeg when this is one side of a hedged call;
+        cancelling it closes the open stream and ends the call without a retry.
+        """
+        estimate = estimate_tokens(messages)
+        metrics = CallMetrics(model, stream=True, hedge=hedge)
+        failures = {}
+        route = self._route(model)
+        backend = first or self._pick(route, estimate)
+        max_tokens = self._max_tokens()
+
+        while True:
+            emitted = False
+            client, limiter = backend.lease(estimate)
+            metrics.routed(backend.provider.name, backend.model)
+            health = backend.health
+            probe = health.begin()
+            try:
+                metrics.waited(limiter.acquire(estimate))
+                params = self._request_params(backend.model, messages, temperature, response_format, max_tokens)
+                params["stream"] = True
+                params.update(backend.provider.stream_params)
+                started = time.monotonic()
+                raw = client.chat.completions.with_raw_response.create(**params)
+                limiter.update_from_headers(raw.headers)
+                think_filter = ThinkTagFilter()
+                usage = None
+                first_chunk = None
+                chunks = raw.parse()
+                if leg is not None:
+                    leg.on_cancel(chunks.close)
+                for chunk in chunks:
+                    if leg is not None and leg.cancelled:
+                        raise CancelledError()
+                    usage = chunk_usage_info(chunk) or usage
+                    text = chunk_text(chunk)
+                    if text and first_chunk is None:
+                        # <think> text counts: it is output the model has to generate
+                        first_chunk = time.monotonic() - started
+                    visible = think_filter.feed(text)
+                    if visible:
+                        if not emitted:
+                            metrics.first_token()
+                        emitted = True
+                        yield visible
+                if leg is not None and leg.cancelled:
+                    raise CancelledError()
+                tail = think_filter.flush()
+                if tail:
+                    yield tail
+                backend.health.success(time.monotonic() - started, self._completion_tokens(usage), first_chunk)
+                limiter.record_usage(estimate, getattr(usage, "total_tokens", None))
+                metrics.usage(usage)
+                metrics.finish()
+                return
+            except Exception as e:
+                if leg is not None and leg.cancelled:
+                    # The other side of the hedge won; closing the stream is what broke this one
+                    metrics.finish(error=CancelledError())
+                    raise CancelledError() from e
+                # Once text has reached the caller a retry would duplicate it
+                backend = None if emitted else self._fail_over(route, backend, e, estimate, failures, limiter)
+                if backend is None:
+                    metrics.finish(error=e)
+                    raise e
+                metrics.retry()
+                # Clients don't retry on their own (max_retries=0), so back off here while it cools down
+                time.sleep(backend.health.cooling_for())
+            finally:
+                if probe:
+                    # Cancelled, abandoned or a bad request: no verdict, so the next call probes
+                    health.release()
+
+    def _build_router(self, xai_api_key=None, fallback_chains=None):
+        """
+        Routes keyed by the model a call asks for, plus one per pipeline stage.
+
+        On Groq alone this is the old behaviour: the primary model, then the
+        fallback once the primary's circuit breaker opens. With an XAI_API_KEY,
+        xAI competes with Groq for the vision and primary text routes and takes
+        over while Groq is throttled or failing.
+
+        A stage's chain comes from fallback_chains[stage] or FALLBACK_CHAIN_<STAGE>
+        (see providers.parse_chain), e.g.
+        FALLBACK_CHAIN_AGENT_3="qwen/qwen3-32b,llama-3.3-70b-versatile|xai:grok-3";
+        without one the stage uses its model's route.
+        """
+        groq_provider = Provider("groq", self._key_client, keys=self.key_pool)
+        xai = self._xai_provider(xai_api_key)
+        xai_text, xai_vision = xai_models() if xai else (None, None)
+        if xai and self.catalog:
+            # xAI is an extra backend, so a model it no longer lists is just left out
+            client = catalog_client("xai", xai_api_key)
+            if xai_text:
+                xai_text = self.catalog.resolve("xai", xai_text, client, json_mode=self.structured, required=False)
+            if xai_vision:
+                xai_vision = self.catalog.resolve("xai", xai_vision, client, vision=True, json_mode=self.structured,
+                                                  required=False)
+
+        def tier(model, xai_model):
+            backends = [Backend(groq_provider, model)]
+            if xai_model:
+                backends.append(Backend(xai, xai_model))
+            return backends
+
+        router = Router(groq_provider)
+        router.add_route(self.vision_model, tier(self.vision_model, xai_vision))
+        router.add_route(self.primary_model, tier(self.primary_model, xai_text),
+                         [Backend(groq_provider, self.fallback_model)])
+
+        providers = {"groq": groq_provider, "xai": xai} if xai else {"groq": groq_provider}
+        chains = fallback_chains or {}
+        stage_models = {"agent_1": self.vision_model, "agent_2": self.primary_model, "agent_3": self.primary_model}
+        for stage, model in stage_models.items():
+            spec = chains.get(stage) or os.getenv(f"FALLBACK_CHAIN_{stage.upper()}")
+            tiers = parse_chain(spec, providers) if spec else None
+            if spec and not tiers:
+                print(f"ROUTER: no usable backend in the {stage} fallback chain {spec!r}, using defaults")
+            router.add_route(stage, *(tiers or router.tiers(model)))
+        return router
+
+    def _route(self, model):
+        # Inside a pipeline stage its (possibly configured) chain wins over the model's route
+        stage = current_stage()
+        return stage if stage in self.router.routes else model
+
+    def _xai_provider(self, api_key):
+        return xai_provider(api_key)
+
+    def _fail_over(self, route, backend, error, estimate, failures, limiter):
+        """
+        Book a failed attempt on `backend` (sent through `limiter`) and pick where
+        to retry, or None to give up.
+
+        A 429 benches the backend for its retry-after and allows MAX_ATTEMPTS tries
+        on it; 5xx, timeouts and dropped connections allow MAX_ATTEMPTS tries with
+        a doubling backoff, and auth/model errors drop it for this call. All of
+        them count towards the backend's circuit breaker, so once it opens later
+        calls skip it outright. Other errors (bad requests) would fail anywhere, so they
+        are raised. With a key pool, a 429 or rejected key only benches that key
+        while another key of the backend can still send.
+        """
+        keys = backend.provider.keys
+        spare_key = lambda: len(keys) > 1 and keys.expected_wait(backend.model, estimate) <= self.router.patience
+        if self._is_rate_limited(error):
+            # Honors retry-after; the next acquire() on that key and model does the waiting
+            delay = limiter.penalize(error_headers(error), 2 ** (int(failures.get(backend, 0)) + 1))
+            if keys is not None and spare_key():
+                # Another key takes over; a 429 per key adds up to one backend failure
+                failures[backend] = failures.get(backend, 0) + 1 / len(keys)
+            else:
+                failures[backend] = failures.get(backend, 0) + 1
+                backend.health.failure(cooldown=delay)
+        elif keys is not None and len(keys) > 1 and getattr(error, "status_code", None) in (401, 403):
+            keys.bench(limiter)
+            if not spare_key():
+                failures[backend] = MAX_ATTEMPTS
+                backend.health.failure()
+        elif self._is_provider_error(error) and getattr(error, "status_code", None) in (401, 403, 404):
+            failures[backend] = MAX_ATTEMPTS
+            backend.health.failure()
+        elif self._is_provider_error(error):
+            tries = int(failures.get(backend, 0))
+            failures[backend] = failures.get(backend, 0) + 1
+            backend.health.failure(cooldown=TRANSIENT_BACKOFF * 2 ** tries)
+        else:
+            return None
+        exhausted = [spent for spent, count in failures.items() if count >= MAX_ATTEMPTS]
+        return self._pick(route, estimate, exclude=exhausted)
+
+    def _pick(self, route, estimate, exclude=()):
+        """router.pick, held to the current stage budget when running against a deadline."""
+        budget = current_budget()
+        if budget is None:
+            return self.router.pick(route, estimate, exclude=exclude)
+        return self.router.pick(route, estimate, exclude=exclude,
+                                output_tokens=min(budget.max_tokens, budget.expected), time_limit=budget.time_left())
+
+    @staticmethod
+    def _max_tokens():
+        budget = current_budget()
+        return None if budget is None else budget.max_tokens
+
+    def _complete(self, model, messages, temperature, on_partial=None):
+        """_safe_call, streamed into on_partial when streaming is enabled."""
+        if not (self.stream and on_partial):
+            return self._safe_call(model=model, messages=messages, temperature=temperature)
+        return collect_stream(self._safe_call(model, messages, temperature, stream=True), on_partial)
+
+    def _create_client(self):
+        # Shared keep-alive pool per key instead of a fresh TLS handshake per engine
+        return get_client(self.api_key)
+
+    def _key_client(self, api_key=None):
+        """Client for a pooled Groq key; the engine's own key uses self.client."""
+        if api_key is None or api_key == self.api_key:
+            return self.client
+        return get_client(api_key)
+
+    @staticmethod
+    def _request_params(model, messages, temperature, response_format=None, max_tokens=None):
+        params = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature
+        }
+        if response_format:
+            params["response_format"] = response_format
+        if max_tokens:
+            params["max_tokens"] = max_tokens
+        return params
+
+    @staticmethod
+    def _clean_content(content):
+        # Clean up <think> tags if present
+        if "<think>" in content:
+            content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
+        return content.strip()
+
+    @staticmethod
+    def _total_tokens(response):
+        usage = getattr(response, "usage", None)
+        return getattr(usage, "total_tokens", None)
+
+    @staticmethod
+    def _completion_tokens(usage):
+        return getattr(usage, "completion_tokens", None)
+
+    @staticmethod
+    def _is_rate_limited(error):
+        error_str = str(error)
+        return "rate_limit_exceeded" in error_str or "429" in error_str
+
+    @staticmethod
+    def _is_provider_error(error):
+        """Failures another backend may not have: 5xx, timeouts, connection, auth or unknown model."""
+        if isinstance(error, (groq.APIConnectionError, openai.APIConnectionError)):
+            return True
+        status = getattr(error, "status_code", None)
+        return status is not None and (status >= 500 or status in (401, 403, 404))
+
+    def encode_image(self, image):
+        return self.preprocessor.prepare(self.preprocessor.load(image)).base64()
+
+    def image_digest(self, image_bytes):
+        """Identity of what agent_1 will see: source bytes plus preprocessing settings."""
+        return fingerprint(sha256_bytes(image_bytes), self.preprocessor.fingerprint())
+
+    def build_pipeline(self, deadline=None):
+        """
+        The agent DAG: image -> agent_1 -> agent_2 -> agent_3. With a Deadline,
+        every stage runs under its budget and nothing is written to the cache.
+        """
+        stages = [
+            Stage(
+                "agent_1", self._vision_stage, inputs=("image",),
+                model=self.vision_model, temperature=self.vision_temperature,
+                prompt=AGENT_1_SYSTEM_PROMPT + self._panel_version() + self._handoff_version(),
+                label="Agent 1: Vision Analysis...", stream=self.stream and not self.structured,
+            ),
+            Stage(
+                "agent_2", self.agent_2_enhance_accuracy, inputs=("agent_1",),
+                model=self.primary_model, temperature=self.enhance_temperature,
+                prompt=AGENT_2_SYSTEM_PROMPT + AGENT_2_USER_TEMPLATE + self._handoff_version(),
+                label="Agent 2: Detailing & Accuracy Architect...", stream=self.stream and not self.structured,
+            ),
+            Stage(
+                "agent_3", self.agent_3_scrub_copyright, inputs=("agent_2",),
+                model=self.primary_model, temperature=self.scrub_temperature,
+                prompt=AGENT_3_SYSTEM_PROMPT + AGENT_3_USER_TEMPLATE + self._ip_guard_version() + self._handoff_version(),
+                label="Agent 3: Zero-Tolerance Copyright Scrubber...",
+                stream=self.stream,
+            ),
+        ]
+        if deadline is None:
+            return StagePipeline(stages, cache=self.cache)
+        for index, stage in enumerate(stages):
+            stage.run = self._budgeted(deadline, stages[index:], stage.run)
+        # Budgeted outputs are shorter than the real thing; reuse cached ones but don't add to them
+        return StagePipeline(stages, cache=self.cache, read_only=True)
+
+    def _budgeted(self, deadline, stages, run):
+        """Stage run function that first plans its budget from the time left."""
+        def budgeted(*inputs, **kwargs):
+            with budget_context(self._plan_budget(deadline, stages, inputs)):
+                return run(*inputs, **kwargs)
+        return budgeted
+
+    def _plan_budget(self, deadline, stages, inputs):
+        """StageBudget for stages[0], sharing the time left with the stages after it."""
+        forecasts = []
+        for stage in stages:
+            tokens = expected_tokens(stage.name)
+            route = stage.name if stage.name in self.router.routes else stage.model
+            overhead, rate = self.router.pick(route, output_tokens=tokens).health.forecast()
+            forecasts.append((stage.name, tokens, overhead, rate))
+        floor = 0
+        if stages[0].name == "agent_3":
+            # Cutting the scrub short would drop the end of the prompt, not just detail
+            written = self._stage_completion_tokens(stages[0].inputs[0]) or text_tokens(inputs[0])
+            floor = int(written * SCRUB_HEADROOM)
+        return deadline.plan(forecasts, floor)
+
+    @staticmethod
+    def _stage_completion_tokens(stage):
+        """Tokens `stage` generated in this run per the trace; None when it was cached or untraced."""
+        trace = current_trace()
+        if trace is None:
+            return None
+        tokens = [call["completion_tokens"] for call in list(trace.calls)
+                  if call["stage"] == stage and call["status"] == "ok" and call["completion_tokens"]]
+        return sum(tokens) if tokens else None
+
+    def _panel_version(self):
+        if not self.panel_detector:
+            return ""
+        return PANEL_NOTE + COLLAGE_HEADER + self.panel_detector.fingerprint()
+
+    def _handoff_version(self):
+        if not self.structured:
+            return ""
+        return STRUCTURED_NOTE
+
+    def _ip_guard_version(self):
+        if not self.ip_detector:
+            return ""
+        return FRAGMENT_INSTRUCTIONS + self.ip_detector.fingerprint()
+
+    def cache_key(self, image_bytes):
+        """Content address for a run: image digest plus the version of every stage."""
+        return fingerprint(
+            "run_engine",
+            self.image_digest(image_bytes),
+            self.build_pipeline().fingerprint(sources=("image",)),
+            self.fallback_model,
+            IDENTITY_MANDATE,
+        )
+
+    def run_namespace(self):
+        """Everything except the image that shapes a run's result; near-duplicates only match within it."""
+        return fingerprint(
+            "run_engine",
+            self.preprocessor.fingerprint(),
+            self.build_pipeline().fingerprint(sources=("image",)),
+            self.fallback_model,
+            IDENTITY_MANDATE,
+        )
+
+    def _vision_stage(self, image_bytes, on_partial=None):
+        # Preprocess lazily so a cached agent_1 output skips the decode/resize too
+        layout, parts = self._prepare_vision(image_bytes)
+        if layout is not None:
+            return self._vision_panels(layout, parts, on_partial)
+        prepared = parts[0][1]
+        return self.agent_1_vision(prepared.base64(), prepared.mime_type, on_partial=on_partial)
+
+    def _prepare_vision(self, image_bytes):
+        """
+        (None, [(None, prepared image)]) for an ordinary image; for a collage its
+        layout summary and a (position, prepared panel) pair per panel.
+        """
+        image = self.preprocessor.decode(image_bytes)
+        panels = self.panel_detector.detect(image) if self.panel_detector else []
+        if not panels:
+            prepared = self.preprocessor.encode(image, len(image_bytes))
+            annotate_run(image_stats=prepared.stats())
+            return None, [(None, prepared)]
+
+        rows = panels[-1].row + 1
+        crops = self.panel_detector.prepare(image, panels, self.preprocessor)
+        parts = [(panel.position(rows, image.size), prepared) for panel, prepared in zip(panels, crops)]
+        bytes_after = sum(prepared.bytes_after for prepared in crops)
+        annotate_run(image_stats={
+            "bytes_before": len(image_bytes),
+            "bytes_after": bytes_after,
+            "ratio": bytes_after / len(image_bytes) if image_bytes else 1.0,
+            "width": image.size[0],
+            "height": image.size[1],
+            "mime_type": crops[0].mime_type,
+            "panels": len(panels),
+        })
+        return layout_summary(panels), parts
+
+    def _vision_panels(self, layout, parts, on_partial=None):
+        """Describe every panel concurrently; on_partial sees the merge grow as panels finish."""
+        descriptions = [None] * len(parts)
+        # Copy the caller's context so each panel call is traced under agent_1
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            futures = {
+                executor.submit(contextvars.copy_context().run, self.agent_1_panel,
+                                prepared.base64(), prepared.mime_type, position, len(parts)): index
+                for index, (position, prepared) in enumerate(parts)
+            }
+            for future in as_completed(futures):
+                descriptions[futures[future]] = future.result()
+                if on_partial:
+                    on_partial(self._merge_panels(layout, parts, descriptions))
+        return self._merge_panels(layout, parts, descriptions)
+
+    def _merge_panels(self, layout, parts, descriptions):
+        if self.structured:
+            handoffs = [None if text is None else parse_handoff(text) for text in descriptions]
+            return dump_handoff(merge_panel_handoffs(layout, [position for position, _ in parts], handoffs))
+        sections = [
+            f"[Panel {number}: {position}]\n{description}"
+            for number, ((position, _), description) in enumerate(zip(parts, descriptions), 1)
+            if description is not None
+        ]
+        return COLLAGE_HEADER.format(layout=layout) + "\n\n".join(sections)
+
+    @staticmethod
+    def _vision_messages(base64_image, mime_type="image/jpeg", structured=False):
+        return [
+            {"role": "system", "content": AGENT_1_SYSTEM_PROMPT + (STRUCTURED_NOTE if structured else "")},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}},
+                ],
+            }
+        ]
+
+    @staticmethod
+    def _panel_messages(base64_image, mime_type, position, count, structured=False):
+        messages = GrokAgenticEngine._vision_messages(base64_image, mime_type, structured)
+        messages[1]["content"].insert(0, {"type": "text", "text": PANEL_NOTE.format(position=position, count=count)})
+        return messages
+
+    @staticmethod
+    def _enhance_messages(prompt, structured=False):
+        return [
+            {"role": "system", "content": AGENT_2_SYSTEM_PROMPT + (STRUCTURED_NOTE if structured else "")},
+            {"role": "user", "content": AGENT_2_USER_TEMPLATE.format(prompt=prompt)}
+        ]
+
+    @staticmethod
+    def _scrub_messages(detailed_prompt):
+        return [
+            {"role": "system", "content": AGENT_3_SYSTEM_PROMPT},
+            {"role": "user", "content": AGENT_3_USER_TEMPLATE.format(prompt=detailed_prompt)}
+        ]
+
+    @staticmethod
+    def _scrub_fragment_messages(numbered_sentences):
+        return [
+            {"role": "system", "content": AGENT_3_SYSTEM_PROMPT},
+            {"role": "user", "content": f"{FRAGMENT_INSTRUCTIONS}\n\n{numbered_sentences}"}
+        ]
+
+    def agent_1_vision(self, base64_image, mime_type="image/jpeg", on_partial=None):
+        """Analyze image and generate detailed prompt."""
+        if self.structured:
+            return self._handoff_call(self.vision_model, self._vision_messages(base64_image, mime_type, True),
+                                      self.vision_temperature)
+        return self._complete(
+            model=self.vision_model,
+            messages=self._vision_messages(base64_image, mime_type),
+            temperature=self.vision_temperature,
+            on_partial=on_partial
+        )
+
+    def agent_1_panel(self, base64_image, mime_type, position, count):
+        """Analyze one collage panel; not streamed, since panels finish out of order."""
+        if self.structured:
+            return self._handoff_call(self.vision_model, self._panel_messages(base64_image, mime_type, position, count, True),
+                                      self.vision_temperature)
         return self._safe_call(
+            model=self.vision_model,
+            messages=self._panel_messages(base64_image, mime_type, position, count),
+            temperature=self.vision_temperature
+        )
+
+    def agent_2_enhance_accuracy(self, prompt, on_partial=None):
+        """Enhance prompt with hyper-accurate minute details, handling collages and grids."""
+        if self.structured:
+            return self._handoff_call(self.primary_model, self._enhance_messages(prompt, True), self.enhance_temperature)
+        return self._complete(
             model=self.primary_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"TRANSLATE ALL IP REFERENCES INTO FORENSIC VISUAL DESCRIPTIONS. PERFORM FINAL LEGAL AUDIT:\n\n{detailed_prompt}"}
-            ],
-            temperature=0.2
+            messages=self._enhance_messages(prompt),
+            temperature=self.enhance_temperature,
+            on_partial=on_partial
         )
 
-    def run_engine(self, image_path, status_callback=None):
-        """Run the specialized sequential pipeline."""
-        if status_callback: status_callback("Agent 1: Vision Analysis...", "agent_1")
-        base64_image = self.encode_image(image_path)
-        prompt_v1 = self.agent_1_vision(base64_image)
-        
-        if status_callback: status_callback("Agent 2: Detailing & Accuracy Architect...", "agent_2")
-        prompt_v2 = self.agent_2_enhance_accuracy(prompt_v1)
-        
-        if status_callback: status_callback("Agent 3: Zero-Tolerance Copyright Scrubber...", "agent_3")
-        prompt_v3 = self.agent_3_scrub_copyright(prompt_v2)
+    def agent_3_scrub_copyright(self, detailed_prompt, on_partial=None):
+        """
+        Translate specific IPs into forensic visual descriptions without losing accuracy.
+        Unlike prompt_gen's guardian this pass doesn't redact face/hair (IDENTITY_MANDATE
+        keeps them), so only IP hits flag sentences here.
+        """
+        if self.structured:
+            return self._scrub_handoff(detailed_prompt, on_partial)
+        if not self.ip_detector:
+            return self._scrub_full(detailed_prompt, on_partial)
+        result, report = guarded_scrub(
+            self.ip_detector,
+            detailed_prompt,
+            scrub_full=lambda text: self._scrub_full(text, on_partial),
+            scrub_fragments=self._scrub_fragments,
+        )
+        annotate_run(ip_report=report)
+        if on_partial and report["mode"] != "full":
+            on_partial(result)
+        return result
+
+    def _scrub_full(self, detailed_prompt, on_partial=None):
+        return self._complete(
+            model=self.primary_model,
+            messages=self._scrub_messages(detailed_prompt),
+            temperature=self.scrub_temperature,
+            on_partial=on_partial
+        )
+
+    def _scrub_fragments(self, numbered_sentences):
+        return self._safe_call(
+            model=self.primary_model,
+            messages=self._scrub_fragment_messages(numbered_sentences),
+            temperature=self.scrub_temperature
+        )
+
+    def _handoff_call(self, model, messages, temperature):
+        """Structured-mode agent call: the JSON reply validated and re-encoded compactly for the next stage."""
+        reply = self._safe_call(model=model, messages=messages, temperature=temperature, response_format=JSON_OBJECT)
+        return dump_handoff(parse_handoff(reply))
+
+    def _scrub_handoff(self, handoff_text, on_partial=None):
+        """Structured agent_3: scrub only the sentences naming IP, then render the prompt locally."""
+        result, report = guarded_scrub_handoff(
+            self.ip_detector,
+            parse_handoff(handoff_text),
+            scrub_fragments=self._scrub_fragments,
+            scrub_full=self._scrub_full,
+        )
+        annotate_run(ip_report=report)
+        if on_partial:
+            on_partial(result)
+        return result
+
+    def run_engine(self, image, status_callback=None, with_trace=False, deadline=None, source=None):
+        """
+        Run the specialized sequential pipeline.
+
+        `image` is a path, bytes, a file-like object (e.g. a Streamlit upload)
+        or a PIL image; in-memory inputs never touch the disk. With a cache configured, a repeated image returns the stored result, and
+        a changed stage only re-executes itself and the stages after it.
+        With streaming enabled, status_callback is also called as
+        status_callback(msg, agent_id, partial_text) while a stage generates.
+        With with_trace=True, returns (prompt, trace) where trace is the
+        telemetry.RunTrace summary: per-stage latency, calls, tokens and cost,
+        plus this run's image_stats and ip_report. The engine is shared between
+        runs, so per-run details only come back this way.
+
+        `deadline` (seconds) turns on latency-SLO mode: each stage gets a
+        max_tokens budget and backend from the time left and the observed
+        tokens/second of its models (see deadline.Deadline), so a slow stage
+        tightens the ones after it. The trace's "deadline" entry says whether
+        it was met. Results are not cached in this mode.
+
+        Fresh runs are added to the prompt history, under `source` (defaults to
+        the file name of a path) when given.
+        """
+        deadline = None if deadline is None else Deadline(deadline)
+        outputs = None
+        with run_trace() as trace:
+            image_bytes = self.preprocessor.load(image)
+
+            key, result, hashes = self._lookup_run(image_bytes, status_callback)
+            trace.cached = result is not None
+            if result is None:
+                outputs = self.build_pipeline(deadline).run(self._pipeline_sources(image_bytes), status_callback=status_callback)
+                result = self._finish_run(outputs, key, status_callback, hashes, deadline)
+            self._report_deadline(deadline, trace, status_callback)
+        summary = trace.summary()
+        self._record_history(image_bytes, result, outputs, summary, deadline, source or self._image_name(image))
+        return (result, summary) if with_trace else result
+
+    def _lookup_run(self, image_bytes, status_callback=None):
+        """
+        Return (cache key, cached result, perceptual hashes); all None without a cache.
+        Falls back to the near-duplicate index when the exact bytes are new.
+        """
+        if self.cache is None:
+            return None, None, None
+        key = self.cache_key(image_bytes)
+        cached = self.cache.get(key)
+        if cached is not None:
+            if status_callback:
+                status_callback("Cache hit. Master prompt restored without agent calls.", "done")
+            return key, cached, None
+        if self.near_dup_index is None:
+            return key, None, None
+
+        try:
+            hashes = image_hashes(image_bytes)
+        except ValueError:
+            # Undecodable; let the vision stage report it
+            return key, None, None
+        cached, distance = self.near_dup_index.find(self.run_namespace(), hashes, self.cache)
+        if cached is not None:
+            # Exact repeats of this file hit directly from now on
+            self.cache.put(key, cached)
+            if status_callback:
+                status_callback(f"Near-duplicate of an earlier image ({distance} bits apart). "
+                                "Master prompt restored without agent calls.", "done")
+        return key, cached, hashes
+
+    def _pipeline_sources(self, image_bytes):
+        return {"image": (image_bytes, self.image_digest(image_bytes))}
+
+    def _finish_run(self, outputs, key, status_callback=None, hashes=None, deadline=None):
+        prompt_v3 = outputs["agent_3"]
         
         # Final status check
         if status_callback: status_callback("Zero-tolerance pipeline complete. Master prompt ready.", "done")
         
-        # Append identity preservation mandate as requested by USER
-        identity_mandate = "\n\ngenerate the input image using this prompt without changing the facial features and hair features of the input image."
-        return prompt_v3 + identity_mandate
+        result = prompt_v3 + IDENTITY_MANDATE
+        if deadline is not None:
+            return result
+        # Natural output lengths, which deadline runs plan with
+        for stage in ("agent_1", "agent_2", "agent_3"):
+            observe_tokens(stage, text_tokens(outputs[stage]))
+        if key is not None:
+            self.cache.put(key, result)
+            if hashes is not None and self.near_dup_index is not None:
+                self.near_dup_index.add(self.run_namespace(), hashes, key)
+        return result
+
+    def history_mode(self, deadline=None):
+        """How a run is labelled in the prompt history."""
+        mode = "three-agent structured" if self.structured else "three-agent"
+        if deadline is not None:
+            mode += f" ({deadline.seconds:g}s deadline)"
+        return mode
+
+    def _record_history(self, image_bytes, result, outputs, trace, deadline=None, source=None):
+        """Log a fresh run; cached results were logged when they were made."""
+        if self.history is None or outputs is None:
+            return
+        stages = {name: outputs[name] for name in ("agent_1", "agent_2", "agent_3")}
+        try:
+            self.history.record(image_bytes, result, self.history_mode(deadline), stages, trace, source)
+        except sqlite3.Error as e:
+            print(f"HISTORY ERROR: {e}")
+
+    @staticmethod
+    def _image_name(image):
+        if isinstance(image, (str, os.PathLike)):
+            return os.path.basename(image)
+        name = getattr(image, "name", None)
+        return os.path.basename(name) if isinstance(name, str) else None
+
+    @staticmethod
+    def _report_deadline(deadline, trace, status_callback=None):
+        if deadline is None:
+            return
+        deadline.finish()
+        trace.deadline = deadline.summary()
+        if status_callback:
+            verdict = "met" if deadline.met else "MISSED"
+            status_callback(f"Deadline {verdict}: {deadline.elapsed():.1f}s of {deadline.seconds:.1f}s.", "done")
@@ -0,0 +1,274 @@
+import os
+import json
+from ip_guard import split_sentences, format_fragments, parse_fragments
+
+# Descriptive keys of the structured handoff, in the order the final prompt reads them
+FIELDS = ("subject", "pose", "costume", "materials", "lighting", "environment", "camera", "style")
+# Names of characters, brands and trademarks mentioned in the fields above
+IP_FIELD = "ip_mentions"
+
+JSON_OBJECT = {"type": "json_object"}
+
+STRUCTURED_NOTE = """
+
+OUTPUT FORMAT OVERRIDE: return ONLY a JSON object with string values for "subject", "pose", "costume", "materials", "lighting", "environment", "camera" and "style", holding all the detail the prose would, plus "ip_mentions": a list of every character, brand or trademark named in them ([] if none). Keep any input keys and panel labels."""
+
+# Trailing entries a reply cut off by max_tokens may lose while it is repaired
+MAX_REPAIRS = 8
+
+
+class HandoffError(ValueError):
+    """An agent reply that can't be read as a handoff."""
+
+
+def structured_handoff_enabled():
+    """True when STRUCTURED_HANDOFF is 1/true/on."""
+    return os.getenv("STRUCTURED_HANDOFF", "0").strip().lower() in ("1", "true", "on", "yes")
+
+
+def parse_handoff(text):
+    """
+    Validate an agent's JSON reply into a handoff: every FIELDS key as a string
+    (missing ones empty, lists joined) plus IP_FIELD as a list of names.
+    Raises HandoffError when there is no JSON object or nothing was described.
+    """
+    data = _load_object(text)
+    handoff = {field: _as_text(data.get(field)) for field in FIELDS}
+    if not any(handoff.values()):
+        raise HandoffError(f"Handoff has none of the fields {FIELDS}.")
+    mentions = data.get(IP_FIELD) or []
+    if isinstance(mentions, str):
+        mentions = [mentions]
+    handoff[IP_FIELD] = [name for name in (_as_text(item) for item in mentions) if name]
+    return handoff
+
+
+def dump_handoff(handoff, fields=None):
+    """Compact JSON for the next agent (just `fields` when given); no whitespace to pay for."""
+    if fields is not None:
+        handoff = {field: handoff[field] for field in fields}
+    return json.dumps(handoff, ensure_ascii=False, separators=(",", ":"))
+
+
+def _as_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        return "; ".join(text for text in (_as_text(item) for item in value) if text)
+    if isinstance(value, dict):
+        return "; ".join(f"{key}: {_as_text(item)}" for key, item in value.items())
+    return str(value)
+
+
+def _load_object(text):
+    start = text.find("{")
+    if start == -1:
+        raise HandoffError("Reply has no JSON object.")
+    end = text.rfind("}")
+    if end > start:
+        try:
+            data = json.loads(text[start:end + 1])
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+
+    # Cut off mid-object (max_tokens): close what is open, dropping the last partial entry if needed
+    body = text[start:]
+    for _ in range(MAX_REPAIRS):
+        try:
+            data = json.loads(_close_truncated(body))
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+        cut = body.rfind(",")
+        if cut <= 0:
+            break
+        body = body[:cut]
+    raise HandoffError("Reply is not a valid JSON object.")
+
+
+def _close_truncated(text):
+    """`text` with its open string, arrays and objects closed."""
+    closers = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+    if escaped:
+        text = text[:-1]
+    if in_string:
+        text += '"'
+    return text.rstrip().rstrip(",") + "".join(reversed(closers))
+
+
+def merge_panel_handoffs(layout, positions, handoffs):
+    """One handoff for a collage: each field lists the panels' values under their labels."""
+    merged = {}
+    for field in FIELDS:
+        merged[field] = " ".join(
+            f"[Panel {number}: {position}] {handoff[field]}"
+            for number, (position, handoff) in enumerate(zip(positions, handoffs), 1)
+            if handoff is not None and handoff[field]
+        )
+    merged["subject"] = f"Collage of {layout}. {merged['subject']}".strip()
+    mentions = []
+    for handoff in handoffs:
+        for name in handoff[IP_FIELD] if handoff is not None else ():
+            if name not in mentions:
+                mentions.append(name)
+    merged[IP_FIELD] = mentions
+    return merged
+
+
+def render_prose(handoff):
+    """The final prompt paragraph, put together locally from the fields."""
+    sentences = []
+    for field in FIELDS:
+        text = " ".join(handoff[field].split())
+        if text:
+            sentences.append(text if text[-1] in ".!?\"')]" else text + ".")
+    return " ".join(sentences)
+
+
+class HandoffScrubPlan:
+    """
+    What agent_3 has to see of a handoff: the sentences that contain a name the
+    agents listed in IP_FIELD or, with a detector, a lexicon hit (or a `redact`
+    hit, see ip_guard.ScrubPlan), numbered in the ip_guard fragment format.
+    Everything else never leaves the process.
+    """
+
+    def __init__(self, detector, handoff, redact=None):
+        self.handoff = handoff
+        self.hits = []
+        self.redactions = []
+        self.parts = {}
+        self.fragments = {}
+        self.owners = {}
+        mentions = [name.lower() for name in handoff[IP_FIELD]]
+        for field in FIELDS:
+            text = handoff[field]
+            if not text:
+                continue
+            hits = detector.find(text) if detector else []
+            self.hits.extend(hits)
+            if redact:
+                redactions = redact.find(text)
+                self.redactions.extend(redactions)
+                hits = hits + redactions
+            parts = self.parts[field] = split_sentences(text)
+            offset = 0
+            for index in range(0, len(parts), 2):
+                sentence = parts[index]
+                end = offset + len(sentence)
+                lowered = sentence.lower()
+                if any(hit.start < end and hit.end > offset for hit in hits) or any(name in lowered for name in mentions):
+                    self.fragments[len(self.fragments) + 1] = sentence
+                    self.owners[len(self.fragments)] = (field, index)
+                offset = end + (len(parts[index + 1]) if index + 1 < len(parts) else 0)
+        self.fields = sorted({field for field, _ in self.owners.values()}, key=FIELDS.index)
+        self.mode = "fragments" if self.fragments else "skip"
+
+    def payload(self):
+        return format_fragments(self.fragments)
+
+    def merge(self, reply):
+        """The handoff with the rewritten sentences from `reply` and no IP names left to track."""
+        rewritten = parse_fragments(reply, self.fragments)
+        if rewritten is None:
+            raise HandoffError("Scrub reply doesn't cover every numbered sentence.")
+        parts = {field: list(parts) for field, parts in self.parts.items()}
+        for number, sentence in rewritten.items():
+            field, index = self.owners[number]
+            parts[field][index] = sentence
+        merged = dict(self.handoff)
+        for field in self.fields:
+            merged[field] = "".join(parts[field])
+        merged[IP_FIELD] = []
+        return merged
+
+    def residual(self, detector, text):
+        """IP names or lexicon terms still present in the rendered `text`."""
+        lowered = text.lower()
+        names = {name for name in self.handoff[IP_FIELD] if name.lower() in lowered}
+        if detector:
+            names.update(match.term for match in detector.find(text))
+        return sorted(names)
+
+
+def handoff_report(plan, residual, retried):
+    if residual:
+        print(f"IP GUARD WARNING: residual IP terms after scrub: {residual}")
+    return {
+        "mode": plan.mode,
+        "hits": sorted({match.term for match in plan.hits}),
+        "redactions": sorted({match.term for match in plan.redactions}),
+        "mentions": list(plan.handoff[IP_FIELD]),
+        "fields": list(plan.fields),
+        "fragments": len(plan.fragments),
+        "retried": retried,
+        "residual": residual,
+    }
+
+
+def guarded_scrub_handoff(detector, handoff, scrub_fragments, scrub_full, redact=None):
+    """
+    Scrub a handoff and render the final prompt.
+
+    `scrub_fragments(numbered_lines)` rewrites the ip_guard FRAGMENT_INSTRUCTIONS
+    format; `scrub_full(text)` rewrites prose. Only the flagged sentences go to
+    the LLM; a malformed reply falls back to a full scrub of the rendered
+    prompt, and so does anything that slipped through. `redact` also flags
+    sentences for the scrub, as in ip_guard.guarded_scrub. Returns (prompt, report).
+    """
+    plan = HandoffScrubPlan(detector, handoff, redact)
+    if plan.mode == "skip":
+        result = render_prose(handoff)
+    else:
+        try:
+            result = render_prose(plan.merge(scrub_fragments(plan.payload())))
+        except HandoffError as e:
+            print(f"HANDOFF ERROR: {e} Scrubbing the full prompt.")
+            plan.mode = "full"
+            result = scrub_full(render_prose(handoff))
+
+    retried = False
+    if plan.residual(detector, result):
+        result = scrub_full(result)
+        retried = True
+    return result, handoff_report(plan, plan.residual(detector, result), retried)
+
+
+async def aguarded_scrub_handoff(detector, handoff, scrub_fragments, scrub_full, redact=None):
+    """guarded_scrub_handoff for coroutine scrubbers."""
+    plan = HandoffScrubPlan(detector, handoff, redact)
+    if plan.mode == "skip":
+        result = render_prose(handoff)
+    else:
+        try:
+            result = render_prose(plan.merge(await scrub_fragments(plan.payload())))
+        except HandoffError as e:
+            print(f"HANDOFF ERROR: {e} Scrubbing the full prompt.")
+            plan.mode = "full"
+            result = await scrub_full(render_prose(handoff))
+
+    retried = False
+    if plan.residual(detector, result):
+        result = await scrub_full(result)
+        retried = True
+    return result, handoff_report(plan, plan.residual(detector, result), retried)
@@ -0,0 +1,189 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError, wait
+
+DEFAULT_PERCENTILE = 95.0
+# Never hedge sooner than this, whatever the percentile says
+DEFAULT_MIN_DELAY = 1.0
+# At most this share of calls may send a duplicate
+DEFAULT_MAX_RATE = 0.05
+DEFAULT_BURST = 2.0
+# Latencies a backend needs before its percentile is trusted
+DEFAULT_MIN_SAMPLES = 20
+
+# Sync hedged calls run in here so the caller can wait with a timeout
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+
+class HedgePolicy:
+    """
+    When a slow call gets a duplicate request, and how many it may get.
+
+    A call that has not answered after the `percentile` of its backend's recent
+    latencies (at least min_delay seconds) is hedged. Every call earns max_rate
+    credits (up to burst) and a hedge spends one, so duplicates stay below
+    max_rate of traffic; the duplicate's model must also have rate-limit budget
+    right now, so hedging never queues or eats into a throttled quota.
+    """
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, min_delay=DEFAULT_MIN_DELAY, max_rate=DEFAULT_MAX_RATE,
+                 burst=DEFAULT_BURST, min_samples=DEFAULT_MIN_SAMPLES):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self.burst = burst
+        self.min_samples = min_samples
+        self.credits = 0.0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def delay(self, health):
+        """Seconds to wait before hedging a call on the backend with `health`, or None to not hedge."""
+        with self._lock:
+            self.calls += 1
+            self.credits = min(self.burst, self.credits + self.max_rate)
+        cutoff = health.percentile(self.percentile, self.min_samples)
+        if cutoff is None:
+            return None
+        return max(self.min_delay, cutoff)
+
+    def admit(self, backend, tokens):
+        """Spend a credit on a hedge to `backend`, if there is one and its model isn't throttled."""
+        if backend.expected_wait(tokens, time.monotonic()) > 0:
+            return False
+        with self._lock:
+            if self.credits < 1.0:
+                return False
+            self.credits -= 1.0
+            self.hedges += 1
+            return True
+
+    def won(self, hedge):
+        if hedge:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": round(self.hedges / self.calls, 4) if self.calls else 0.0,
+                "credits": round(self.credits, 3),
+            }
+
+
+def default_hedge_policy():
+    """HedgePolicy from HEDGE_PERCENTILE / HEDGE_MAX_RATE / HEDGE_MIN_DELAY; off unless HEDGE_PERCENTILE is set."""
+    percentile = os.getenv("HEDGE_PERCENTILE")
+    if not percentile:
+        return None
+    return HedgePolicy(
+        percentile=float(percentile),
+        max_rate=float(os.getenv("HEDGE_MAX_RATE", DEFAULT_MAX_RATE)),
+        min_delay=float(os.getenv("HEDGE_MIN_DELAY", DEFAULT_MIN_DELAY)),
+    )
+
+
+class HedgeLeg:
+    """
+    One side of a sync hedged call. A running thread can't be interrupted, so
+    the call registers a close() for its open response with on_cancel(), and
+    checks `cancelled` before retrying.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._closers = []
+        self._lock = threading.Lock()
+
+    def on_cancel(self, close):
+        with self._lock:
+            if not self.cancelled:
+                self._closers.append(close)
+                return
+        close()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            closers, self._closers = self._closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                pass
+
+
+def hedged(first, second, delay, admit, policy):
+    """
+    Run first(leg); if it hasn't returned within `delay` seconds and admit()
+    agrees, race it against second(leg) and return whichever succeeds first.
+
+    Once a winner is in, the other leg is cancelled (see HedgeLeg), which
+    closes its response. Raises only when both calls fail.
+    """
+    legs = {}
+    primary = _submit(first, legs)
+    try:
+        try:
+            return primary.result(timeout=delay)
+        except TimeoutError:
+            pass
+        if not admit():
+            return primary.result()
+        backup = _submit(second, legs)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    policy.won(future is backup)
+                    return future.result()
+                error = future.exception()
+        raise error
+    finally:
+        for future, leg in legs.items():
+            if not future.done():
+                leg.cancel()
+
+
+async def ahedged(first, second, delay, admit, policy):
+    """hedged() for coroutine factories; here the loser is actually cancelled."""
+    primary = asyncio.ensure_future(first())
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not admit():
+            return await primary
+        backup = asyncio.ensure_future(second())
+        tasks.append(backup)
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    policy.won(task is backup)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def _submit(fn, legs):
+    # Carry the caller's telemetry stage/trace into the worker thread
+    leg = HedgeLeg()
+    future = _executor.submit(contextvars.copy_context().run, fn, leg)
+    legs[future] = leg
+    return future
@@ -0,0 +1,362 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from result_cache import sha256_bytes
+
+DEFAULT_HISTORY_PATH = os.path.join(".cache", "history.sqlite3")
+DEFAULT_MAX_ENTRIES = 20000
+# Small enough to keep thousands of runs in a few MB, big enough to recognise the image
+THUMBNAIL_EDGE = 160
+THUMBNAIL_QUALITY = 70
+
+_TERM = re.compile(r"\w+\*?", re.UNICODE)
+
+
+def make_thumbnail(image_bytes, edge=THUMBNAIL_EDGE):
+    """Small JPEG of the image for browsing, or None if it can't be decoded."""
+    # Imported here so searching the history (e.g. on every app rerun) doesn't load Pillow
+    import PIL.Image
+    import PIL.ImageOps
+    try:
+        image = PIL.Image.open(io.BytesIO(image_bytes))
+        # JPEGs decode straight at a reduced scale
+        image.draft("RGB", (edge * 2, edge * 2))
+        image = PIL.ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = PIL.Image.new("RGBA", image.size, (255, 255, 255, 255))
+            image = PIL.Image.alpha_composite(background, image)
+        image = image.convert("RGB")
+        image.thumbnail((edge, edge), PIL.Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+        return buffer.getvalue()
+    except (PIL.UnidentifiedImageError, OSError, ValueError):
+        return None
+
+
+def fts_query(text):
+    """
+    FTS5 query for free text typed by a user: every word must appear, a
+    trailing * makes it a prefix. Quoting each word keeps characters such as
+    "-" or ":" from being read as query syntax. Returns None for no words.
+    """
+    terms = []
+    for term in _TERM.findall(text):
+        prefix = term.endswith("*")
+        word = term.rstrip("*")
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+
+def trace_models(trace):
+    """{stage: ["provider/model", ...]} of the calls that succeeded in a run trace."""
+    models = {}
+    for call in (trace or {}).get("calls", []):
+        if call["status"] != "ok":
+            continue
+        name = f"{call['provider']}/{call['model']}"
+        used = models.setdefault(call["stage"] or "unknown", [])
+        if name not in used:
+            used.append(name)
+    return models
+
+
+def trace_timings(trace):
+    """Latency, per-stage seconds and token/cost totals of a run trace."""
+    if not trace:
+        return {}
+    totals = trace.get("totals") or {}
+    return {
+        "latency": trace.get("latency"),
+        "stages": {stage["stage"]: round(stage["seconds"], 3) for stage in trace.get("stages", [])},
+        "prompt_tokens": totals.get("prompt_tokens"),
+        "completion_tokens": totals.get("completion_tokens"),
+        "cost_usd": totals.get("cost_usd"),
+    }
+
+
+class HistoryStore:
+    """
+    Persistent, searchable log of generated prompts.
+
+    Each run keeps the image hash and a thumbnail, the mode, every stage's
+    output, the models and timings. An FTS5 index over the prompt, the stage
+    outputs, the mode and the source name backs search(); browsing newest
+    first uses a plain index on the creation time. The oldest runs are dropped
+    beyond max_entries. Safe to share between threads.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " id INTEGER PRIMARY KEY,"
+            " created REAL NOT NULL,"
+            " image_sha TEXT NOT NULL,"
+            " mode TEXT NOT NULL,"
+            " source TEXT,"
+            " prompt TEXT NOT NULL,"
+            " stages TEXT NOT NULL,"
+            " models TEXT NOT NULL,"
+            " timings TEXT NOT NULL,"
+            " thumbnail BLOB);"
+            "CREATE INDEX IF NOT EXISTS runs_created ON runs(created);"
+            "CREATE INDEX IF NOT EXISTS runs_image ON runs(image_sha);"
+            # Indexes plain text rather than runs.stages, whose JSON escapes would glue words together
+            "CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(prompt, stages, mode, source);"
+            "CREATE TRIGGER IF NOT EXISTS runs_ad AFTER DELETE ON runs BEGIN"
+            " DELETE FROM runs_fts WHERE rowid = old.id; END;"
+        )
+        self._conn.commit()
+
+    def record(self, image_bytes, prompt, mode, stages=None, trace=None, source=None, models=None,
+               timings=None, thumbnail=True):
+        """
+        Store one finished run and return its id. `stages` maps stage names to
+        their outputs; models and timings come from `trace` (a
+        telemetry.RunTrace summary) unless given directly.
+        """
+        preview = make_thumbnail(image_bytes) if thumbnail else None
+        stages = stages or {}
+        row = (
+            time.time(),
+            sha256_bytes(image_bytes),
+            mode,
+            source,
+            prompt,
+            json.dumps(stages, ensure_ascii=False),
+            json.dumps(trace_models(trace) if models is None else models),
+            json.dumps(trace_timings(trace) if timings is None else timings),
+            preview,
+        )
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO runs (created, image_sha, mode, source, prompt, stages, models, timings, thumbnail)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row,
+            )
+            self._conn.execute(
+                "INSERT INTO runs_fts (rowid, prompt, stages, mode, source) VALUES (?, ?, ?, ?, ?)",
+                (cursor.lastrowid, prompt, "\n\n".join(stages.values()), mode, source),
+            )
+            self._evict()
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def _evict(self):
+        if not self.max_entries:
+            return
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM runs").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM runs WHERE id IN (SELECT id FROM runs ORDER BY created ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def search(self, text, limit=20, mode=None):
+        """
+        Runs matching every word of `text`, best match first, with a highlighted
+        snippet of the best-matching text. Empty text browses the newest runs instead.
+        """
+        query = fts_query(text or "")
+        if query is None:
+            return self.recent(limit, mode)
+        sql = (
+            "SELECT runs.id, runs.created, runs.image_sha, runs.mode, runs.source, runs.prompt, runs.timings,"
+            " runs.thumbnail, snippet(runs_fts, -1, '[', ']', '...', 16) AS snippet"
+            " FROM runs_fts JOIN runs ON runs.id = runs_fts.rowid"
+            " WHERE runs_fts MATCH ?"
+        )
+        params = [query]
+        if mode:
+            sql += " AND runs.mode = ?"
+            params.append(mode)
+        sql += " ORDER BY bm25(runs_fts) LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [_summary(row) for row in rows]
+
+    def recent(self, limit=20, mode=None):
+        """Newest runs first."""
+        sql = ("SELECT id, created, image_sha, mode, source, prompt, timings, thumbnail, NULL AS snippet FROM runs")
+        params = []
+        if mode:
+            sql += " WHERE mode = ?"
+            params.append(mode)
+        sql += " ORDER BY created DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [_summary(row) for row in rows]
+
+    def for_image(self, image_bytes, limit=5):
+        """Earlier runs on exactly these image bytes, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, created, image_sha, mode, source, prompt, timings, thumbnail, NULL AS snippet"
+                " FROM runs WHERE image_sha = ? ORDER BY created DESC LIMIT ?",
+                (sha256_bytes(image_bytes), limit),
+            ).fetchall()
+        return [_summary(row) for row in rows]
+
+    def get(self, run_id):
+        """Everything stored for one run, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        for field in ("stages", "models", "timings"):
+            entry[field] = json.loads(entry[field])
+        return entry
+
+    def delete(self, run_id):
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+            self._conn.commit()
+            return cursor.rowcount > 0
+
+    def modes(self):
+        with self._lock:
+            return [mode for (mode,) in self._conn.execute("SELECT DISTINCT mode FROM runs ORDER BY mode")]
+
+    def stats(self):
+        with self._lock:
+            count, images, oldest, newest = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT image_sha), MIN(created), MAX(created) FROM runs"
+            ).fetchone()
+        return {"entries": count, "images": images, "oldest": oldest, "newest": newest}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _summary(row):
+    entry = dict(row)
+    entry["timings"] = json.loads(entry["timings"])
+    return entry
+
+
+_default_history = None
+_default_lock = threading.Lock()
+
+
+def default_history():
+    """
+    Process-wide store at PROMPT_HISTORY_PATH, or None when PROMPT_HISTORY is
+    0/false/off.
+    """
+    global _default_history
+    if os.getenv("PROMPT_HISTORY", "1").strip().lower() in ("0", "false", "off", "no"):
+        return None
+    with _default_lock:
+        if _default_history is None:
+            _default_history = HistoryStore(
+                path=os.getenv("PROMPT_HISTORY_PATH", DEFAULT_HISTORY_PATH),
+                max_entries=int(os.getenv("PROMPT_HISTORY_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            )
+        return _default_history
+
+
+def _format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+def _print_entries(entries):
+    if not entries:
+        print("No runs found.")
+        return
+    for entry in entries:
+        latency = entry["timings"].get("latency")
+        took = f" {latency:.1f}s" if latency else ""
+        source = f" {entry['source']}" if entry["source"] else ""
+        print(f"#{entry['id']}  {_format_time(entry['created'])}  {entry['mode']}{took}{source}")
+        text = entry["snippet"] or entry["prompt"]
+        text = " ".join(text.split())
+        print(f"    {text[:200]}{'...' if len(text) > 200 else ''}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search and browse the prompt history.")
+    parser.add_argument("--db", default=None, help="History database (default: PROMPT_HISTORY_PATH or .cache/history.sqlite3)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search = commands.add_parser("search", help="Full-text search over prompts and stage outputs")
+    search.add_argument("query", nargs="+")
+    search.add_argument("-n", "--limit", type=int, default=20)
+    search.add_argument("--mode", help="Only runs of this mode")
+    search.add_argument("--json", action="store_true", help="Print JSON lines instead of a listing")
+
+    recent = commands.add_parser("recent", help="Newest runs first")
+    recent.add_argument("-n", "--limit", type=int, default=20)
+    recent.add_argument("--mode", help="Only runs of this mode")
+    recent.add_argument("--json", action="store_true", help="Print JSON lines instead of a listing")
+
+    show = commands.add_parser("show", help="Print one run's prompt (or everything with --json)")
+    show.add_argument("id", type=int)
+    show.add_argument("--json", action="store_true")
+
+    delete = commands.add_parser("delete", help="Remove a run")
+    delete.add_argument("id", type=int)
+
+    commands.add_parser("stats", help="Number of runs and images stored")
+
+    args = parser.parse_args(argv)
+    store = HistoryStore(args.db or os.getenv("PROMPT_HISTORY_PATH", DEFAULT_HISTORY_PATH))
+
+    if args.command in ("search", "recent"):
+        if args.command == "search":
+            entries = store.search(" ".join(args.query), args.limit, args.mode)
+        else:
+            entries = store.recent(args.limit, args.mode)
+        if args.json:
+            for entry in entries:
+                entry.pop("thumbnail", None)
+                print(json.dumps(entry, ensure_ascii=False))
+        else:
+            _print_entries(entries)
+    elif args.command == "show":
+        entry = store.get(args.id)
+        if entry is None:
+            print(f"No run #{args.id}.")
+            return 1
+        if args.json:
+            entry.pop("thumbnail", None)
+            print(json.dumps(entry, ensure_ascii=False, indent=2))
+        else:
+            print(entry["prompt"])
+    elif args.command == "delete":
+        if not store.delete(args.id):
+            print(f"No run #{args.id}.")
+            return 1
+        print(f"Deleted run #{args.id}.")
+    else:
+        stats = store.stats()
+        print(f"{stats['entries']} runs of {stats['images']} images")
+        if stats["entries"]:
+            print(f"oldest {_format_time(stats['oldest'])}, newest {_format_time(stats['newest'])}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import io
+import os
+import sys
+import base64
+import PIL.Image
+import PIL.ImageOps
+from result_cache import fingerprint
+
+# llama-4-scout tiles images internally; anything beyond this edge is
+# downsampled server-side anyway, so sending it only costs upload time.
+DEFAULT_MAX_EDGE = 1120
+DEFAULT_FORMAT = "JPEG"
+DEFAULT_QUALITY = 85
+
+# Modes PIL can write to PNG as they are; anything else is converted first
+PNG_MODES = ("1", "L", "LA", "P", "RGB", "RGBA")
+
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+
+class PreparedImage:
+    """Re-encoded image bytes ready for a vision request, plus before/after sizes."""
+
+    def __init__(self, data, mime_type, bytes_before, size):
+        self.data = data
+        self.mime_type = mime_type
+        self.bytes_before = bytes_before
+        self.size = size
+
+    @property
+    def bytes_after(self):
+        return len(self.data)
+
+    def base64(self):
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{self.base64()}"
+
+    def stats(self):
+        return {
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after,
+            "ratio": self.bytes_after / self.bytes_before if self.bytes_before else 1.0,
+            "width": self.size[0],
+            "height": self.size[1],
+            "mime_type": self.mime_type,
+        }
+
+
+def load_image_bytes(source, max_edge=DEFAULT_MAX_EDGE):
+    """
+    Encoded image bytes from any supported input: a path, bytes-like data, a
+    file-like object (such as a Streamlit upload) or a PIL image.
+
+    Bytes come back as-is and in-memory buffers via getvalue(), so uploads are
+    neither copied to disk nor duplicated. A PIL image has no source bytes; it
+    is turned upright, converted to a mode PNG can hold (CMYK, float...),
+    shrunk to max_edge (preprocessing would do that anyway) and stored as
+    fast lossless PNG so cache keys stay deterministic.
+    """
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (bytearray, memoryview)):
+        return bytes(source)
+    if isinstance(source, PIL.Image.Image):
+        # Returns a copy, so the caller's image is left alone
+        image = PIL.ImageOps.exif_transpose(source)
+        if image.mode not in PNG_MODES:
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        image.thumbnail((max_edge, max_edge), PIL.Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", compress_level=1)
+        return buffer.getvalue()
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    if hasattr(source, "read"):
+        return source.read()
+    with open(source, "rb") as image_file:
+        return image_file.read()
+
+
+class ImagePreprocessor:
+    """
+    Normalizes uploads before base64 encoding: applies EXIF orientation, drops
+    metadata, downscales to max_edge and re-encodes as JPEG or WebP.
+    """
+
+    def __init__(self, max_edge=None, image_format=None, quality=None):
+        self.max_edge = int(max_edge or os.getenv("IMAGE_MAX_EDGE", DEFAULT_MAX_EDGE))
+        self.image_format = (image_format or os.getenv("IMAGE_FORMAT", DEFAULT_FORMAT)).upper()
+        self.quality = int(quality or os.getenv("IMAGE_QUALITY", DEFAULT_QUALITY))
+        if self.image_format not in MIME_TYPES:
+            raise ValueError(f"Unsupported output format {self.image_format!r}; use one of {sorted(MIME_TYPES)}.")
+
+    def fingerprint(self):
+        """Settings that change what the vision model sees, for use in cache keys."""
+        return fingerprint("image_prep", self.max_edge, self.image_format, self.quality)
+
+    def load(self, source):
+        """load_image_bytes with this preprocessor's max_edge."""
+        return load_image_bytes(source, self.max_edge)
+
+    def prepare(self, data):
+        return self.encode(self.decode(data), len(data))
+
+    def decode(self, data):
+        """Upright PIL image from encoded bytes, decoded at a reduced scale where possible."""
+        try:
+            image = PIL.Image.open(io.BytesIO(data))
+            # Let the JPEG decoder skip straight to a reduced scale (no-op for other formats)
+            image.draft("RGB", (self.max_edge, self.max_edge))
+            image = PIL.ImageOps.exif_transpose(image)
+        except PIL.UnidentifiedImageError as e:
+            raise ValueError(f"Could not decode image: {e}") from e
+        return image
+
+    def encode(self, image, bytes_before=0):
+        """
+        PreparedImage from a decoded image (or a crop of one); bytes_before is
+        the source size reported in stats().
+        """
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        if self.image_format == "JPEG" and image.mode == "RGBA":
+            # JPEG has no alpha channel; flatten onto white like most viewers do
+            background = PIL.Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+
+        image.thumbnail((self.max_edge, self.max_edge), PIL.Image.LANCZOS)
+        # Nothing from the source (EXIF, ICC, XMP, comments) rides along
+        image.info = {}
+
+        buffer = io.BytesIO()
+        save_args = {"quality": self.quality}
+        if self.image_format == "JPEG":
+            save_args["optimize"] = True
+        else:
+            save_args["method"] = 4
+        image.save(buffer, format=self.image_format, **save_args)
+        return PreparedImage(buffer.getvalue(), MIME_TYPES[self.image_format], bytes_before, image.size)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python image_prep.py <path_to_image> [...]")
+        sys.exit(1)
+
+    preprocessor = ImagePreprocessor()
+    for path in sys.argv[1:]:
+        with open(path, "rb") as image_file:
+            prepared = preprocessor.prepare(image_file.read())
+        stats = prepared.stats()
+        print(f"{path}: {stats['bytes_before']:,} -> {stats['bytes_after']:,} bytes "
+              f"({stats['ratio']:.1%}) {stats['width']}x{stats['height']} {stats['mime_type']}")
@@ -0,0 +1,351 @@
+import os
+import re
+import threading
+from collections import deque
+from result_cache import fingerprint
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ip_lexicon.txt")
+
+# Above this share of flagged sentences one full-text scrub is cheaper than fragments
+MAX_FRAGMENT_RATIO = 0.5
+
+FRAGMENT_INSTRUCTIONS = """Each line below is one sentence taken from a longer prompt, prefixed with its [number].
+Apply your rules to these sentences only. Return exactly the same numbered lines, one per line,
+in the form "[number] rewritten sentence". Do not merge, drop or add lines. Output nothing else."""
+
+# Face and hair wording. prompt_gen's guardian also redacts these (mandate 3 of its
+# GUARDIAN_SYSTEM_PROMPT), so a sentence using one is scrubbed even when it names no IP.
+# Words that are just as often about costumes ("braided", "fringe", "blush") are left out.
+FACE_HAIR_TERMS = [
+    "face", "faces", "facial", "eye", "eyes", "eyed", "iris", "irises", "pupils", "eyebrow", "eyebrows",
+    "brow", "brows", "eyelashes", "lashes", "cheek", "cheeks", "cheekbones", "jaw", "jawline", "chin",
+    "lip", "lips", "nose", "freckles", "freckled", "mole", "dimples", "complexion", "skin tone",
+    "makeup", "lipstick", "eyeliner", "eyeshadow", "mascara", "beard", "bearded", "moustache", "mustache",
+    "stubble", "goatee", "sideburns", "hair", "haired", "hairstyle", "hairdo", "haircut", "ponytail",
+    "pigtails", "bun", "bangs", "curls", "ringlets", "dreadlocks", "afro", "bald", "blonde", "blond",
+    "brunette", "redhead",
+]
+
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])(\s+)")
+_FRAGMENT_LINE = re.compile(r"^\s*\[(\d+)\]\s*(.*)$")
+
+
+class Match:
+    def __init__(self, start, end, term):
+        self.start = start
+        self.end = end
+        self.term = term
+
+    def __repr__(self):
+        return f"Match({self.term!r}, {self.start}, {self.end})"
+
+
+class IPDetector:
+    """
+    Aho-Corasick matcher over a lexicon of character, brand and franchise names.
+
+    Matching is case-insensitive and only counts whole words, so one pass over
+    the text finds every lexicon entry regardless of lexicon size.
+    """
+
+    def __init__(self, terms):
+        self.terms = sorted({term.strip() for term in terms if term.strip()})
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for term in self.terms:
+            self._add(term.lower(), term)
+        self._link()
+
+    @classmethod
+    def load(cls, path=DEFAULT_LEXICON_PATH):
+        """Read a lexicon file: one name per line, '#' starts a comment, [section] headers are ignored."""
+        terms = []
+        with open(path, "r", encoding="utf-8") as handle:
+            for line in handle:
+                line = line.split("#", 1)[0].strip()
+                if line and not (line.startswith("[") and line.endswith("]")):
+                    terms.append(line)
+        return cls(terms)
+
+    def _add(self, pattern, term):
+        node = 0
+        for char in pattern:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][char] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = child
+        self._output[node].append((len(pattern), term))
+
+    def _link(self):
+        # Breadth-first so every failure link points at an already-linked, shallower node
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text):
+        """Every whole-word lexicon hit in `text`, in order of appearance."""
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # A few characters change length when lowercased; keep offsets aligned
+            lowered = "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        node = 0
+        for index, char in enumerate(lowered):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                for length, term in output[node]:
+                    start = index - length + 1
+                    if _is_word_boundary(text, start - 1) and _is_word_boundary(text, index + 1):
+                        matches.append(Match(start, index + 1, term))
+        matches.sort(key=lambda match: (match.start, -match.end))
+        return matches
+
+    def is_clean(self, text):
+        return not self.find(text)
+
+    def fingerprint(self):
+        return fingerprint("ip_lexicon", self.terms)
+
+
+def _is_word_boundary(text, index):
+    return index < 0 or index >= len(text) or not text[index].isalnum()
+
+
+_default_detector = None
+_default_lock = threading.Lock()
+
+
+def default_detector():
+    """Detector over IP_LEXICON_PATH (default: ip_lexicon.txt next to this module), loaded once."""
+    global _default_detector
+    with _default_lock:
+        if _default_detector is None:
+            _default_detector = IPDetector.load(os.getenv("IP_LEXICON_PATH", DEFAULT_LEXICON_PATH))
+        return _default_detector
+
+
+_face_hair_detector = None
+
+
+def face_hair_detector():
+    """Detector over FACE_HAIR_TERMS, for scrubbers that redact biometrics as well as IP."""
+    global _face_hair_detector
+    with _default_lock:
+        if _face_hair_detector is None:
+            _face_hair_detector = IPDetector(FACE_HAIR_TERMS)
+        return _face_hair_detector
+
+
+def split_sentences(text):
+    """Split into [sentence, separator, sentence, separator, ...]; joining the list restores the text."""
+    return _SENTENCE_BREAK.split(text)
+
+
+def format_fragments(fragments):
+    return "\n".join(f"[{number}] {' '.join(sentence.split())}" for number, sentence in sorted(fragments.items()))
+
+
+def parse_fragments(text, expected):
+    """Map of sentence number -> rewritten sentence, or None if the reply doesn't cover `expected`."""
+    rewritten = {}
+    for line in text.splitlines():
+        match = _FRAGMENT_LINE.match(line)
+        if match:
+            rewritten[int(match.group(1))] = match.group(2).strip()
+    if set(rewritten) != set(expected):
+        return None
+    return rewritten
+
+
+class ScrubPlan:
+    """
+    What a guarded scrub needs to do for one text.
+
+    mode is "skip" (no hits, no LLM call), "fragments" (send only the flagged
+    sentences) or "full" (send everything). With a `redact` detector (e.g.
+    face_hair_detector) its hits flag sentences too, but only IP hits count as
+    residue afterwards.
+    """
+
+    def __init__(self, detector, text, redact=None):
+        self.text = text
+        self.hits = detector.find(text)
+        self.redactions = redact.find(text) if redact else []
+        self.parts = split_sentences(text)
+        self.fragments = {}
+        flagged = self.hits + self.redactions
+        if not flagged:
+            self.mode = "skip"
+            return
+
+        # Sentences sit at even positions of parts; find the ones containing a hit
+        offset = 0
+        for index in range(0, len(self.parts), 2):
+            sentence = self.parts[index]
+            end = offset + len(sentence)
+            if any(hit.start < end and hit.end > offset for hit in flagged):
+                self.fragments[index // 2 + 1] = sentence
+            offset = end + (len(self.parts[index + 1]) if index + 1 < len(self.parts) else 0)
+
+        sentence_count = (len(self.parts) + 1) // 2
+        if len(self.fragments) / sentence_count > MAX_FRAGMENT_RATIO:
+            self.mode = "full"
+        else:
+            self.mode = "fragments"
+
+    def fragment_prompt(self):
+        return format_fragments(self.fragments)
+
+    def pending(self):
+        """Sentences a batched scrub has to rewrite: the flagged ones, or all of them in full mode."""
+        if self.mode == "fragments":
+            return self.fragments
+        if self.mode == "skip":
+            return {}
+        return {index // 2 + 1: self.parts[index] for index in range(0, len(self.parts), 2)
+                if self.parts[index].strip()}
+
+    def merge(self, reply):
+        """Splice a fragment reply back into the text; None if the reply is malformed."""
+        rewritten = parse_fragments(reply, self.fragments)
+        if rewritten is None:
+            return None
+        return self.splice(rewritten)
+
+    def splice(self, rewritten):
+        parts = list(self.parts)
+        for number, sentence in rewritten.items():
+            parts[(number - 1) * 2] = sentence
+        return "".join(parts)
+
+
+def scrub_report(plan, detector, result, retried):
+    residual = detector.find(result)
+    if residual:
+        print(f"IP GUARD WARNING: residual IP terms after scrub: {sorted({m.term for m in residual})}")
+    return {
+        "mode": plan.mode,
+        "hits": sorted({match.term for match in plan.hits}),
+        "redactions": sorted({match.term for match in plan.redactions}),
+        "fragments": len(plan.fragments),
+        "retried": retried,
+        "residual": sorted({match.term for match in residual}),
+    }
+
+
+def guarded_scrub(detector, text, scrub_full, scrub_fragments, redact=None):
+    """
+    Scrub `text` with as little LLM work as the lexicon allows.
+
+    `scrub_full(text)` rewrites a whole text; `scrub_fragments(numbered_lines)`
+    rewrites the FRAGMENT_INSTRUCTIONS format. Clean text is returned untouched;
+    with `redact`, text is only clean if that detector finds nothing either.
+    The result is re-checked, and gets one full scrub if anything slipped through.
+    Returns (scrubbed_text, report).
+    """
+    plan = ScrubPlan(detector, text, redact)
+    if plan.mode == "skip":
+        return text, scrub_report(plan, detector, text, False)
+
+    result = None
+    if plan.mode == "fragments":
+        result = plan.merge(scrub_fragments(plan.fragment_prompt()))
+    if result is None:
+        result = scrub_full(text)
+
+    retried = False
+    if not detector.is_clean(result):
+        result = scrub_full(result)
+        retried = True
+    return result, scrub_report(plan, detector, result, retried)
+
+
+def guarded_scrub_many(detector, texts, scrub_full, scrub_fragments, redact=None):
+    """
+    guarded_scrub for several texts at once, in one LLM call where possible.
+
+    The sentences every text needs rewritten (all of them for texts too dense
+    for fragments) are numbered into a single FRAGMENT_INSTRUCTIONS batch. If
+    the reply is malformed, or a result still hits the lexicon, that text gets
+    a full scrub of its own. Returns a list of (scrubbed_text, report).
+    """
+    plans = [ScrubPlan(detector, text, redact) for text in texts]
+    batch = {}
+    owners = {}
+    for index, plan in enumerate(plans):
+        for number, sentence in plan.pending().items():
+            batch[len(batch) + 1] = sentence
+            owners[len(batch)] = (index, number)
+
+    results = [plan.text for plan in plans]
+    if batch:
+        rewritten = parse_fragments(scrub_fragments(format_fragments(batch)), batch)
+        per_text = {}
+        for number, sentence in (rewritten or {}).items():
+            index, local = owners[number]
+            per_text.setdefault(index, {})[local] = sentence
+        for index, plan in enumerate(plans):
+            if plan.mode == "skip":
+                continue
+            if rewritten is None:
+                results[index] = scrub_full(plan.text)
+            else:
+                results[index] = plan.splice(per_text.get(index, {}))
+
+    reports = []
+    for index, plan in enumerate(plans):
+        retried = False
+        if plan.mode != "skip" and not detector.is_clean(results[index]):
+            results[index] = scrub_full(results[index])
+            retried = True
+        reports.append(scrub_report(plan, detector, results[index], retried))
+    return list(zip(results, reports))
+
+
+async def aguarded_scrub(detector, text, scrub_full, scrub_fragments, redact=None):
+    """guarded_scrub for coroutine scrubbers."""
+    plan = ScrubPlan(detector, text, redact)
+    if plan.mode == "skip":
+        return text, scrub_report(plan, detector, text, False)
+
+    result = None
+    if plan.mode == "fragments":
+        result = plan.merge(await scrub_fragments(plan.fragment_prompt()))
+    if result is None:
+        result = await scrub_full(text)
+
+    retried = False
+    if not detector.is_clean(result):
+        result = await scrub_full(result)
+        retried = True
+    return result, scrub_report(plan, detector, result, retried)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    detector = default_detector()
+    sample = sys.stdin.read() if len(sys.argv) < 2 else open(sys.argv[1], encoding="utf-8").read()
+    started = time.perf_counter()
+    found = detector.find(sample)
+    elapsed = (time.perf_counter() - started) * 1e6
+    print(f"{len(detector.terms)} terms, {len(sample)} chars, {elapsed:.0f} us")
+    for match in found:
+        print(f"  {match.start}-{match.end}: {match.term}")
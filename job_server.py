@@ -0,0 +1,518 @@
+import os
+import json
+import time
+import uuid
+import queue
+import base64
+import signal
+import argparse
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_PORT = 8600
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 16
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+# Stage announcements kept per job (partial text only keeps the latest)
+MAX_EVENTS = 200
+# Finished jobs kept for polling before the oldest are forgotten
+FINISHED_JOBS_KEPT = 500
+# Seconds between SSE keep-alive comments while a job is quiet
+HEARTBEAT = 15.0
+TASKS = ("engine", "prompt", "prompts")
+FINISHED = ("done", "failed", "cancelled")
+
+
+class Job:
+    """One submitted image and everything known about its progress."""
+
+    def __init__(self, task, image_bytes, options):
+        self.id = uuid.uuid4().hex[:12]
+        self.task = task
+        self.image_bytes = image_bytes
+        self.options = options
+        self.status = "queued"
+        self.events = []
+        self.stage = None
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Bumped on every change so streamers can wait for "anything new"
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def progress(self, msg, agent_id="", partial=None):
+        """status_callback for the pipeline."""
+        with self._cond:
+            if partial is not None:
+                self.partial = partial
+            else:
+                self.stage = agent_id or self.stage
+                self.partial = None
+                self.events.append({"ts": time.time(), "stage": agent_id, "message": msg})
+                del self.events[:-MAX_EVENTS]
+            self._changed()
+
+    def start(self):
+        with self._cond:
+            self.status = "running"
+            self.started = time.time()
+            self._changed()
+
+    def finish(self, result=None, error=None, status=None):
+        with self._cond:
+            self.status = status or ("failed" if error is not None else "done")
+            self.result = result
+            self.error = error
+            self.partial = None
+            self.finished = time.time()
+            # The upload is no longer needed once the job is over
+            self.image_bytes = None
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self._cond.notify_all()
+
+    def wait(self, version, timeout):
+        """Block until the job changes past `version` (or timeout); returns the current version."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def snapshot(self, with_result=True):
+        with self._cond:
+            data = {
+                "id": self.id,
+                "task": self.task,
+                "status": self.status,
+                "stage": self.stage,
+                "events": list(self.events),
+                "partial": self.partial,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished,
+                "error": self.error,
+            }
+            if with_result:
+                data["result"] = self.result
+            return data
+
+
+class ServiceClosed(Exception):
+    """Raised by JobService.submit once shutdown has begun."""
+
+
+class JobService:
+    """
+    Bounded job queue in front of a pool of pipeline workers.
+
+    `workers` threads take jobs off a queue of at most `queue_size`; submit()
+    raises queue.Full instead of growing it, so callers feel the backpressure.
+    With use_processes=True each worker thread hands its job to a process pool
+    of the same size (progress comes back over a multiprocessing queue), which
+    keeps CPU-heavy preprocessing off this process' GIL.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, use_processes=False,
+                 stream=True, cache=None):
+        self.workers = workers
+        self.use_processes = use_processes
+        self.stream = stream
+        self.cache = cache
+        self.jobs = OrderedDict()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._accepting = True
+        self._threads = []
+        self._engine = None
+        self._pool = None
+        self._progress = None
+        self._pump = None
+
+    def start(self):
+        if self.use_processes:
+            # spawn: forking a process that already runs threads can deadlock
+            context = multiprocessing.get_context("spawn")
+            self._progress = context.Queue()
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                             initializer=_init_worker,
+                                             initargs=(self._progress, self.stream, self.cache is not None))
+            self._pump = threading.Thread(target=self._pump_progress, name="job-progress", daemon=True)
+            self._pump.start()
+        else:
+            from grok_engine import GrokAgenticEngine
+            # One warm engine (and connection pool) shared by every worker thread, as in app.py
+            self._engine = GrokAgenticEngine(cache=self.cache, stream=self.stream)
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, task, image_bytes, options=None):
+        if task not in TASKS:
+            raise ValueError(f"Unknown task {task!r}; expected one of {', '.join(TASKS)}")
+        job = Job(task, image_bytes, options or {})
+        with self._lock:
+            if not self._accepting:
+                raise ServiceClosed("Service is shutting down")
+            self._queue.put_nowait(job)
+            self.jobs[job.id] = job
+            self._forget_old()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a job that hasn't started; running jobs can't be interrupted. Returns the job or None."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with job._cond:
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.finished = time.time()
+                job.image_bytes = None
+                job._changed()
+        return job
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {
+            "accepting": self._accepting,
+            "workers": self.workers,
+            "pool": "process" if self.use_processes else "thread",
+            "queued": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            "jobs": {status: statuses.count(status) for status in sorted(set(statuses))},
+        }
+
+    def shutdown(self, drain=True, timeout=None):
+        """
+        Stop accepting jobs, then let the workers finish what is running and
+        (with drain=True) everything still queued; queued jobs are cancelled
+        otherwise. Waits up to `timeout` seconds for the workers.
+        """
+        with self._lock:
+            self._accepting = False
+        if not drain:
+            for job in list(self.jobs.values()):
+                self.cancel(job.id)
+        for _ in self._threads:
+            # Blocks while the queue is full, i.e. until workers make room
+            self._queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._progress.put(None)
+
+    def _forget_old(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if job.status != "queued":
+                continue
+            job.start()
+            try:
+                if self._pool is not None:
+                    result = self._pool.submit(_process_job, job.id, job.task, job.image_bytes, job.options).result()
+                else:
+                    result = run_task(self._engine, job.task, job.image_bytes, job.options, job.progress, self.cache)
+                job.finish(result=result)
+            except Exception as e:
+                print(f"JOB ERROR ({job.id}): {e}")
+                job.finish(error=f"{type(e).__name__}: {e}")
+
+    def _pump_progress(self):
+        # Forward progress from worker processes to their jobs
+        while True:
+            item = self._progress.get()
+            if item is None:
+                return
+            job_id, args = item
+            job = self.get(job_id)
+            if job is not None:
+                job.progress(*args)
+
+
+def run_task(engine, task, image_bytes, options, progress, cache=None):
+    """Run one job in this process; returns a JSON-ready result."""
+    if task == "engine":
+        result, trace = engine.run_engine(image_bytes, status_callback=progress, with_trace=True,
+                                          deadline=options.get("deadline"))
+        return {"prompt": result, "trace": trace}
+
+    from prompt_gen import generate_prompt, generate_prompts
+    if task == "prompt":
+        mode = options.get("mode") or "Human-Aesthetic Narrative"
+        progress(f"Generating {mode} prompt", "prompt")
+        result = {"prompt": generate_prompt(image_bytes, mode=mode, cache=cache)}
+    else:
+        progress("Describing image for every prompt mode", "prompts")
+        result = {"prompts": generate_prompts(image_bytes, modes=options.get("modes"), cache=cache)}
+    progress("Prompt ready.", "done")
+    return result
+
+
+_worker_engine = None
+_worker_progress = None
+
+
+def _init_worker(progress_queue, stream, use_cache):
+    global _worker_engine, _worker_progress
+    # Ctrl-C is for the parent, which drains the pool; running jobs get to finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from grok_engine import GrokAgenticEngine
+    from result_cache import default_cache
+    _worker_progress = progress_queue
+    # The cache itself can't be pickled over; the worker opens the same default store
+    _worker_engine = GrokAgenticEngine(cache=default_cache() if use_cache else None, stream=stream)
+
+
+def _process_job(job_id, task, image_bytes, options):
+    def progress(*args):
+        _worker_progress.put((job_id, args))
+
+    return run_task(_worker_engine, task, image_bytes, options, progress, _worker_engine.cache)
+
+
+def _make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [part for part in url.path.split("/") if part]
+            if parts == ["health"]:
+                self._send_json(200, service.stats())
+                return
+            job = self._job(parts)
+            if job is None:
+                return
+            if len(parts) == 2:
+                self._send_json(200, job.snapshot())
+            elif parts[2] == "result":
+                snapshot = job.snapshot()
+                if snapshot["status"] == "done":
+                    self._send_json(200, snapshot["result"])
+                elif snapshot["status"] in FINISHED:
+                    self._send_json(409, {"error": snapshot["error"] or snapshot["status"], "status": snapshot["status"]})
+                else:
+                    self._send_json(202, {"status": snapshot["status"], "stage": snapshot["stage"]},
+                                    {"Retry-After": "2"})
+            elif parts[2] == "events":
+                self._stream_events(job)
+            else:
+                self._send_json(404, {"error": f"Unknown path {url.path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path.rstrip("/") != "/jobs":
+                self._send_json(404, {"error": f"Unknown path {url.path}"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_UPLOAD_BYTES:
+                self._send_json(413, {"error": f"Upload larger than {MAX_UPLOAD_BYTES} bytes"}, close=True)
+                return
+            raw = self.rfile.read(length) if length else b""
+            try:
+                task, image_bytes, options = _parse_submission(self.headers.get("Content-Type", ""), raw,
+                                                               parse_qs(url.query))
+                job = service.submit(task, image_bytes, options)
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+            except queue.Full:
+                self._send_json(429, {"error": "Job queue is full, retry later"}, {"Retry-After": "5"})
+            except ServiceClosed as e:
+                self._send_json(503, {"error": str(e)})
+            else:
+                self._send_json(202, {"id": job.id, "status": job.status, "links": {
+                    "status": f"/jobs/{job.id}",
+                    "events": f"/jobs/{job.id}/events",
+                    "result": f"/jobs/{job.id}/result",
+                }}, {"Location": f"/jobs/{job.id}"})
+
+        def do_DELETE(self):
+            parts = [part for part in urlparse(self.path).path.split("/") if part]
+            job = self._job(parts)
+            if job is None:
+                return
+            service.cancel(job.id)
+            snapshot = job.snapshot(with_result=False)
+            self._send_json(200 if snapshot["status"] == "cancelled" else 409, snapshot)
+
+        def _job(self, parts):
+            job = service.get(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+            if job is None:
+                self._send_json(404, {"error": "No such job"})
+            return job
+
+        def _stream_events(self, job):
+            """Server-sent events: progress, partial text, then the result or error."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            sent_events = 0
+            version = -1
+            try:
+                while True:
+                    current = job.wait(version, HEARTBEAT)
+                    if current == version:
+                        self._write_chunk(b": keep-alive\n\n")
+                        continue
+                    version = current
+                    snapshot = job.snapshot()
+                    for event in snapshot["events"][sent_events:]:
+                        self._write_event("progress", event)
+                    sent_events = len(snapshot["events"])
+                    if snapshot["partial"] is not None:
+                        self._write_event("partial", {"stage": snapshot["stage"], "text": snapshot["partial"]})
+                    if snapshot["status"] in FINISHED:
+                        self._write_event(snapshot["status"], {"result": snapshot["result"], "error": snapshot["error"]})
+                        self._write_chunk(b"")
+                        return
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away; the job carries on
+                return
+
+        def _write_event(self, name, payload):
+            self._write_chunk(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def _send_json(self, status, payload, headers=None, close=False):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if close:
+                # The unread body would otherwise be parsed as the next request
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def _parse_submission(content_type, raw, query):
+    """
+    (task, image bytes, options) from a POST /jobs body: either the raw image
+    (options in the query string) or JSON with image_base64, task, mode, modes
+    and deadline (seconds, engine task only).
+    """
+    if content_type.startswith("application/json"):
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON submission: {e}")
+        if not isinstance(body, dict):
+            raise ValueError("Invalid JSON submission: expected an object")
+        encoded = body.get("image_base64") or ""
+        if not isinstance(encoded, str):
+            raise ValueError("Invalid JSON submission: image_base64 must be a string")
+        try:
+            image_bytes = base64.b64decode(encoded, validate=True)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON submission: {e}")
+        task = body.get("task", "engine")
+        options = {"mode": body.get("mode"), "modes": body.get("modes"), "deadline": body.get("deadline")}
+    else:
+        image_bytes = raw
+        task = query.get("task", ["engine"])[0]
+        options = {"mode": query.get("mode", [None])[0], "modes": query.get("modes") or None,
+                   "deadline": query.get("deadline", [None])[0]}
+    if not image_bytes:
+        raise ValueError("No image in the request")
+    if options["deadline"] is not None:
+        try:
+            options["deadline"] = float(options["deadline"])
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid deadline {options['deadline']!r}; expected seconds")
+        if options["deadline"] <= 0:
+            raise ValueError("deadline must be positive")
+    return task, image_bytes, options
+
+
+class JobServer:
+    """JobService plus its HTTP front end; shutdown() drains the workers before closing the socket."""
+
+    def __init__(self, service, host="127.0.0.1", port=DEFAULT_PORT):
+        self.service = service
+        self._httpd = ThreadingHTTPServer((host, port), _make_handler(service))
+        self._httpd.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.service.start()
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self, drain=True, timeout=None):
+        # Status and result endpoints stay up while the queue drains
+        self.service.shutdown(drain=drain, timeout=timeout)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP job API for the prompt pipeline.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-w", "--workers", type=int, default=int(os.getenv("JOB_WORKERS", DEFAULT_WORKERS)))
+    parser.add_argument("-q", "--queue-size", type=int, default=int(os.getenv("JOB_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)))
+    parser.add_argument("--processes", action="store_true", help="Run jobs in worker processes instead of threads")
+    parser.add_argument("--no-stream", action="store_true", help="Don't stream partial text to /events")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the on-disk result cache")
+    parser.add_argument("--drain-timeout", type=float, default=None,
+                        help="Seconds to wait for in-flight jobs on shutdown (default: no limit)")
+    args = parser.parse_args()
+
+    from result_cache import default_cache
+    service = JobService(workers=max(1, args.workers), queue_size=max(1, args.queue_size),
+                         use_processes=args.processes, stream=not args.no_stream,
+                         cache=None if args.no_cache else default_cache())
+    server = JobServer(service, host=args.host, port=args.port).start()
+    print(f"Job API on {server.base_url}: POST /jobs, GET /jobs/<id>[/events|/result], DELETE /jobs/<id>, GET /health")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *a: stop.set())
+    signal.signal(signal.SIGTERM, lambda *a: stop.set())
+    stop.wait()
+    print("Shutting down: finishing queued and running jobs...")
+    server.shutdown(drain=True, timeout=args.drain_timeout)
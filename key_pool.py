@@ -0,0 +1,134 @@
+import os
+import re
+import hashlib
+import time
+import threading
+from rate_limiter import get_rate_limiter
+
+# Seconds a key rejected as invalid (401/403) is kept out of rotation
+REJECTED_KEY_COOLDOWN = 3600.0
+# Waits closer than this count as equal, so headroom decides between keys
+WAIT_RESOLUTION = 0.05
+
+_SEPARATORS = re.compile(r"[\s,;]+")
+
+
+def key_label(api_key):
+    """Stable name for a key in logs and snapshots; the key itself is never printed."""
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+def load_api_keys(primary=None, extra=(), env_var="GROQ_API_KEYS", single_env_var="GROQ_API_KEY"):
+    """
+    Keys for the pool: `primary` first, then `extra`, GROQ_API_KEYS (separated
+    by commas, semicolons or whitespace) and GROQ_API_KEY, without duplicates.
+    """
+    keys = [primary] + list(extra) + _SEPARATORS.split(os.getenv(env_var, "")) + [os.getenv(single_env_var)]
+    unique = []
+    for key in keys:
+        key = (key or "").strip()
+        if key and key not in unique:
+            unique.append(key)
+    return unique
+
+
+class PooledKey:
+    def __init__(self, secret):
+        self.secret = secret
+        self.label = key_label(secret)
+        # time.monotonic() until which the key is out of rotation for every model (see KeyPool.bench)
+        self.benched_until = 0.0
+
+    def benched_for(self, now=None):
+        return max(0.0, self.benched_until - (time.monotonic() if now is None else now))
+
+    def __repr__(self):
+        return f"PooledKey({self.label})"
+
+
+class KeyPool:
+    """
+    Several API keys (accounts) for one provider, each with its own rate
+    limiter per model, so every key's request/token budget is tracked from its
+    own response headers and 429s.
+
+    choose() hands out the key that could send soonest and, among those, the
+    one with the most headroom left, which spreads load evenly and keeps every
+    account's minute and daily quota in use. A key that hits its limit is held
+    back by its limiter until the reset (retry-after) for that model, and a key
+    the API rejects is benched for REJECTED_KEY_COOLDOWN for every model, so
+    the rest carry on.
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError("A key pool needs at least one API key.")
+        self.keys = [PooledKey(key) for key in keys]
+
+    @property
+    def primary(self):
+        return self.keys[0]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def limiter(self, key, model):
+        return get_rate_limiter(model, account=key.label)
+
+    def choose(self, model, tokens=0):
+        """Key for the next call; the call's own acquire() reserves the budget, so concurrent choices spread out."""
+        keys = self._active()
+        if not keys:
+            # Everything is benched: the key that comes back first is the best bet
+            return min(self.keys, key=lambda key: key.benched_until)
+        return min(keys, key=lambda key: self._rank(key, model, tokens))
+
+    def _active(self):
+        now = time.monotonic()
+        return [key for key in self.keys if not key.benched_for(now)]
+
+    def _rank(self, key, model, tokens):
+        limiter = self.limiter(key, model)
+        return round(limiter.expected_wait(tokens) / WAIT_RESOLUTION), -limiter.headroom()
+
+    def expected_wait(self, model, tokens=0):
+        """Delay before the best key could send a call of `tokens` to `model`."""
+        keys = self._active()
+        if not keys:
+            return min(key.benched_for() for key in self.keys)
+        return min(self.limiter(key, model).expected_wait(tokens) for key in keys)
+
+    def bench(self, limiter, seconds=REJECTED_KEY_COOLDOWN):
+        """Take the key behind `limiter` out of rotation for every model (e.g. revoked), without touching the others."""
+        for key in self.keys:
+            if key.label == limiter.account:
+                print(f"KEY POOL WARNING: {key.label} was rejected; skipping it for {seconds:.0f}s")
+                key.benched_until = max(key.benched_until, time.monotonic() + seconds)
+
+    def snapshot(self, models=()):
+        return {
+            key.label: {model: self.limiter(key, model).snapshot() for model in models}
+            for key in self.keys
+        }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(keys):
+    """Process-wide KeyPool for this set of keys, shared by every engine and prompt_gen."""
+    keys = tuple(keys)
+    with _pools_lock:
+        pool = _pools.get(keys)
+        if pool is None:
+            pool = _pools[keys] = KeyPool(keys)
+        return pool
+
+
+def default_key_pool(primary=None, extra=()):
+    """Pool of `primary` and `extra` plus the keys in the environment (see load_api_keys)."""
+    keys = load_api_keys(primary, extra)
+    if not keys:
+        raise ValueError("GROQ_API_KEY not found in environment variables.")
+    return get_key_pool(keys)
@@ -1,17 +1,5 @@
-import os
-from openai import OpenAI
-from dotenv import load_dotenv
+import sys
+from model_catalog import main
 
-load_dotenv()
-
-api_key = os.getenv("XAI_API_KEY")
-if not api_key:
-    print("No API key found in .env")
-else:
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://api.x.ai/v1",
-    )
-    models = client.models.list()
-    for model in models.data:
-        print(model.id)
+# xAI models from the cached catalog; pass --refresh to fetch the list now
+main(["xai"] + sys.argv[1:])
@@ -0,0 +1,420 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from handoff import FIELDS, IP_FIELD
+
+DEFAULT_MODELS = [
+    "llama-3.3-70b-versatile",
+    "qwen/qwen3-32b",
+    "meta-llama/llama-4-scout-17b-16e-instruct",
+]
+
+# Lexicon-clean filler, so the IP guard skips agent_3 unless ip_rate asks otherwise
+FILLER = (
+    "A woman in her early thirties stands in three-quarter view against a weathered brick wall. "
+    "Her dark shoulder-length hair falls in loose waves and catches a warm rim light from camera left. "
+    "She wears a fitted charcoal wool coat over a cream knit sweater with a ribbed collar. "
+    "Soft overcast daylight fills the frame with low contrast and gentle falloff on the background. "
+    "The lens sits at eye level with a shallow depth of field that blurs the street behind her. "
+    "Muted teal and amber tones give the scene a quiet late-autumn mood. "
+)
+IP_SENTENCE = "Her coat carries a small Batman emblem on the lapel. "
+
+_FRAGMENT_LINE = re.compile(r"^\s*\[(\d+)\]", re.MULTILINE)
+
+
+class MockConfig:
+    """
+    Behaviour of the mock server.
+
+    Latency is time-to-first-token drawn from `latency` ("fixed", "uniform",
+    "normal" or "lognormal") around `latency_ms` with spread `jitter_ms`, plus
+    `output_tokens / tokens_per_second` of generation. `error_429` and
+    `error_5xx` are per-request probabilities; `ip_rate` is the chance an image
+    request mentions a lexicon term so the scrub path gets exercised.
+    """
+
+    def __init__(self, latency="lognormal", latency_ms=300.0, jitter_ms=100.0, tokens_per_second=500.0,
+                 output_tokens=220, error_429=0.0, error_5xx=0.0, retry_after=0.05, ip_rate=0.0,
+                 tokens_per_minute=1000000, models=None, seed=None):
+        self.latency = latency
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.tokens_per_second = float(tokens_per_second)
+        self.output_tokens = int(output_tokens)
+        self.error_429 = float(error_429)
+        self.error_5xx = float(error_5xx)
+        self.retry_after = float(retry_after)
+        self.ip_rate = float(ip_rate)
+        self.tokens_per_minute = int(tokens_per_minute)
+        self.models = list(models or DEFAULT_MODELS)
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class MockGroqServer:
+    """
+    Local stand-in for the Groq (OpenAI-compatible) chat-completions API.
+
+    Point a client at `base_url` (GROQ_BASE_URL for the Groq SDK). Every request
+    is tallied under a stage name from `stage_of(body)` (the model name by
+    default) so a benchmark can see per-stage request, error and latency counts.
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0, stage_of=None):
+        self.config = config or MockConfig()
+        self.stage_of = stage_of or (lambda body: body.get("model", "unknown"))
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    # --- bookkeeping ---
+
+    def _record(self, stage, status, elapsed, streamed):
+        with self._lock:
+            entry = self._stats.setdefault(stage, {
+                "requests": 0, "ok": 0, "errors_429": 0, "errors_5xx": 0, "streamed": 0, "server_seconds": [],
+            })
+            entry["requests"] += 1
+            entry["streamed"] += int(streamed)
+            if status == 200:
+                entry["ok"] += 1
+                entry["server_seconds"].append(round(elapsed, 4))
+            elif status == 429:
+                entry["errors_429"] += 1
+            else:
+                entry["errors_5xx"] += 1
+
+    def stats(self):
+        """Per-stage tallies; server_seconds holds the duration of each successful request."""
+        with self._lock:
+            return {stage: dict(entry, server_seconds=list(entry["server_seconds"]))
+                    for stage, entry in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    # --- behaviour ---
+
+    def _draw(self):
+        """(status, first-token delay, mentions_ip) for one request."""
+        config = self.config
+        with self._lock:
+            roll = self._random.random()
+            if config.latency == "fixed":
+                delay = config.latency_ms
+            elif config.latency == "uniform":
+                delay = self._random.uniform(config.latency_ms - config.jitter_ms, config.latency_ms + config.jitter_ms)
+            elif config.latency == "normal":
+                delay = self._random.gauss(config.latency_ms, config.jitter_ms)
+            else:
+                # Median latency_ms with a long right tail, like real API latency
+                sigma = config.jitter_ms / config.latency_ms if config.latency_ms else 0.0
+                delay = config.latency_ms * self._random.lognormvariate(0.0, sigma)
+            mentions_ip = self._random.random() < config.ip_rate
+        if roll < config.error_429:
+            status = 429
+        elif roll < config.error_429 + config.error_5xx:
+            status = 503
+        else:
+            status = 200
+        return status, max(0.0, delay) / 1000.0, mentions_ip
+
+    def reply_text(self, body, mentions_ip=False):
+        user_text = _user_text(body)
+        numbers = _FRAGMENT_LINE.findall(user_text)
+        if numbers:
+            # Fragment scrub: answer every numbered line in the same format
+            sentences = FILLER.split(". ")
+            return "\n".join(f"[{n}] {sentences[i % len(sentences)].strip().rstrip('.')}." for i, n in enumerate(numbers))
+        # Real models stop at max_tokens, which deadline budgets rely on
+        length = min(self.config.output_tokens, body.get("max_tokens") or self.config.output_tokens)
+        words = (FILLER * (length // len(FILLER.split()) + 1)).split()[:length]
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            return _json_reply(user_text, words, mentions_ip and _has_image(body))
+        text = " ".join(words)
+        # IP named in the input is carried along (as agent_2 does) until a scrub asks for it to go
+        carried = IP_SENTENCE in user_text and "IP REFERENCES" not in user_text
+        if (mentions_ip and _has_image(body)) or carried:
+            text = IP_SENTENCE + text
+        return text
+
+    def rate_limit_headers(self, prompt_tokens):
+        return {
+            "x-ratelimit-limit-requests": "14400",
+            "x-ratelimit-remaining-requests": "14000",
+            "x-ratelimit-reset-requests": "6s",
+            "x-ratelimit-limit-tokens": str(self.config.tokens_per_minute),
+            "x-ratelimit-remaining-tokens": str(max(0, self.config.tokens_per_minute - prompt_tokens)),
+            "x-ratelimit-reset-tokens": "60ms",
+        }
+
+
+def _user_text(body):
+    parts = []
+    for message in body.get("messages", []):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(part.get("text", "") for part in content if part.get("type") == "text")
+    return "\n".join(parts)
+
+
+def _prompt_tokens(body):
+    """Rough count over the message contents (4 characters a token), not the escaped request body."""
+    characters = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            characters += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                characters += len(part.get("text") or (part.get("image_url") or {}).get("url") or "")
+    return characters // 4
+
+
+def _json_reply(user_text, words, mentions_ip):
+    """
+    JSON mode: the keys of the JSON object in the prompt (or the handoff fields)
+    filled with `words`. IP mentions are passed along until a reply without
+    IP_FIELD, like agent_3's scrub, drops them.
+    """
+    source = {}
+    start, end = user_text.find("{"), user_text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            source = json.loads(user_text[start:end + 1])
+        except ValueError:
+            source = {}
+    keys = [key for key in source if key != IP_FIELD] or list(FIELDS)
+    share = max(1, len(words) // len(keys))
+    reply = {}
+    for index, key in enumerate(keys):
+        value = " ".join(words[index * share:(index + 1) * share])
+        if IP_FIELD in source and IP_SENTENCE in str(source.get(key, "")):
+            value = IP_SENTENCE + value
+        reply[key] = value
+    if IP_FIELD in source:
+        reply[IP_FIELD] = source[IP_FIELD]
+    elif not source:
+        reply[IP_FIELD] = ["Batman"] if mentions_ip else []
+        if mentions_ip:
+            reply["costume"] = IP_SENTENCE + reply["costume"]
+    return json.dumps(reply)
+
+
+def _has_image(body):
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, so client connection pooling behaves as it would against Groq
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/openai/v1/models":
+                data = [{"id": model, "object": "model", "created": 0, "owned_by": "mock",
+                         "active": True, "context_window": 131072} for model in server.config.models]
+                self._send_json(200, {"object": "list", "data": data})
+            elif self.path == "/mock/stats":
+                self._send_json(200, server.stats())
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if self.path == "/mock/reset":
+                server.reset()
+                self._send_json(200, {"ok": True})
+                return
+            if self.path.rstrip("/") != "/openai/v1/chat/completions":
+                self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+                return
+
+            started = time.monotonic()
+            try:
+                body = json.loads(raw or b"{}")
+            except ValueError:
+                self._send_json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+                return
+            stage = server.stage_of(body)
+            streamed = bool(body.get("stream"))
+            status, delay, mentions_ip = server._draw()
+            time.sleep(delay)
+
+            # Tallied before the last bytes go out, so stats are complete once the client returns
+            record = lambda: server._record(stage, status, time.monotonic() - started, streamed)
+            if status == 429:
+                headers = server.rate_limit_headers(0)
+                headers["retry-after"] = str(server.config.retry_after)
+                record()
+                self._send_json(429, {"error": {
+                    "message": f"Rate limit reached for model `{body.get('model')}` (mock)",
+                    "type": "tokens", "code": "rate_limit_exceeded",
+                }}, headers)
+            elif status != 200:
+                record()
+                self._send_json(status, {"error": {"message": "Service unavailable (mock)", "type": "internal_server_error"}})
+            else:
+                text = server.reply_text(body, mentions_ip)
+                prompt_tokens = _prompt_tokens(body)
+                if streamed:
+                    self._stream(body, text, prompt_tokens, server.rate_limit_headers(prompt_tokens), record)
+                else:
+                    words = text.split(" ")
+                    time.sleep(len(words) / server.config.tokens_per_second)
+                    record()
+                    self._send_json(200, _completion(body, text, prompt_tokens, len(words)),
+                                    server.rate_limit_headers(prompt_tokens))
+
+        def _send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, body, text, prompt_tokens, headers, record):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+
+            words = text.split(" ")
+            pause = 1.0 / server.config.tokens_per_second
+            completion_id = f"chatcmpl-mock-{time.time_ns()}"
+            for index, word in enumerate(words):
+                delta = {"content": word if index == 0 else " " + word}
+                if index == 0:
+                    delta["role"] = "assistant"
+                self._write_event(_chunk(body, completion_id, delta, None))
+                time.sleep(pause)
+            last = _chunk(body, completion_id, {}, "stop")
+            last["x_groq"] = {"id": completion_id, "usage": _usage(prompt_tokens, len(words))}
+            # OpenAI-style APIs (xAI) put it at the top level when the client asks
+            if (body.get("stream_options") or {}).get("include_usage"):
+                last["usage"] = last["x_groq"]["usage"]
+            self._write_event(last)
+            record()
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+
+        def _write_event(self, payload):
+            self._write_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def _usage(prompt_tokens, completion_tokens):
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def _completion(body, text, prompt_tokens, completion_tokens):
+    return {
+        "id": f"chatcmpl-mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": _usage(prompt_tokens, completion_tokens),
+    }
+
+
+def _chunk(body, completion_id, delta, finish_reason):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def add_config_arguments(parser):
+    """MockConfig options as CLI flags (shared with benchmark.py)."""
+    parser.add_argument("--latency", choices=["fixed", "uniform", "normal", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Median time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=100.0, help="Spread of the latency distribution")
+    parser.add_argument("--tps", type=float, default=500.0, help="Output tokens per second")
+    parser.add_argument("--output-tokens", type=int, default=220)
+    parser.add_argument("--error-429", type=float, default=0.0, help="Probability of a 429 per request")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="Probability of a 503 per request")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="retry-after seconds sent with 429s")
+    parser.add_argument("--ip-rate", type=float, default=0.0, help="Chance an image reply mentions a lexicon term")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args):
+    return MockConfig(latency=args.latency, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      tokens_per_second=args.tps, output_tokens=args.output_tokens, error_429=args.error_429,
+                      error_5xx=args.error_5xx, retry_after=args.retry_after, ip_rate=args.ip_rate, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Groq chat-completions server for offline testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    mock = MockGroqServer(config_from_args(args), host=args.host, port=args.port)
+    print(f"Mock Groq server on {mock.base_url} (set GROQ_BASE_URL to this). Stats at {mock.base_url}/mock/stats")
+    try:
+        mock.serve_forever()
+    except KeyboardInterrupt:
+        pass
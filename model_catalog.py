@@ -0,0 +1,324 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from client_pool import get_client, get_openai_client
+from providers import XAI_BASE_URL
+
+DEFAULT_CATALOG_PATH = os.path.join(".cache", "models.json")
+GROQ_BASE_URL = "https://api.groq.com"
+# How long a fetched model list is trusted before startup asks the provider again
+DEFAULT_TTL = 24 * 3600
+# After a failed fetch, engines built within this many seconds don't try again
+FETCH_RETRY_AFTER = 300.0
+
+CAPABILITIES = ("vision", "json_mode")
+
+# What the model lists don't say; the API's own fields (context_window, input_modalities) win
+KNOWN_CAPABILITIES = {
+    "meta-llama/llama-4-scout-17b-16e-instruct": {"vision": True, "json_mode": True, "context_window": 131072},
+    "meta-llama/llama-4-maverick-17b-128e-instruct": {"vision": True, "json_mode": True, "context_window": 131072},
+    "llama-3.3-70b-versatile": {"vision": False, "json_mode": True, "context_window": 131072},
+    "llama-3.1-8b-instant": {"vision": False, "json_mode": True, "context_window": 131072},
+    "qwen/qwen3-32b": {"vision": False, "json_mode": True, "context_window": 131072},
+    "grok-3": {"vision": False, "json_mode": True, "context_window": 131072},
+    "grok-2-vision-1212": {"vision": True, "json_mode": True, "context_window": 32768},
+}
+
+_VISION_HINT = re.compile(r"vision|llama-4|llava|-vl\b|\bvl-", re.IGNORECASE)
+# Listed by the models endpoint but not chat models
+_NOT_CHAT = re.compile(r"whisper|tts|playai|distil|embed|guard|prompt-guard|orpheus", re.IGNORECASE)
+
+# Smallest requests that tell a capability apart: a 400 means the model refuses it
+PROBE_IMAGE = ("data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAIAAACQkWg2AAAAGUlEQVR42mNsaGhgIAUwMZAIR"
+               "jWMahg6GgDJTAGg54KQ4AAAAABJRU5ErkJggg==")
+PROBE_MAX_TOKENS = 32
+
+
+def describe_model(raw):
+    """Catalog entry for one item of a provider's model list."""
+    model_id = raw["id"]
+    known = KNOWN_CAPABILITIES.get(model_id, {})
+    modalities = raw.get("input_modalities")
+    if modalities is not None:
+        vision = "image" in modalities
+    elif "vision" in known:
+        vision = known["vision"]
+    else:
+        vision = True if _VISION_HINT.search(model_id) else None
+    return {
+        "id": model_id,
+        "owned_by": raw.get("owned_by"),
+        "active": raw.get("active") is not False,
+        "chat": not _NOT_CHAT.search(model_id),
+        "vision": vision,
+        "json_mode": known.get("json_mode"),
+        "context_window": raw.get("context_window") or known.get("context_window"),
+        "max_completion_tokens": raw.get("max_completion_tokens"),
+    }
+
+
+def fetch_models(client):
+    """{id: entry} from an OpenAI-compatible client's models endpoint."""
+    models = {}
+    for item in client.models.list().data:
+        entry = describe_model(item.to_dict())
+        models[entry["id"]] = entry
+    return models
+
+
+def probe_capability(client, model, capability):
+    """
+    Ask `model` for a one-line answer that needs `capability`: True if it
+    answers, False if the API rejects the request, None when it can't tell.
+    """
+    if capability == "vision":
+        params = {"messages": [{"role": "user", "content": [
+            {"type": "text", "text": "Reply OK."},
+            {"type": "image_url", "image_url": {"url": PROBE_IMAGE}},
+        ]}]}
+    else:
+        params = {"messages": [{"role": "user", "content": 'Return the JSON object {"ok": true}.'}],
+                  "response_format": {"type": "json_object"}}
+    try:
+        client.chat.completions.create(model=model, max_tokens=PROBE_MAX_TOKENS, temperature=0, **params)
+        return True
+    except Exception as e:
+        if getattr(e, "status_code", None) in (400, 404, 422):
+            return False
+        print(f"MODEL CATALOG ERROR: probing {model} for {capability}: {e}")
+        return None
+
+
+def catalog_source(provider, client=None):
+    """
+    Key of a stored model list: the provider and the endpoint it came from, so
+    a list from a mock server or proxy never stands in for the real API's.
+    """
+    if client is not None:
+        base_url = str(client.base_url)
+    elif provider == "xai":
+        base_url = os.getenv("XAI_BASE_URL", XAI_BASE_URL)
+    else:
+        base_url = os.getenv("GROQ_BASE_URL", GROQ_BASE_URL)
+    return f"{provider} {base_url.rstrip('/')}"
+
+
+def catalog_client(provider, api_key=None):
+    """Sync client for listing/probing `provider` ("groq" or "xai"), or None without a key."""
+    if provider == "xai":
+        api_key = api_key or os.getenv("XAI_API_KEY")
+        return get_openai_client(api_key, os.getenv("XAI_BASE_URL", XAI_BASE_URL)) if api_key else None
+    api_key = api_key or os.getenv("GROQ_API_KEY")
+    return get_client(api_key) if api_key else None
+
+
+class ModelCatalog:
+    """
+    Every provider's model list with what each model can do (vision, JSON
+    mode, context size), kept in a JSON file for `ttl` seconds.
+
+    Engines resolve their stage models against it once, when they are built:
+    a retired model or one that can't take the stage's input is swapped for a
+    working one before any tokens are spent, instead of failing mid-pipeline.
+    The provider is only asked again once the list is older than the TTL, so
+    the pipeline itself never waits on it. Capabilities the list doesn't tell
+    stay unknown (and are trusted) unless `probe` is on: then they are probed
+    with a tiny request, a real billed completion, and stored alongside.
+    """
+
+    def __init__(self, path=DEFAULT_CATALOG_PATH, ttl=DEFAULT_TTL, probe=False):
+        self.path = path
+        self.ttl = ttl
+        self.probe = probe
+        self._lock = threading.Lock()
+        self._data = None
+        self._failed = {}
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as handle:
+                    self._data = json.load(handle)
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Replaced in one go, so another process never reads half a file
+        partial = f"{self.path}.{os.getpid()}.tmp"
+        with open(partial, "w", encoding="utf-8") as handle:
+            json.dump(self._data, handle, indent=1, sort_keys=True)
+        os.replace(partial, self.path)
+
+    def models(self, provider, client=None, refresh=False):
+        """
+        {id: entry} for `provider`, fetched with `client` when missing, older
+        than the TTL or `refresh` is set. Falls back to the stored list when
+        the fetch fails; None when there is nothing to go on.
+        """
+        source = catalog_source(provider, client)
+        with self._lock:
+            stored = self._load().get(source)
+            now = time.time()
+            stale = stored is None or refresh or now - stored["fetched"] > self.ttl
+            if stale and client is not None and now - self._failed.get(source, 0) > FETCH_RETRY_AFTER:
+                try:
+                    models = fetch_models(client)
+                except Exception as e:
+                    print(f"MODEL CATALOG ERROR: listing {provider} models: {e}")
+                    self._failed[source] = now
+                else:
+                    # Probe results survive a refresh for models still listed
+                    previous = stored["models"] if stored else {}
+                    for model_id, entry in models.items():
+                        for capability in CAPABILITIES:
+                            if entry[capability] is None and previous.get(model_id, {}).get(capability) is not None:
+                                entry[capability] = previous[model_id][capability]
+                    stored = self._data[source] = {"fetched": now, "models": models}
+                    self._save()
+            return stored["models"] if stored else None
+
+    def info(self, provider, model, client=None):
+        """Stored entry for `model` on `client`'s endpoint, or None (unlisted, or no list yet)."""
+        with self._lock:
+            stored = self._load().get(catalog_source(provider, client))
+        return stored["models"].get(model) if stored else None
+
+    def supports(self, provider, model, capability, client=None):
+        """True/False, probing `model` with `client` (if probing is on) when the list doesn't say; None if unknown."""
+        entry = self.info(provider, model, client)
+        if entry is None:
+            return None
+        value = entry.get(capability)
+        if value is None and self.probe and client is not None:
+            value = probe_capability(client, model, capability)
+            if value is not None:
+                with self._lock:
+                    entry[capability] = value
+                    self._save()
+        return value
+
+    def resolve(self, provider, model, client=None, vision=False, json_mode=False, fallbacks=(), required=True,
+                exclude=()):
+        """
+        The model to configure instead of `model`: itself when it is listed,
+        active and (as far as is known) capable, else the first usable of
+        `fallbacks`, else the listed chat model with the needed capabilities
+        and the biggest context. Models in `exclude` are never picked as the
+        replacement. Without a model list `model` is trusted. When nothing
+        fits, `model` is kept if `required`, otherwise None.
+        """
+        models = self.models(provider, client)
+        if models is None:
+            return model
+        needs = [capability for capability, wanted in (("vision", vision), ("json_mode", json_mode)) if wanted]
+        problem = None
+        for candidate in [model] + [name for name in fallbacks if name and name != model]:
+            if candidate in exclude:
+                problem = problem or "taken by another stage"
+                continue
+            entry = models.get(candidate)
+            if entry is None or not entry["active"]:
+                problem = problem or "no longer listed"
+                continue
+            missing = [capability for capability in needs if self.supports(provider, candidate, capability, client) is False]
+            if missing:
+                problem = problem or f"without {' or '.join(missing)}"
+                continue
+            if candidate != model:
+                print(f"MODEL CATALOG: {provider}/{model} is {problem}; using {candidate}")
+            return candidate
+
+        usable = [entry for entry in models.values()
+                  if entry["active"] and entry["chat"] and entry["id"] not in exclude
+                  and all(entry.get(capability) for capability in needs)]
+        if usable:
+            best = max(usable, key=lambda entry: entry["context_window"] or 0)["id"]
+            print(f"MODEL CATALOG: {provider}/{model} is {problem}; using {best}")
+            return best
+        print(f"MODEL CATALOG WARNING: {provider}/{model} is {problem} and nothing listed replaces it")
+        return model if required else None
+
+    def snapshot(self):
+        with self._lock:
+            return {source: {"fetched": stored["fetched"], "models": len(stored["models"])}
+                    for source, stored in self._load().items()}
+
+
+_default_catalog = None
+_default_lock = threading.Lock()
+
+
+def default_catalog():
+    """
+    Process-wide catalog at MODEL_CATALOG_PATH, or None when MODEL_CATALOG is
+    0/false/off. MODEL_CATALOG_TTL sets the refresh interval in seconds and
+    MODEL_CATALOG_PROBE=1 turns on probing of unknown capabilities.
+    """
+    global _default_catalog
+    if os.getenv("MODEL_CATALOG", "1").strip().lower() in ("0", "false", "off", "no"):
+        return None
+    with _default_lock:
+        if _default_catalog is None:
+            _default_catalog = ModelCatalog(
+                path=os.getenv("MODEL_CATALOG_PATH", DEFAULT_CATALOG_PATH),
+                ttl=float(os.getenv("MODEL_CATALOG_TTL", DEFAULT_TTL)),
+                probe=os.getenv("MODEL_CATALOG_PROBE", "0").strip().lower() in ("1", "true", "on", "yes"),
+            )
+        return _default_catalog
+
+
+def _flag(value):
+    return "?" if value is None else ("yes" if value else "no")
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="List the cached model catalog of each provider.")
+    parser.add_argument("providers", nargs="*", default=["groq", "xai"], help="groq and/or xai (default: both)")
+    parser.add_argument("--refresh", action="store_true", help="Fetch the lists now instead of waiting for the TTL")
+    parser.add_argument("--probe", action="store_true",
+                        help="Probe chat models for capabilities the lists don't state (billed requests)")
+    parser.add_argument("--json", action="store_true", help="Print the entries as JSON")
+    parser.add_argument("--path", default=os.getenv("MODEL_CATALOG_PATH", DEFAULT_CATALOG_PATH))
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    catalog = ModelCatalog(path=args.path, ttl=float(os.getenv("MODEL_CATALOG_TTL", DEFAULT_TTL)), probe=args.probe)
+    listing = {}
+    for provider in args.providers:
+        client = catalog_client(provider)
+        models = catalog.models(provider, client, refresh=args.refresh)
+        if models is None:
+            print(f"{provider}: no model list (missing API key or the fetch failed)", file=sys.stderr)
+            continue
+        if catalog.probe and client is not None:
+            for model_id, entry in models.items():
+                for capability in CAPABILITIES:
+                    if entry["chat"] and entry[capability] is None:
+                        catalog.supports(provider, model_id, capability, client)
+        listing[provider] = models
+
+    if args.json:
+        print(json.dumps(listing, indent=2, sort_keys=True))
+        return
+    for provider, models in listing.items():
+        print(f"{provider}:")
+        for model_id, entry in sorted(models.items()):
+            context = entry["context_window"] or "?"
+            state = "" if entry["active"] else "  (inactive)"
+            kind = "" if entry["chat"] else "  (not chat)"
+            print(f"  {model_id:<50} ctx {context:>7}  vision {_flag(entry['vision']):<3}  "
+                  f"json {_flag(entry['json_mode']):<3}{state}{kind}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import os
+import sys
+import numpy as np
+import PIL.Image
+from image_prep import ImagePreprocessor
+from result_cache import fingerprint
+
+# Edge the gutter search runs at; thin gutters still span a pixel or two here
+ANALYSIS_EDGE = 768
+# A row/column counts as gutter when its grey levels vary less than this
+GUTTER_STD = 8.0
+# Gutters must be at least this many analysis pixels wide
+MIN_GUTTER = 2
+# Every panel must cover at least this share of the region it was split from
+MIN_PANEL_FRACTION = 0.12
+# Flat edges wider than this share are background, not a margin around the collage
+MAX_MARGIN_FRACTION = 0.08
+# At least this share of each panel's rows/columns must have detail; a mostly flat
+# "panel" means the gutter was a stripe of sky or backdrop inside one photo
+MIN_CONTENT_FRACTION = 0.5
+# Splits nest at most this deep (rows -> columns -> rows)
+MAX_DEPTH = 3
+# Beyond this it's a contact sheet; one call on the whole image is cheaper
+MAX_PANELS = 12
+# Panels are small to begin with, and each one gets its own vision call
+DEFAULT_PANEL_EDGE = 512
+
+
+class Panel:
+    """One cell of a collage: its box in the source image and where it sits in the layout."""
+
+    def __init__(self, box, row, column, columns):
+        self.box = box
+        self.row = row
+        self.column = column
+        self.columns = columns
+
+    def position(self, rows, size):
+        """Human layout label such as "row 1, panel 2 of 3 (top-right)"."""
+        left, top, right, bottom = self.box
+        across = _third((left + right) / 2 / size[0], ("left", "center", "right"))
+        down = _third((top + bottom) / 2 / size[1], ("top", "middle", "bottom"))
+        where = "center" if (down, across) == ("middle", "center") else f"{down}-{across}"
+        if rows == 1:
+            return f"panel {self.column + 1} of {self.columns} ({where})"
+        return f"row {self.row + 1}, panel {self.column + 1} of {self.columns} ({where})"
+
+    def __repr__(self):
+        return f"Panel({self.box}, row={self.row}, column={self.column})"
+
+
+def _third(value, names):
+    return names[min(2, int(value * 3))]
+
+
+class PanelDetector:
+    """
+    Splits collages and grids into panels by finding gutters: full-width or
+    full-height bands of near-uniform colour between content. Regions are cut
+    recursively (rows, then columns within each row, and so on), so uneven
+    comic-style layouts work as well as regular grids. Outer margins are
+    ignored, and a split is only accepted when every piece is a reasonable
+    size, so ordinary photos come back as no panels.
+    """
+
+    def __init__(self, panel_edge=None, gutter_std=GUTTER_STD, max_panels=MAX_PANELS):
+        self.panel_edge = int(panel_edge or os.getenv("PANEL_MAX_EDGE", DEFAULT_PANEL_EDGE))
+        self.gutter_std = gutter_std
+        self.max_panels = max_panels
+
+    def fingerprint(self):
+        """Settings that change what the vision model sees, for use in cache keys."""
+        return fingerprint("panels", ANALYSIS_EDGE, self.gutter_std, MIN_GUTTER, MIN_PANEL_FRACTION,
+                           MAX_MARGIN_FRACTION, MIN_CONTENT_FRACTION, MAX_DEPTH, self.max_panels, self.panel_edge)
+
+    def detect(self, image):
+        """
+        Panels of a decoded PIL image in reading order, or [] when it isn't a
+        collage (or has more than max_panels cells).
+        """
+        grey = image.convert("L")
+        grey.thumbnail((ANALYSIS_EDGE, ANALYSIS_EDGE), PIL.Image.BILINEAR)
+        pixels = np.asarray(grey, dtype=np.float32)
+        boxes = self._split(pixels, 0, 0, axis=0, depth=0, retried=False)
+        if len(boxes) < 2 or len(boxes) > self.max_panels:
+            return []
+
+        scale_x = image.size[0] / pixels.shape[1]
+        scale_y = image.size[1] / pixels.shape[0]
+        boxes = [
+            (round(left * scale_x), round(top * scale_y), round(right * scale_x), round(bottom * scale_y))
+            for left, top, right, bottom in boxes
+        ]
+        return _arrange(boxes)
+
+    def prepare(self, image, panels, preprocessor):
+        """PreparedImage per panel, encoded like `preprocessor` but no larger than panel_edge."""
+        edge = min(self.panel_edge, preprocessor.max_edge)
+        panel_preprocessor = ImagePreprocessor(max_edge=edge, image_format=preprocessor.image_format,
+                                               quality=preprocessor.quality)
+        return [panel_preprocessor.encode(image.crop(panel.box)) for panel in panels]
+
+    def _split(self, pixels, x0, y0, axis, depth, retried):
+        """Boxes (left, top, right, bottom) of the content in `pixels`, offset by x0/y0."""
+        segments = self._segments(pixels, axis)
+        if not segments:
+            return []
+        if len(segments) == 1:
+            start, end = segments[0]
+            if retried or depth >= MAX_DEPTH:
+                return [self._box(x0, y0, axis, start, end, pixels.shape)]
+            # No gutter this way; try the other direction once before calling it a panel
+            inner = pixels[start:end] if axis == 0 else pixels[:, start:end]
+            offset_x, offset_y = (x0, y0 + start) if axis == 0 else (x0 + start, y0)
+            return self._split(inner, offset_x, offset_y, 1 - axis, depth, True)
+
+        boxes = []
+        for start, end in segments:
+            inner = pixels[start:end] if axis == 0 else pixels[:, start:end]
+            offset_x, offset_y = (x0, y0 + start) if axis == 0 else (x0 + start, y0)
+            boxes.extend(self._split(inner, offset_x, offset_y, 1 - axis, depth + 1, False))
+        return boxes
+
+    @staticmethod
+    def _box(x0, y0, axis, start, end, shape):
+        if axis == 0:
+            return (x0, y0 + start, x0 + shape[1], y0 + end)
+        return (x0 + start, y0, x0 + end, y0 + shape[0])
+
+    def _segments(self, pixels, axis):
+        """(start, end) content runs along `axis` (0 = rows) separated by gutters, margins trimmed."""
+        lines = pixels if axis == 0 else pixels.T
+        flat = lines.std(axis=1) < self.gutter_std
+        content = np.flatnonzero(~flat)
+        if content.size == 0:
+            return []
+        first, last = content[0], content[-1] + 1
+        if first > MAX_MARGIN_FRACTION * len(flat):
+            first = 0
+        if len(flat) - last > MAX_MARGIN_FRACTION * len(flat):
+            last = len(flat)
+
+        segments = []
+        start = first
+        position = first
+        while position < last:
+            if not flat[position]:
+                position += 1
+                continue
+            end = position
+            while end < last and flat[end]:
+                end += 1
+            # A real gutter is thick enough and one colour throughout, not just flat rows of a
+            # gradient; its outer rows are blended with the content by resampling, so skip them
+            means = lines[position:end].mean(axis=1)
+            core = means[1:-1] if len(means) > 2 else means
+            if end - position >= MIN_GUTTER and np.ptp(core) < self.gutter_std:
+                segments.append((start, position))
+                start = end
+            position = end
+        segments.append((start, last))
+
+        length = last - first
+        if len(segments) > 1 and any(
+            # A sliver (caption strip, border detail) means this isn't a clean split
+            end - start < MIN_PANEL_FRACTION * length
+            or np.count_nonzero(~flat[start:end]) < MIN_CONTENT_FRACTION * (end - start)
+            for start, end in segments
+        ):
+            return [(first, last)]
+        return segments
+
+
+def _arrange(boxes):
+    """Panels in reading order, grouped into rows by vertical overlap."""
+    rows = []
+    for box in sorted(boxes, key=lambda box: (box[1], box[0])):
+        middle = (box[1] + box[3]) / 2
+        for row in rows:
+            if row[0][1] <= middle < row[0][3]:
+                row.append(box)
+                break
+        else:
+            rows.append([box])
+
+    panels = []
+    for row_index, row in enumerate(rows):
+        row.sort(key=lambda box: box[0])
+        for column, box in enumerate(row):
+            panels.append(Panel(box, row_index, column, len(row)))
+    return panels
+
+
+def layout_summary(panels):
+    """e.g. "4 panels in 2 rows (2 + 2)"."""
+    rows = max(panel.row for panel in panels) + 1
+    counts = [sum(1 for panel in panels if panel.row == row) for row in range(rows)]
+    if rows == 1:
+        return f"{len(panels)} panels side by side"
+    return f"{len(panels)} panels in {rows} rows ({' + '.join(str(count) for count in counts)})"
+
+
+def default_panel_detector():
+    """PanelDetector unless COLLAGE_SPLIT is 0/false/off."""
+    if os.getenv("COLLAGE_SPLIT", "1").strip().lower() in ("0", "false", "off", "no"):
+        return None
+    return PanelDetector()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python panels.py <path_to_image> [...]")
+        sys.exit(1)
+
+    detector = PanelDetector()
+    for path in sys.argv[1:]:
+        image = PIL.Image.open(path)
+        panels = detector.detect(image)
+        if not panels:
+            print(f"{path}: not a collage")
+            continue
+        rows = panels[-1].row + 1
+        print(f"{path}: {layout_summary(panels)}")
+        for number, panel in enumerate(panels, 1):
+            print(f"  {number}. {panel.position(rows, image.size)} {panel.box}")
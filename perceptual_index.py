@@ -0,0 +1,267 @@
+import io
+import os
+import sys
+import time
+import sqlite3
+import threading
+from functools import lru_cache
+from itertools import combinations
+import numpy as np
+import PIL.Image
+import PIL.ImageOps
+
+DEFAULT_INDEX_PATH = os.path.join(".cache", "phash.sqlite3")
+# Re-saves, resizes and recompressions land within a few bits; different photos sit around 32
+DEFAULT_THRESHOLD = 6
+DEFAULT_DHASH_THRESHOLD = 10
+DEFAULT_TTL = 7 * 24 * 3600
+
+HASH_SIZE = 8
+PHASH_SCALE = 4
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+
+
+_DCT = _dct_matrix(HASH_SIZE * PHASH_SCALE)
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def load_gray(data):
+    """Decode image bytes to an upright grayscale image, cheaply (JPEGs decode at reduced scale)."""
+    try:
+        image = PIL.Image.open(io.BytesIO(data))
+        image.draft("L", (HASH_SIZE * PHASH_SCALE * 2, HASH_SIZE * PHASH_SCALE * 2))
+        image = PIL.ImageOps.exif_transpose(image)
+    except PIL.UnidentifiedImageError as e:
+        raise ValueError(f"Could not decode image: {e}") from e
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white, as the preprocessor does
+        image = image.convert("RGBA")
+        background = PIL.Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = PIL.Image.alpha_composite(background, image)
+    return image.convert("L")
+
+
+def phash(image):
+    """64-bit DCT perceptual hash: low frequencies of a 32x32 thumbnail against their median."""
+    size = HASH_SIZE * PHASH_SCALE
+    pixels = np.asarray(image.resize((size, size), PIL.Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term is just overall brightness; leave it out of the median
+    median = np.median(low.flatten()[1:])
+    return _bits_to_int(low > median)
+
+
+def dhash(image):
+    """64-bit difference hash: brightness gradient between horizontal neighbours."""
+    pixels = np.asarray(image.resize((HASH_SIZE + 1, HASH_SIZE), PIL.Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def image_hashes(data):
+    """(phash, dhash) of raw image bytes."""
+    image = load_gray(data)
+    return phash(image), dhash(image)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(width, radius):
+    """Every XOR mask of at most `radius` set bits within `width` bits."""
+    masks = [0]
+    for flips in range(1, radius + 1):
+        for positions in combinations(range(width), flips):
+            masks.append(sum(1 << position for position in positions))
+    return tuple(masks)
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over 64-bit hashes under Hamming distance.
+
+    Each hash is split into `chunks` substrings with one exact-match table per
+    substring. Two hashes within r bits differ by at most r // chunks bits in at
+    least one substring (pigeonhole), so a query only probes those small
+    neighbourhoods and verifies the few candidates it finds there.
+    """
+
+    def __init__(self, bits=64, chunks=4):
+        self.chunks = chunks
+        self.width = bits // chunks
+        self.mask = (1 << self.width) - 1
+        self.tables = [{} for _ in range(chunks)]
+        self.size = 0
+
+    def _parts(self, value):
+        return [(value >> (index * self.width)) & self.mask for index in range(self.chunks)]
+
+    def add(self, value, item):
+        entry = (value, item)
+        for table, part in zip(self.tables, self._parts(value)):
+            table.setdefault(part, []).append(entry)
+        self.size += 1
+
+    def search(self, value, radius):
+        """(distance, item) pairs within `radius` of `value`, nearest first."""
+        masks = _flip_masks(self.width, radius // self.chunks)
+        seen = set()
+        found = []
+        for table, part in zip(self.tables, self._parts(value)):
+            for mask in masks:
+                for entry in table.get(part ^ mask, ()):
+                    if id(entry) in seen:
+                        continue
+                    seen.add(id(entry))
+                    distance = hamming(value, entry[0])
+                    if distance <= radius:
+                        found.append((distance, entry[1]))
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class PerceptualIndex:
+    """
+    Persistent near-duplicate index: perceptual hashes of processed images,
+    pointing at the ResultCache key that holds each image's result.
+
+    Entries are grouped by namespace (the pipeline or prompt configuration) so a
+    near-duplicate only reuses a result produced with the same settings. A match
+    needs pHash within `threshold` bits and dHash within `dhash_threshold` bits.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, threshold=DEFAULT_THRESHOLD,
+                 dhash_threshold=DEFAULT_DHASH_THRESHOLD, ttl=DEFAULT_TTL):
+        self.path = path
+        self.threshold = threshold
+        self.dhash_threshold = dhash_threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Hashes are stored as hex: they use all 64 bits and SQLite integers are signed
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " namespace TEXT NOT NULL,"
+            " phash TEXT NOT NULL,"
+            " dhash TEXT NOT NULL,"
+            " result_key TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " PRIMARY KEY (namespace, result_key))"
+        )
+        if self.ttl:
+            self._conn.execute("DELETE FROM hashes WHERE created < ?", (time.time() - self.ttl,))
+        self._conn.commit()
+        for namespace, phash_hex, dhash_hex, result_key in self._conn.execute(
+            "SELECT namespace, phash, dhash, result_key FROM hashes"
+        ):
+            self._namespace_index(namespace).add(int(phash_hex, 16), (int(dhash_hex, 16), result_key))
+
+    def _namespace_index(self, namespace):
+        index = self._indexes.get(namespace)
+        if index is None:
+            index = self._indexes[namespace] = MultiIndexHash()
+        return index
+
+    def lookup(self, namespace, hashes):
+        """Result keys of near-duplicates as (distance, result_key), nearest first."""
+        image_phash, image_dhash = hashes
+        with self._lock:
+            index = self._indexes.get(namespace)
+            candidates = index.search(image_phash, self.threshold) if index else []
+        matches = [(distance, result_key) for distance, (other_dhash, result_key) in candidates
+                   if hamming(image_dhash, other_dhash) <= self.dhash_threshold]
+        return matches
+
+    def find(self, namespace, hashes, cache):
+        """
+        Stored result of the nearest near-duplicate still present in `cache`.
+        Returns (result, distance), or (None, None) on a miss.
+        """
+        for distance, result_key in self.lookup(namespace, hashes):
+            result = cache.get(result_key)
+            if result is not None:
+                self.hits += 1
+                return result, distance
+        self.misses += 1
+        return None, None
+
+    def add(self, namespace, hashes, result_key):
+        image_phash, image_dhash = hashes
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO hashes (namespace, phash, dhash, result_key, created) VALUES (?, ?, ?, ?, ?)",
+                (namespace, f"{image_phash:016x}", f"{image_dhash:016x}", result_key, time.time()),
+            )
+            self._conn.commit()
+            if cursor.rowcount:
+                self._namespace_index(namespace).add(image_phash, (image_dhash, result_key))
+
+    def stats(self):
+        with self._lock:
+            entries = sum(index.size for index in self._indexes.values())
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "namespaces": len(self._indexes),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_index = None
+_default_lock = threading.Lock()
+
+
+def default_index():
+    """Process-wide index configured from PHASH_INDEX_PATH, PHASH_THRESHOLD and PHASH_DHASH_THRESHOLD."""
+    global _default_index
+    with _default_lock:
+        if _default_index is None:
+            _default_index = PerceptualIndex(
+                path=os.getenv("PHASH_INDEX_PATH", DEFAULT_INDEX_PATH),
+                threshold=int(os.getenv("PHASH_THRESHOLD", DEFAULT_THRESHOLD)),
+                dhash_threshold=int(os.getenv("PHASH_DHASH_THRESHOLD", DEFAULT_DHASH_THRESHOLD)),
+                ttl=float(os.getenv("PROMPT_CACHE_TTL", DEFAULT_TTL)),
+            )
+        return _default_index
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python perceptual_index.py <image> [<image> ...]")
+        sys.exit(1)
+
+    hashed = []
+    for path in sys.argv[1:]:
+        with open(path, "rb") as image_file:
+            started = time.perf_counter()
+            hashes = image_hashes(image_file.read())
+            elapsed = (time.perf_counter() - started) * 1000
+        hashed.append((path, hashes))
+        print(f"{path}: phash {hashes[0]:016x} dhash {hashes[1]:016x} ({elapsed:.1f} ms)")
+    for (path_a, hashes_a), (path_b, hashes_b) in zip(hashed, hashed[1:]):
+        print(f"{path_a} vs {path_b}: phash {hamming(hashes_a[0], hashes_b[0])} bits, "
+              f"dhash {hamming(hashes_a[1], hashes_b[1])} bits")
@@ -0,0 +1,132 @@
+import time
+import inspect
+from result_cache import sha256_bytes, fingerprint
+from telemetry import stage_context, trace_stage
+
+
+class Stage:
+    """
+    One node of the agent DAG.
+
+    `run` receives the outputs of `inputs` positionally and returns text. The
+    model, temperature and prompt text make up the stage's version: changing
+    any of them invalidates this stage and, through the input hashes, every
+    stage downstream of it.
+    """
+
+    def __init__(self, name, run, inputs=(), model=None, temperature=None, prompt="", label=None, stream=False):
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.model = model
+        self.temperature = temperature
+        self.prompt = prompt
+        self.label = label or name
+        # Streaming stages accept an on_partial(text) keyword argument
+        self.stream = stream
+
+    def fingerprint(self):
+        return fingerprint(self.name, self.model, self.temperature, sha256_bytes(self.prompt.encode("utf-8")))
+
+    def cache_key(self, input_digests):
+        return fingerprint("stage", self.fingerprint(), list(input_digests))
+
+
+class StagePipeline:
+    """
+    Executes stages in dependency order, memoizing each stage's output in a ResultCache.
+
+    Stage timings and the LLM calls made inside each stage go to the current
+    telemetry.run_trace, when there is one.
+    """
+
+    def __init__(self, stages, cache=None, read_only=False):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique.")
+        self.cache = cache
+        # Look stages up in the cache but never store new outputs
+        self.read_only = read_only
+
+    def order(self, sources=()):
+        """Topological order of the stages; `sources` are the externally supplied input names."""
+        known = set(sources)
+        pending = list(self.stages.values())
+        ordered = []
+        while pending:
+            ready = [stage for stage in pending if all(name in known for name in stage.inputs)]
+            if not ready:
+                missing = {name for stage in pending for name in stage.inputs if name not in known}
+                raise ValueError(f"Unresolvable stage inputs (cycle or missing source): {sorted(missing)}")
+            for stage in ready:
+                ordered.append(stage)
+                known.add(stage.name)
+                pending.remove(stage)
+        return ordered
+
+    def fingerprint(self, sources=()):
+        return fingerprint([(stage.name, stage.inputs, stage.fingerprint()) for stage in self.order(sources)])
+
+    def run(self, sources, status_callback=None):
+        """
+        Run every stage.
+
+        `sources` maps input names to (value, digest) pairs; the digest stands in
+        for the value in cache keys so large payloads such as images are hashed once.
+        Returns a dict of every source and stage output by name.
+        """
+        values = {name: value for name, (value, _) in sources.items()}
+        digests = {name: digest for name, (_, digest) in sources.items()}
+
+        for stage in self.order(sources):
+            started = time.perf_counter()
+            key, output = self._lookup(stage, digests, status_callback)
+            cached = output is not None
+            if not cached:
+                with stage_context(stage.name):
+                    output = stage.run(*(values[name] for name in stage.inputs), **self._stream_kwargs(stage, status_callback))
+                self._store(key, output)
+            trace_stage(stage.name, time.perf_counter() - started, cached)
+            values[stage.name] = output
+            digests[stage.name] = sha256_bytes(output.encode("utf-8"))
+        return values
+
+    async def arun(self, sources, status_callback=None):
+        """Same as run, for stages whose `run` returns an awaitable."""
+        values = {name: value for name, (value, _) in sources.items()}
+        digests = {name: digest for name, (_, digest) in sources.items()}
+
+        for stage in self.order(sources):
+            started = time.perf_counter()
+            key, output = self._lookup(stage, digests, status_callback)
+            cached = output is not None
+            if not cached:
+                with stage_context(stage.name):
+                    output = stage.run(*(values[name] for name in stage.inputs), **self._stream_kwargs(stage, status_callback))
+                    if inspect.isawaitable(output):
+                        output = await output
+                self._store(key, output)
+            trace_stage(stage.name, time.perf_counter() - started, cached)
+            values[stage.name] = output
+            digests[stage.name] = sha256_bytes(output.encode("utf-8"))
+        return values
+
+    def _lookup(self, stage, digests, status_callback):
+        key = stage.cache_key(digests[name] for name in stage.inputs)
+        output = self.cache.get(key) if self.cache is not None else None
+        if status_callback:
+            if output is None:
+                status_callback(stage.label, stage.name)
+            else:
+                status_callback(f"{stage.label} (cached)", stage.name)
+        return key, output
+
+    @staticmethod
+    def _stream_kwargs(stage, status_callback):
+        if not (stage.stream and status_callback):
+            return {}
+        return {"on_partial": lambda text: status_callback(stage.label, stage.name, text)}
+
+    def _store(self, key, output):
+        if self.cache is not None and not self.read_only:
+            self.cache.put(key, output)
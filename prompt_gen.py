@@ -1,13 +1,41 @@
 import os
 import sys
-import base64
-from groq import Groq
+import json
+import time
+import sqlite3
+import threading
+import contextvars
+import groq
+from concurrent.futures import ThreadPoolExecutor
+from client_pool import get_client
+from key_pool import default_key_pool
+from rate_limiter import estimate_tokens, error_headers
 from dotenv import load_dotenv
-import PIL.Image
+from result_cache import sha256_bytes, fingerprint, default_cache
+from image_prep import ImagePreprocessor
+from ip_guard import default_detector, face_hair_detector, guarded_scrub, guarded_scrub_many, FRAGMENT_INSTRUCTIONS
+from telemetry import CallMetrics
+from perceptual_index import default_index, image_hashes
+from history import default_history
+from model_catalog import default_catalog, catalog_client
 
 # Load environment variables
 load_dotenv()
 
+VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct" # Optimized Llama 4 Vision model for forensic accuracy
+VISION_TEMPERATURE = 0.05 # Near-zero temperature for absolute objective precision
+GUARDIAN_MODEL = "llama-3.3-70b-versatile"
+GUARDIAN_TEMPERATURE = 0.1
+# generate_prompts writes each mode from the shared description with a text model
+RENDER_MODEL = "llama-3.3-70b-versatile"
+RENDER_TEMPERATURE = 0.2
+# Tries per chat call (at least one per pooled key) and the first backoff after a 5xx
+CHAT_ATTEMPTS = 3
+CHAT_BACKOFF = 0.5
+
+# Which of the models above each role needs: (model, needs vision)
+STAGE_MODELS = {"vision": (VISION_MODEL, True), "guardian": (GUARDIAN_MODEL, False), "render": (RENDER_MODEL, False)}
+
 # STRICT COPYRIGHT SAFETY RULES (USER MANDATE)
 COPYRIGHT_SAFETY_RULES = """
 CRITICAL LEGAL REQUIREMENT:
@@ -77,15 +105,7 @@ A seamless artistic description followed by the generation prompt. No technical
 """
 }
 
-def copyright_guardian(text):
-    """
-    Uses Llama 3 70B to audit the prompt for copyright infringement and
-    ensure facial/hair details are minimized in favor of costume/environmental micro-details.
-    """
-    api_key = os.getenv("GROQ_API_KEY")
-    client = Groq(api_key=api_key)
-    
-    guardian_system = """
+GUARDIAN_SYSTEM_PROMPT = """
     You are a STRICT Copyright Compliance Officer and Detail Architect.
     
     **YOUR MANDATE**:
@@ -97,77 +117,400 @@ def copyright_guardian(text):
     3. **FACE/HAIR REDACTION**: The user explicitly wants "minute details EXCLUDING facial/hair". Redact any mention of "blue eyes", "scar on cheek", "messy bun". Keep it generic: "face obscured by helmet/shadow" or "neutral expression".
     4. **OUTPUT**: Return the rewritten, safe, high-detail prompt. Do not output anything else.
     """
-    
+
+# One vision pass for generate_prompts; every mode is written from this description
+EXTRACTION_SYSTEM_PROMPT = """
+SYSTEM ROLE:
+You are a Forensic Visual Extraction Engine. Your description is the ONLY view of this image that later writers get, so capture everything they could need with microscopic precision.
+
+**RULES**:
+- Describe logos, emblems, symbols and patterns by shape, colour and placement. NEVER name characters, franchises or brands.
+- Do NOT describe facial features or hair beyond a few generic words.
+
+**OUTPUT FORMAT**:
+Return ONLY a JSON object with these string keys:
+- "subject": pose, exact joint angles, body mechanics, build and physical presence.
+- "costume": every garment and accessory: cut, material, weave, stitching, scratches, weathering, colours.
+- "markings": logos, emblems, symbols and patterns, described generically.
+- "environment": setting, background elements, atmosphere, particles.
+- "lighting": sources, direction, quality, colour temperature, reflections.
+- "optics": framing, camera angle, lens, depth of field, bokeh, colour grading.
+- "mood": tone, aura and cinematic resonance.
+"""
+
+# Tells a PROMPT_MODES system prompt that it gets the description instead of the image
+RENDER_INPUT_NOTE = """
+**INPUT**: Instead of the image you receive a structured forensic description of it (JSON). Treat it as the image itself: use everything it states and invent nothing that contradicts it.
+"""
+
+# Fidelity Lock Header (Modified for Body/Costume priority)
+FIDELITY_LOCK = "**COPYRIGHT NEUTRALIZED & DETAILED**\n*Face/Hair redacted | Background & Pose prioritized*\n\n"
+
+def render_system_prompt(mode):
+    return PROMPT_MODES[mode] + RENDER_INPUT_NOTE
+
+def copyright_guardian(text):
+    """
+    Uses Llama 3 70B to audit the prompt for copyright infringement and
+    ensure facial/hair details are minimized in favor of costume/environmental micro-details.
+    """
+    return _guard_or_fallback(_guard, text)[0]
+
+def _guard_or_fallback(guard, value):
+    """(guard(value), True), or (value, False) when the guardian fails; only guarded results may be stored."""
     try:
-        completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": guardian_system},
-                {"role": "user", "content": f"SANITIZE AND ENHANCE this prompt:\n\n{text}"}
-            ],
-            model="llama-3.3-70b-versatile",
-            temperature=0.1
-        )
-        return completion.choices[0].message.content.strip()
+        return guard(value), True
     except Exception as e:
         print(f"GUARDIAN ERROR: {e}") # Log error for debugging
-        return text # Fallback to original if Guardian fails
+        return value, False # Fallback to original if Guardian fails
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def _guard(text):
+    """
+    Lexicon-gated guardian: clean text skips the LLM, flagged text sends only the
+    affected sentences. Sentences describing face or hair count as flagged, since
+    the guardian redacts those too (FIDELITY_LOCK promises it).
+    Raises on API errors so callers can decide how to degrade.
+    """
+    result, _ = guarded_scrub(default_detector(), text, _run_guardian, _run_guardian_fragments,
+                              redact=face_hair_detector())
+    return result
+
+def _guard_many(texts):
+    """_guard for several texts, sharing one guardian call for all their flagged sentences."""
+    scrubbed = guarded_scrub_many(default_detector(), texts, _run_guardian, _run_guardian_fragments,
+                                  redact=face_hair_detector())
+    return [result for result, _ in scrubbed]
+
+def _run_guardian(text):
+    """Single guardian call over the whole text."""
+    return _guardian_call(f"SANITIZE AND ENHANCE this prompt:\n\n{text}")
+
+def _run_guardian_fragments(numbered_sentences):
+    return _guardian_call(f"{FRAGMENT_INSTRUCTIONS}\n\n{numbered_sentences}")
 
-def generate_prompt(image_path, mode="Human-Aesthetic Narrative"):
-    api_key = os.getenv("GROQ_API_KEY")
-    if not api_key:
-        raise ValueError("GROQ_API_KEY not found in environment variables.")
+def _guardian_call(user_content):
+    completion = _chat(stage_model("guardian"), [
+        {"role": "system", "content": GUARDIAN_SYSTEM_PROMPT},
+        {"role": "user", "content": user_content}
+    ], GUARDIAN_TEMPERATURE, stage="guardian")
+    return completion.choices[0].message.content.strip()
+
+_resolved_models = {}
+_resolved_lock = threading.Lock()
+
+def stage_model(role):
+    """
+    The model for `role` in STAGE_MODELS, swapped for a listed one if the model
+    catalog (see model_catalog) says it is retired or can't take images.
+    Resolved once per process, so calls never wait on the catalog.
+    """
+    with _resolved_lock:
+        if role not in _resolved_models:
+            model, vision = STAGE_MODELS[role]
+            catalog = default_catalog()
+            if catalog:
+                model = catalog.resolve("groq", model, catalog_client("groq"), vision=vision)
+            _resolved_models[role] = model
+        return _resolved_models[role]
 
-    client = Groq(api_key=api_key)
-    base64_image = encode_image(image_path)
+def _chat(model, messages, temperature, stage):
+    """
+    One chat completion through the key pool: sent on the key with the most
+    budget left for `model`, and moved to another key if that one is rate
+    limited or rejected. 429s, 5xx and dropped connections get CHAT_ATTEMPTS
+    tries (the pooled clients don't retry on their own).
+    """
+    pool = default_key_pool()
+    estimate = estimate_tokens(messages)
+    attempts = max(len(pool), CHAT_ATTEMPTS)
+    rejected = 0
+    with CallMetrics(model, stage=stage) as metrics:
+        for attempt in range(attempts):
+            key = pool.choose(model, estimate)
+            limiter = pool.limiter(key, model)
+            metrics.waited(limiter.acquire(estimate))
+            try:
+                raw = get_client(key.secret).chat.completions.with_raw_response.create(
+                    messages=messages,
+                    model=model,
+                    temperature=temperature,
+                )
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                if attempt == attempts - 1:
+                    raise
+                if status == 429:
+                    # The next acquire() on this key waits out the retry-after
+                    limiter.penalize(error_headers(e))
+                elif status in (401, 403) and rejected < len(pool) - 1:
+                    pool.bench(limiter)
+                    rejected += 1
+                elif isinstance(e, groq.APIConnectionError) or (status is not None and status >= 500):
+                    time.sleep(CHAT_BACKOFF * 2 ** attempt)
+                else:
+                    raise
+                metrics.retry()
+                continue
+            limiter.update_from_headers(raw.headers)
+            completion = raw.parse()
+            if completion.usage is not None:
+                limiter.record_usage(estimate, completion.usage.total_tokens)
+            metrics.usage(completion.usage)
+            return completion
+
+def encode_image(image, preprocessor=None):
+    preprocessor = preprocessor or ImagePreprocessor()
+    return preprocessor.prepare(preprocessor.load(image)).base64()
+
+def _prompt_settings(mode, preprocessor):
+    """Everything besides the image that shapes a generate_prompt result."""
+    system_instruction = PROMPT_MODES.get(mode, PROMPT_MODES["Human-Aesthetic Narrative"])
+    return [
+        preprocessor.fingerprint(),
+        [stage_model("vision"), stage_model("guardian")],
+        [VISION_TEMPERATURE, GUARDIAN_TEMPERATURE],
+        fingerprint(system_instruction, GUARDIAN_SYSTEM_PROMPT, FIDELITY_LOCK),
+        default_detector().fingerprint(),
+        face_hair_detector().fingerprint(),
+    ]
+
+def prompt_cache_key(image_bytes, mode, preprocessor=None):
+    """Content address for generate_prompt: image digest plus models, temperatures and prompt versions."""
+    preprocessor = preprocessor or ImagePreprocessor()
+    return fingerprint("generate_prompt", sha256_bytes(image_bytes), *_prompt_settings(mode, preprocessor))
+
+def prompt_namespace(mode, preprocessor=None):
+    """Near-duplicate namespace: results are only shared between identical settings."""
+    preprocessor = preprocessor or ImagePreprocessor()
+    return fingerprint("generate_prompt", *_prompt_settings(mode, preprocessor))
+
+def _record_history(history, cache, image_bytes, prompt, mode, stages, models, started, source=None):
+    """Log a fresh result in the prompt history (by default whenever a cache is in use)."""
+    if history is None and cache is not None:
+        history = default_history()
+    if not history:
+        return
+    try:
+        history.record(image_bytes, prompt, mode, stages, source=source, models=models,
+                       timings={"latency": time.perf_counter() - started})
+    except sqlite3.Error as e:
+        print(f"HISTORY ERROR: {e}")
+
+def _image_name(image):
+    return os.path.basename(image) if isinstance(image, (str, os.PathLike)) else None
+
+def generate_prompt(image, mode="Human-Aesthetic Narrative", cache=None, preprocessor=None, near_dup_index=None,
+                    history=None):
+    """
+    `image` is a path, bytes, a file-like object or a PIL image. With a cache, repeated images (and, through the perceptual-hash index,
+    re-saved or resized copies of them) return the stored prompt without any
+    API call. Pass near_dup_index=False to only reuse exact matches.
+    Fresh results go to the prompt history (history=False to skip it).
+    """
+    # Raises early when no key is configured
+    default_key_pool()
+
+    preprocessor = preprocessor or ImagePreprocessor()
+    image_bytes = preprocessor.load(image)
+    key = None
+    hashes = None
+    if cache is not None:
+        key = prompt_cache_key(image_bytes, mode, preprocessor)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        if near_dup_index is None:
+            near_dup_index = default_index()
+        if near_dup_index:
+            hashes = image_hashes(image_bytes)
+            cached, _ = near_dup_index.find(prompt_namespace(mode, preprocessor), hashes, cache)
+            if cached is not None:
+                cache.put(key, cached)
+                return cached
+
+    started = time.perf_counter()
+    prepared = preprocessor.prepare(image_bytes)
     
     # Use Human-Aesthetic Narrative as the primary fallback to avoid KeyErrors
     system_instruction = PROMPT_MODES.get(mode, PROMPT_MODES["Human-Aesthetic Narrative"])
 
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": system_instruction
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                        },
+    chat_completion = _chat(stage_model("vision"), [
+        {
+            "role": "system",
+            "content": system_instruction
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": prepared.data_url(),
                     },
-                ],
-            }
-        ],
-        model="meta-llama/llama-4-scout-17b-16e-instruct", # Optimized Llama 4 Vision model for forensic accuracy
-        temperature=0.05, # Near-zero temperature for absolute objective precision
-    )
+                },
+            ],
+        }
+    ], VISION_TEMPERATURE, stage="prompt_vision")
     
     raw_content = chat_completion.choices[0].message.content.strip()
     
     # RUN COPYRIGHT GUARDIAN
-    sanitized_content = copyright_guardian(raw_content)
+    sanitized_content, guarded = _guard_or_fallback(_guard, raw_content)
     
-    # Fidelity Lock Header (Modified for Body/Costume priority)
-    fidelity_lock = "**COPYRIGHT NEUTRALIZED & DETAILED**\n*Face/Hair redacted | Background & Pose prioritized*\n\n"
-    
-    return fidelity_lock + sanitized_content
+    result = FIDELITY_LOCK + sanitized_content
+    # Never persist an unguarded result (nor offer it for reuse from the history)
+    if guarded:
+        if key is not None:
+            cache.put(key, result)
+            if hashes is not None:
+                near_dup_index.add(prompt_namespace(mode, preprocessor), hashes, key)
+        _record_history(history, cache, image_bytes, result, mode,
+                        {"prompt_vision": raw_content, "guardian": sanitized_content},
+                        {"prompt_vision": [stage_model("vision")], "guardian": [stage_model("guardian")]},
+                        started, _image_name(image))
+    return result
+
+def _prompts_settings(mode, preprocessor):
+    """Everything besides the image that shapes one mode of a generate_prompts result."""
+    return [
+        preprocessor.fingerprint(),
+        [stage_model("vision"), stage_model("render"), stage_model("guardian")],
+        [VISION_TEMPERATURE, RENDER_TEMPERATURE, GUARDIAN_TEMPERATURE],
+        fingerprint(EXTRACTION_SYSTEM_PROMPT, render_system_prompt(mode), GUARDIAN_SYSTEM_PROMPT, FIDELITY_LOCK),
+        default_detector().fingerprint(),
+        face_hair_detector().fingerprint(),
+    ]
+
+def prompts_cache_key(image_bytes, mode, preprocessor=None):
+    """Content address of one mode of generate_prompts (a different pipeline from generate_prompt's)."""
+    preprocessor = preprocessor or ImagePreprocessor()
+    return fingerprint("generate_prompts", sha256_bytes(image_bytes), *_prompts_settings(mode, preprocessor))
+
+def prompts_namespace(mode, preprocessor=None):
+    preprocessor = preprocessor or ImagePreprocessor()
+    return fingerprint("generate_prompts", *_prompts_settings(mode, preprocessor))
+
+def describe_image(image_bytes, preprocessor=None, cache=None):
+    """
+    The structured vision pass behind generate_prompts: a JSON description
+    (pretty-printed, or the raw reply if it isn't valid JSON). Cached per image
+    so adding a mode later doesn't need the vision model again.
+    """
+    preprocessor = preprocessor or ImagePreprocessor()
+    key = None
+    if cache is not None:
+        key = fingerprint("describe_image", sha256_bytes(image_bytes), preprocessor.fingerprint(),
+                          stage_model("vision"), VISION_TEMPERATURE, EXTRACTION_SYSTEM_PROMPT)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    prepared = preprocessor.prepare(image_bytes)
+    completion = _chat(stage_model("vision"), [
+        {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": prepared.data_url()}}]},
+    ], VISION_TEMPERATURE, stage="prompt_vision")
+
+    description = _tidy_description(completion.choices[0].message.content)
+    if key is not None:
+        cache.put(key, description)
+    return description
+
+def _tidy_description(content):
+    content = content.strip()
+    start, end = content.find("{"), content.rfind("}")
+    if start != -1 and end > start:
+        try:
+            return json.dumps(json.loads(content[start:end + 1]), indent=2, ensure_ascii=False)
+        except ValueError:
+            pass
+    return content
+
+def _render_mode(description, mode):
+    """Write one PROMPT_MODES output from the shared description (text model, no image)."""
+    completion = _chat(stage_model("render"), [
+        {"role": "system", "content": render_system_prompt(mode)},
+        {"role": "user", "content": f"IMAGE DESCRIPTION:\n{description}"},
+    ], RENDER_TEMPERATURE, stage="prompt_render")
+    return completion.choices[0].message.content.strip()
+
+def generate_prompts(image, modes=None, cache=None, preprocessor=None, near_dup_index=None, history=None):
+    """
+    Several PROMPT_MODES outputs (all by default) for one image, as {mode: prompt}.
+
+    Instead of one generate_prompt per mode (a vision upload and a guardian pass
+    each), the image is described once by the vision model, every mode is
+    written from that description concurrently by a text model, and all drafts
+    share one batched guardian call. Caching works per mode as in generate_prompt.
+    """
+    default_key_pool()
+    modes = list(modes or PROMPT_MODES)
+    unknown = [mode for mode in modes if mode not in PROMPT_MODES]
+    if unknown:
+        raise ValueError(f"Unknown prompt modes: {unknown}")
+
+    preprocessor = preprocessor or ImagePreprocessor()
+    image_bytes = preprocessor.load(image)
+    results = {}
+    keys = {}
+    hashes = None
+    if cache is not None:
+        if near_dup_index is None:
+            near_dup_index = default_index()
+        for mode in modes:
+            keys[mode] = prompts_cache_key(image_bytes, mode, preprocessor)
+            cached = cache.get(keys[mode])
+            if cached is None and near_dup_index:
+                if hashes is None:
+                    hashes = image_hashes(image_bytes)
+                cached, _ = near_dup_index.find(prompts_namespace(mode, preprocessor), hashes, cache)
+                if cached is not None:
+                    cache.put(keys[mode], cached)
+            if cached is not None:
+                results[mode] = cached
+
+    missing = [mode for mode in modes if mode not in results]
+    if missing:
+        started = time.perf_counter()
+        description = describe_image(image_bytes, preprocessor, cache)
+        # Copy the caller's context so each render is still traced under its run
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, _render_mode, description, mode)
+                       for mode in missing]
+            drafts = [future.result() for future in futures]
+
+        sanitized, guarded = _guard_or_fallback(_guard_many, drafts)
+
+        for mode, draft, text in zip(missing, drafts, sanitized):
+            results[mode] = FIDELITY_LOCK + text
+            # Never persist an unguarded result (nor offer it for reuse from the history)
+            if not guarded:
+                continue
+            _record_history(history, cache, image_bytes, results[mode], mode,
+                            {"prompt_vision": description, "prompt_render": draft, "guardian": text},
+                            {"prompt_vision": [stage_model("vision")], "prompt_render": [stage_model("render")],
+                             "guardian": [stage_model("guardian")]},
+                            started, _image_name(image))
+            if mode in keys:
+                cache.put(keys[mode], results[mode])
+                if hashes is not None:
+                    near_dup_index.add(prompts_namespace(mode, preprocessor), hashes, keys[mode])
+    return {mode: results[mode] for mode in modes}
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python prompt_gen.py <path_to_image>")
+        print("Usage: python prompt_gen.py <path_to_image> [--all-modes]")
+        print("For folders or JSONL batches use: python batch_cli.py <glob|file.jsonl> -o results.jsonl")
         sys.exit(1)
         
     image_input = sys.argv[1]
     
     try:
-        result = generate_prompt(image_input)
+        if "--all-modes" in sys.argv[2:]:
+            prompts = generate_prompts(image_input, cache=default_cache())
+            result = "\n\n".join(f"### {mode}\n{prompt}" for mode, prompt in prompts.items())
+        else:
+            result = generate_prompt(image_input, cache=default_cache())
         print("\n" + "="*50)
         print("GENERATED PROMPTS (Groq)")
         print("="*50 + "\n")
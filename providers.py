@@ -0,0 +1,389 @@
+import os
+import time
+import threading
+from collections import deque
+from client_pool import get_openai_client, get_async_openai_client
+from rate_limiter import get_rate_limiter
+
+XAI_BASE_URL = "https://api.x.ai/v1"
+DEFAULT_XAI_TEXT_MODEL = "grok-3"
+DEFAULT_XAI_VISION_MODEL = "grok-2-vision-1212"
+
+# Weight of the newest sample in the latency / error-rate moving averages
+EWMA_ALPHA = 0.3
+# Circuit breaker: failures in a row that open it, and how long it stays open
+# (doubling, up to the max, each time a half-open probe fails)
+BREAKER_FAILURES = 3
+BREAKER_OPEN_FOR = 30.0
+BREAKER_MAX_OPEN_FOR = 600.0
+# How long a call would rather wait for a backend than drop to a lower tier (e.g. the fallback model)
+TIER_PATIENCE = 5.0
+# Latencies kept per backend for percentiles (hedging)
+RECENT_SAMPLES = 200
+# Output speed (tokens/s) assumed for a model until its calls have been measured
+TYPICAL_TOKENS_PER_SECOND = {
+    "llama-3.3-70b-versatile": 275.0,
+    "qwen/qwen3-32b": 400.0,
+    "meta-llama/llama-4-scout-17b-16e-instruct": 450.0,
+    "grok-3": 60.0,
+    "grok-2-vision-1212": 60.0,
+}
+DEFAULT_TOKENS_PER_SECOND = 100.0
+# Seconds before the first token, likewise
+DEFAULT_OVERHEAD = 0.5
+
+
+class Provider:
+    """
+    An OpenAI-compatible chat API. `client` is called on every use, so pooled
+    (and per-event-loop) clients are looked up lazily; `stream_params` are
+    extra request fields for streamed calls.
+
+    With a key_pool.KeyPool as `keys`, `client` is called with the API key to
+    use, and each attempt goes out on the pooled key with the most headroom.
+    """
+
+    def __init__(self, name, client, stream_params=None, keys=None):
+        self.name = name
+        self._client = client
+        self.stream_params = stream_params or {}
+        self.keys = keys
+
+    @property
+    def client(self):
+        return self._client()
+
+    def client_for(self, key):
+        return self._client(key.secret)
+
+
+class BackendHealth:
+    """
+    EWMA latency and error rate of one provider/model plus its circuit breaker,
+    shared process-wide.
+
+    The breaker opens after BREAKER_FAILURES failures in a row (429s included),
+    so later calls go straight to the next backend in their chain instead of
+    each rediscovering the outage. When the open period is over, one call is let
+    through as a probe (half-open): success closes the breaker, failure reopens
+    it for twice as long.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = None
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+        # EWMA output speed and time to first token, for deadline budgets
+        self.tokens_per_second = None
+        self.overhead = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.cooldown_until = 0.0
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.open_for = BREAKER_OPEN_FOR
+        self.reopen_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def success(self, seconds, completion_tokens=None, first_token=None):
+        """
+        Count a successful call. With its completion_tokens (and, for streams,
+        the seconds to first_token) the output speed is tracked too.
+        """
+        with self._lock:
+            self.calls += 1
+            self.recent.append(seconds)
+            self.latency = _ewma(self.latency, seconds)
+            if first_token is not None:
+                self.overhead = _ewma(self.overhead, first_token)
+            if completion_tokens:
+                # Without a first token time the overhead is counted as generation, which errs slow
+                generating = seconds - (first_token or 0.0)
+                if generating > 0:
+                    self.tokens_per_second = _ewma(self.tokens_per_second, completion_tokens / generating)
+            self.error_rate *= 1 - EWMA_ALPHA
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self.open_for = BREAKER_OPEN_FOR
+            self.probing = False
+
+    def failure(self, cooldown=0.0):
+        """Count a failed call; `cooldown` keeps the backend out of rotation (429 retry-after)."""
+        with self._lock:
+            now = time.monotonic()
+            self.calls += 1
+            self.errors += 1
+            self.error_rate += EWMA_ALPHA * (1 - self.error_rate)
+            self.consecutive_failures += 1
+            self.cooldown_until = max(self.cooldown_until, now + cooldown)
+            if self.state == self.HALF_OPEN:
+                self.open_for = min(BREAKER_MAX_OPEN_FOR, self.open_for * 2)
+                self._open(now)
+            elif self.state == self.CLOSED and self.consecutive_failures >= BREAKER_FAILURES:
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.probing = False
+        # A long retry-after (e.g. a spent daily quota) keeps it open longer
+        self.reopen_at = max(now + self.open_for, self.cooldown_until)
+
+    def available(self, now=None):
+        """False while the breaker is open, or half-open with its probe still out."""
+        now = time.monotonic() if now is None else now
+        if self.state == self.OPEN:
+            return now >= self.reopen_at
+        if self.state == self.HALF_OPEN:
+            return not self.probing
+        return True
+
+    def begin(self):
+        """
+        A request is going out; after an open period it becomes the half-open
+        probe. Returns True for the probe, whose caller must release() it if
+        the call ends without success() or failure().
+        """
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() >= self.reopen_at:
+                self.state = self.HALF_OPEN
+                self.probing = True
+                return True
+            return False
+
+    def release(self):
+        """
+        The probe ended with no verdict (cancelled hedge loser, abandoned stream,
+        bad request): back to open with the wait over, so the next call probes.
+        A no-op once success() or failure() has settled the breaker.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self.probing:
+                self.state = self.OPEN
+                self.probing = False
+                self.reopen_at = time.monotonic()
+
+    def cooling_for(self, now=None):
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.cooldown_until - now)
+
+    def percentile(self, q, min_samples=1):
+        """q-th percentile (0-100) of the recent latencies, or None with fewer than min_samples."""
+        with self._lock:
+            samples = sorted(self.recent)
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100.0))]
+
+    def forecast(self):
+        """(seconds before output starts, output tokens per second), measured or typical for the model."""
+        model = self.name.split("/", 1)[1]
+        overhead = DEFAULT_OVERHEAD if self.overhead is None else self.overhead
+        rate = self.tokens_per_second or TYPICAL_TOKENS_PER_SECOND.get(model, DEFAULT_TOKENS_PER_SECOND)
+        return overhead, rate
+
+    def expected_seconds(self, output_tokens):
+        """Forecast duration of a call writing `output_tokens`, inflated by the error rate."""
+        overhead, rate = self.forecast()
+        return (overhead + output_tokens / rate) * (1 + self.error_rate)
+
+    def expected_latency(self):
+        # Unmeasured backends look free so each one gets sampled early on
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + self.error_rate)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "latency": None if self.latency is None else round(self.latency, 3),
+                "tokens_per_second": None if self.tokens_per_second is None else round(self.tokens_per_second, 1),
+                "error_rate": round(self.error_rate, 3),
+                "calls": self.calls,
+                "errors": self.errors,
+                "cooling_for": round(self.cooling_for(), 3),
+                "breaker": self.state,
+                "consecutive_failures": self.consecutive_failures,
+            }
+
+
+def _ewma(current, sample):
+    if current is None:
+        return sample
+    return current + EWMA_ALPHA * (sample - current)
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def get_health(provider, model):
+    """Process-wide health for `provider`/`model`, shared by every engine, thread and task."""
+    name = f"{provider}/{model}"
+    with _health_lock:
+        health = _health.get(name)
+        if health is None:
+            health = _health[name] = BackendHealth(name)
+        return health
+
+
+def health_snapshot():
+    with _health_lock:
+        healths = list(_health.values())
+    return {health.name: health.snapshot() for health in healths}
+
+
+class Backend:
+    """One model on one provider."""
+
+    def __init__(self, provider, model):
+        self.provider = provider
+        self.model = model
+        self.name = f"{provider.name}/{model}"
+        self.health = get_health(provider.name, model)
+
+    def lease(self, tokens):
+        """(client, rate limiter) for the next attempt; a key pool lends out its roomiest key."""
+        keys = self.provider.keys
+        if keys is None:
+            return self.provider.client, get_rate_limiter(self.model)
+        key = keys.choose(self.model, tokens)
+        return self.provider.client_for(key), keys.limiter(key, self.model)
+
+    def expected_wait(self, tokens, now):
+        """Time before a call could go out: cooldown or the model's rate-limit queue (on its best key)."""
+        keys = self.provider.keys
+        if keys is None:
+            queued = get_rate_limiter(self.model).expected_wait(tokens)
+        else:
+            queued = keys.expected_wait(self.model, tokens)
+        return max(self.health.cooling_for(now), queued)
+
+    def __repr__(self):
+        return f"Backend({self.name})"
+
+
+class Router:
+    """
+    Picks the backend for each call from named routes.
+
+    A route is a list of tiers (the fallback chain), each a list of
+    interchangeable backends. Backends with an open circuit breaker are skipped.
+    Within a tier the backend with the lowest expected wait + EWMA latency
+    (inflated by its error rate) wins. A lower tier is only used when nothing
+    above it could start within TIER_PATIENCE seconds, so a rate-limited or
+    failing provider is swapped for an equivalent one first and for the
+    fallback model last. Names without a route go straight to `default` (the
+    Groq provider).
+
+    Under a deadline, pick() is given the call's output budget and time limit:
+    backends are then compared by forecast duration at their observed
+    tokens/second, and a tier is skipped when even its best backend can't
+    finish in time.
+    """
+
+    def __init__(self, default, patience=TIER_PATIENCE):
+        self.default = default
+        self.patience = patience
+        self.routes = {}
+
+    def add_route(self, name, *tiers):
+        self.routes[name] = [list(tier) for tier in tiers if tier]
+
+    def tiers(self, name):
+        tiers = self.routes.get(name)
+        if tiers is None:
+            tiers = self.routes[name] = [[Backend(self.default, name)]]
+        return tiers
+
+    def pick(self, name, tokens=0, exclude=(), output_tokens=None, time_limit=None):
+        """Best backend for a call on route `name`, or None once every one is excluded."""
+        now = time.monotonic()
+        tiers = self.tiers(name)
+        closed = [[backend for backend in tier if backend.health.available(now)] for tier in tiers]
+        # With every breaker open, trying something beats failing the call outright
+        if any(closed):
+            tiers = closed
+        waiting = None
+        for tier in tiers:
+            usable = [backend for backend in tier if backend not in exclude]
+            if not usable:
+                continue
+            waits = {backend: backend.expected_wait(tokens, now) for backend in usable}
+            if output_tokens:
+                costs = {backend: waits[backend] + backend.health.expected_seconds(output_tokens) for backend in usable}
+            else:
+                costs = {backend: waits[backend] + backend.health.expected_latency() for backend in usable}
+            best = min(usable, key=costs.get)
+            if waits[best] <= self.patience and (time_limit is None or costs[best] <= time_limit):
+                return best
+            # Under a deadline the fallback is whatever finishes first, otherwise whatever frees up first
+            rank = waits[best] if time_limit is None else costs[best]
+            if waiting is None or rank < waiting[0]:
+                waiting = (rank, best)
+        # Everything is held back (or too slow); settle for the best of the rest
+        return waiting[1] if waiting else None
+
+    def snapshot(self):
+        return {
+            name: [[backend.health.snapshot() for backend in tier] for tier in tiers]
+            for name, tiers in self.routes.items()
+        }
+
+
+def xai_provider(api_key=None, use_async=False):
+    """
+    xAI through the OpenAI SDK, or None without an
+    XAI_API_KEY. XAI_BASE_URL overrides the endpoint.
+    """
+    api_key = api_key or os.getenv("XAI_API_KEY")
+    if not api_key:
+        return None
+    base_url = os.getenv("XAI_BASE_URL", XAI_BASE_URL)
+    get = get_async_openai_client if use_async else get_openai_client
+    # The OpenAI API only reports usage on streams when asked to
+    return Provider("xai", lambda: get(api_key, base_url),
+                    stream_params={"stream_options": {"include_usage": True}})
+
+
+def xai_models():
+    """(text, vision) xAI models from XAI_TEXT_MODEL / XAI_VISION_MODEL; empty disables one."""
+    return (
+        os.getenv("XAI_TEXT_MODEL", DEFAULT_XAI_TEXT_MODEL),
+        os.getenv("XAI_VISION_MODEL", DEFAULT_XAI_VISION_MODEL),
+    )
+
+
+def parse_chain(spec, providers, default="groq"):
+    """
+    Route tiers from a fallback chain such as
+    "llama-3.3-70b-versatile|xai:grok-3, qwen/qwen3-32b" (or a list of tier strings).
+
+    Commas separate tiers in fallback order and "|" separates interchangeable
+    backends within one; a "provider:" prefix picks the provider (default groq).
+    Entries for providers that aren't configured are skipped.
+    """
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    tiers = []
+    for tier_spec in spec:
+        tier = []
+        for entry in tier_spec.split("|"):
+            entry = entry.strip()
+            if not entry:
+                continue
+            name, _, model = entry.rpartition(":")
+            provider = providers.get(name or default)
+            if provider is None:
+                print(f"ROUTER: skipping {entry!r}, provider {name!r} is not configured")
+                continue
+            tier.append(Backend(provider, model))
+        if tier:
+            tiers.append(tier)
+    return tiers
@@ -0,0 +1,304 @@
+import re
+import time
+import asyncio
+import threading
+
+# Published Groq free-tier limits (requests/min, tokens/min). Paid tiers are
+# higher; the response headers correct these as soon as the first call returns.
+DEFAULT_LIMITS = {
+    "llama-3.3-70b-versatile": (30, 12000),
+    "qwen/qwen3-32b": (60, 6000),
+    "meta-llama/llama-4-scout-17b-16e-instruct": (30, 30000),
+    # xAI (routed to by providers.Router); conservative, corrected by headers where sent
+    "grok-3": (60, 100000),
+    "grok-2-vision-1212": (60, 100000),
+}
+FALLBACK_LIMITS = (30, 6000)
+
+# Rough prompt-token cost of one image part; Groq bills images as tokens too
+IMAGE_TOKEN_ESTIMATE = 1200
+# Completion allowance reserved up front when no max_tokens is set
+DEFAULT_COMPLETION_ESTIMATE = 1024
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_duration(value):
+    """Parse Groq reset headers such as '2m59.56s', '7.66s' or '120ms' into seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    scale = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """Cheap pre-flight estimate (about 4 characters per token) of a request's token cost."""
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    chars += len(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    images += 1
+    return chars // 4 + images * IMAGE_TOKEN_ESTIMATE + (max_tokens or DEFAULT_COMPLETION_ESTIMATE)
+
+
+class TokenBucket:
+    """Continuously refilling bucket; callers must hold the owning limiter's lock."""
+
+    def __init__(self, capacity, per_seconds=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / per_seconds
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Debit `amount` (the level may go negative) and return how long the caller must wait."""
+        self.refill(now)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def wait_for(self, amount, now):
+        """What reserve() would return, without debiting anything."""
+        return max(0.0, (amount - self.available(now)) / self.rate)
+
+    def available(self, now):
+        """Current level, without refilling in place."""
+        return min(self.capacity, self.level + (now - self.updated) * self.rate)
+
+    def resize(self, capacity, per_seconds=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / per_seconds
+        self.level = min(self.level, self.capacity)
+
+
+class ModelRateLimiter:
+    """
+    Request-per-minute and token-per-minute budget for one model.
+
+    Calls reserve capacity before they are sent, so concurrent callers are
+    spaced out instead of all failing with 429. Budgets are re-synced from
+    Groq's x-ratelimit-* headers and frozen for the retry-after period when a
+    429 does slip through. Works from threads (acquire) and asyncio tasks
+    (acquire_async) alike.
+
+    `account` names the API key the budget belongs to (see key_pool); limits
+    are per account, so each pooled key gets its own limiter.
+    """
+
+    def __init__(self, model, rpm, tpm, account=None):
+        self.model = model
+        self.account = account
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        # (x-ratelimit-remaining-tokens, time.monotonic()) of the last response that sent it
+        self.reported_tokens = None
+        self.daily_requests_limit = None
+        self.daily_requests_remaining = None
+        self.throttled_seconds = 0.0
+        self.rejections = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens):
+        """Claim budget for one call and return the delay to observe before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(self._debit(tokens), now),
+                self.blocked_until - now,
+            )
+            wait = max(0.0, wait)
+            self.throttled_seconds += wait
+            return wait
+
+    def expected_wait(self, tokens):
+        """Delay a call of `tokens` would get right now, without reserving it (for routing)."""
+        with self._lock:
+            now = time.monotonic()
+            return max(
+                0.0,
+                self.requests.wait_for(1, now),
+                self.tokens.wait_for(self._debit(tokens), now),
+                self.blocked_until - now,
+            )
+
+    def headroom(self):
+        """
+        Share of the budget left right now (0-1): the scarcest of this minute's
+        requests and tokens and today's requests; 0 while blocked.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                return 0.0
+            fractions = [
+                self.requests.available(now) / self.requests.capacity,
+                self.tokens.available(now) / self.tokens.capacity,
+            ]
+            if self.daily_requests_limit and self.daily_requests_remaining is not None:
+                fractions.append(self.daily_requests_remaining / self.daily_requests_limit)
+            return max(0.0, min(fractions))
+
+    def acquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens):
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def _debit(self, tokens):
+        # One call can't need more than a full bucket; callers must hold the lock
+        return min(tokens, self.tokens.capacity)
+
+    def record_usage(self, estimated, actual):
+        """
+        Correct the token bucket once the real usage of a call is known: give
+        back what reserve() debited for `estimated` beyond `actual`. Never
+        credits past the server's last reported remaining tokens (refilled
+        since), which already count this call.
+        """
+        if actual is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens.refill(now)
+            level = min(self.tokens.capacity, self.tokens.level + self._debit(estimated) - actual)
+            if self.reported_tokens is not None:
+                remaining, reported_at = self.reported_tokens
+                level = min(level, remaining + (now - reported_at) * self.tokens.rate)
+            self.tokens.level = level
+
+    def update_from_headers(self, headers):
+        """Re-sync budgets from a response's (or a 429's) rate-limit headers."""
+        if headers is None:
+            return
+        get = headers.get
+        with self._lock:
+            now = time.monotonic()
+            limit_tokens = get("x-ratelimit-limit-tokens")
+            if limit_tokens and float(limit_tokens) != self.tokens.capacity:
+                self.tokens.resize(float(limit_tokens))
+            remaining_tokens = get("x-ratelimit-remaining-tokens")
+            if remaining_tokens is not None:
+                self.tokens.refill(now)
+                self.tokens.level = min(self.tokens.level, float(remaining_tokens))
+                self.reported_tokens = (float(remaining_tokens), now)
+
+            # Groq reports the request headers against the daily (RPD) quota
+            limit_requests = get("x-ratelimit-limit-requests")
+            if limit_requests:
+                self.daily_requests_limit = int(float(limit_requests))
+            remaining_requests = get("x-ratelimit-remaining-requests")
+            if remaining_requests is not None:
+                self.daily_requests_remaining = int(float(remaining_requests))
+                if self.daily_requests_remaining <= 0:
+                    reset = parse_duration(get("x-ratelimit-reset-requests")) or 60.0
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+            retry_after = parse_duration(get("retry-after"))
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def penalize(self, headers=None, fallback_delay=2.0):
+        """
+        Register a rejected (429) call. Every caller of this model is held back
+        for the server's retry-after period, or `fallback_delay` without one.
+        """
+        self.update_from_headers(headers)
+        retry_after = parse_duration(headers.get("retry-after")) if headers is not None else None
+        delay = retry_after if retry_after else fallback_delay
+        with self._lock:
+            self.rejections += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return {
+                "model": self.model,
+                "account": self.account,
+                "requests_available": round(self.requests.level, 2),
+                "requests_per_minute": self.requests.capacity,
+                "tokens_available": round(self.tokens.level, 1),
+                "tokens_per_minute": self.tokens.capacity,
+                "daily_requests_remaining": self.daily_requests_remaining,
+                "blocked_for": round(max(0.0, self.blocked_until - now), 3),
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "rejections": self.rejections,
+            }
+
+
+_limiters = {}
+_registry_lock = threading.Lock()
+
+
+def get_rate_limiter(model, account=None):
+    """
+    Process-wide limiter for `model` (on API key `account`), shared by every
+    engine, thread and task. A new account starts from the limits configured
+    for the model, then follows its own headers.
+    """
+    base = None if account is None else get_rate_limiter(model)
+    with _registry_lock:
+        limiter = _limiters.get((account, model))
+        if limiter is None:
+            if base is None:
+                rpm, tpm = DEFAULT_LIMITS.get(model, FALLBACK_LIMITS)
+            else:
+                rpm, tpm = base.requests.capacity, base.tokens.capacity
+            limiter = _limiters[(account, model)] = ModelRateLimiter(model, rpm, tpm, account)
+        return limiter
+
+
+def configure_rate_limit(model, rpm=None, tpm=None, account=None):
+    """Override the starting limits for a model (for paid tiers); without `account`, for keys seen later too."""
+    limiter = get_rate_limiter(model, account)
+    with limiter._lock:
+        if rpm:
+            limiter.requests.resize(rpm)
+        if tpm:
+            limiter.tokens.resize(tpm)
+    return limiter
+
+
+def rate_limit_snapshot():
+    """Current budget of every model (per pooled key, as "key/model") seen so far, for monitoring."""
+    with _registry_lock:
+        limiters = list(_limiters.values())
+    return {
+        limiter.model if limiter.account is None else f"{limiter.account}/{limiter.model}": limiter.snapshot()
+        for limiter in limiters
+    }
+
+
+def error_headers(error):
+    """Response headers carried by an API error, if any."""
+    response = getattr(error, "response", None)
+    return getattr(response, "headers", None)
@@ -0,0 +1,103 @@
+import time
+
+# Minimum gap between partial-text callbacks; keeps UI redraws cheap on fast models
+STREAM_UPDATE_INTERVAL = 0.05
+
+
+class ThinkTagFilter:
+    """
+    Incremental version of the <think>...</think> stripping in _clean_content.
+
+    Feed raw deltas in order; each call returns only the text that is safe to
+    show. A tag split across chunk boundaries is held back until it resolves.
+    """
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self):
+        self.inside = False
+        self.buffer = ""
+        self.hidden = ""
+
+    def feed(self, text):
+        self.buffer += text
+        visible = []
+        while True:
+            if not self.inside:
+                index = self.buffer.find(self.OPEN)
+                if index == -1:
+                    keep = _partial_tag_length(self.buffer, self.OPEN)
+                    visible.append(self.buffer[:len(self.buffer) - keep])
+                    self.buffer = self.buffer[len(self.buffer) - keep:]
+                    break
+                visible.append(self.buffer[:index])
+                self.buffer = self.buffer[index + len(self.OPEN):]
+                self.inside = True
+            else:
+                index = self.buffer.find(self.CLOSE)
+                if index == -1:
+                    keep = _partial_tag_length(self.buffer, self.CLOSE)
+                    self.hidden += self.buffer[:len(self.buffer) - keep]
+                    self.buffer = self.buffer[len(self.buffer) - keep:]
+                    break
+                self.buffer = self.buffer[index + len(self.CLOSE):]
+                self.hidden = ""
+                self.inside = False
+        return "".join(visible)
+
+    def flush(self):
+        """Text still held at end of stream. An unclosed <think> is kept, as the regex in _clean_content would."""
+        if self.inside:
+            tail = self.OPEN + self.hidden + self.buffer
+        else:
+            tail = self.buffer
+        self.buffer = self.hidden = ""
+        return tail
+
+
+def _partial_tag_length(text, tag):
+    """Length of the longest suffix of `text` that could be the start of `tag`."""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+def chunk_text(chunk):
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+
+def chunk_usage_info(chunk):
+    """Usage object reported on a stream chunk (Groq sends it under x_groq on the last one)."""
+    return getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+
+
+def collect_stream(chunks, on_partial):
+    """Drain text chunks, reporting the accumulated text to on_partial; returns the final stripped text."""
+    text = ""
+    last_update = 0.0
+    for chunk in chunks:
+        text += chunk
+        now = time.monotonic()
+        if now - last_update >= STREAM_UPDATE_INTERVAL:
+            on_partial(text)
+            last_update = now
+    on_partial(text)
+    return text.strip()
+
+
+async def acollect_stream(chunks, on_partial):
+    """collect_stream for async generators."""
+    text = ""
+    last_update = 0.0
+    async for chunk in chunks:
+        text += chunk
+        now = time.monotonic()
+        if now - last_update >= STREAM_UPDATE_INTERVAL:
+            on_partial(text)
+            last_update = now
+    on_partial(text)
+    return text.strip()
@@ -0,0 +1,425 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import CancelledError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# USD per million tokens (input, output) from the Groq and xAI public price lists
+MODEL_PRICES = {
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+    "qwen/qwen3-32b": (0.29, 0.59),
+    "meta-llama/llama-4-scout-17b-16e-instruct": (0.11, 0.34),
+    "grok-3": (3.00, 15.00),
+    "grok-2-vision-1212": (2.00, 10.00),
+}
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_current_stage = contextvars.ContextVar("telemetry_stage", default=None)
+_current_trace = contextvars.ContextVar("telemetry_trace", default=None)
+
+_hooks = []
+_hooks_lock = threading.Lock()
+_env_hooks_installed = False
+
+
+def add_hook(hook):
+    """Register `hook(record)` to receive every finished call record."""
+    with _hooks_lock:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+def install_env_hooks():
+    """
+    Add the sinks named by TELEMETRY_JSONL_PATH, TELEMETRY_PROM_PATH (textfile
+    for node_exporter) and TELEMETRY_PROM_PORT (/metrics endpoint). Runs once.
+    """
+    global _env_hooks_installed
+    with _hooks_lock:
+        if _env_hooks_installed:
+            return
+        _env_hooks_installed = True
+    jsonl_path = os.getenv("TELEMETRY_JSONL_PATH")
+    if jsonl_path:
+        add_hook(JsonlSink(jsonl_path))
+    prom_path = os.getenv("TELEMETRY_PROM_PATH")
+    prom_port = os.getenv("TELEMETRY_PROM_PORT")
+    if prom_path or prom_port:
+        exporter = add_hook(PrometheusExporter(path=prom_path))
+        if prom_port:
+            exporter.serve(int(prom_port))
+
+
+def emit(record):
+    """Attach the record to the current run trace and hand it to every hook."""
+    install_env_hooks()
+    trace = _current_trace.get()
+    if trace is not None:
+        record["run_id"] = trace.run_id
+        trace.add_call(record)
+    with _hooks_lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        try:
+            hook(record)
+        except Exception as e:
+            print(f"TELEMETRY HOOK ERROR: {e}")
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    prices = MODEL_PRICES.get(model)
+    if prices is None or prompt_tokens is None or completion_tokens is None:
+        return None
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1e6
+
+
+def current_stage():
+    return _current_stage.get()
+
+
+@contextmanager
+def stage_context(name):
+    """Attribute calls made inside the block to stage `name`."""
+    token = _current_stage.set(name)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+class CallMetrics:
+    """
+    Telemetry for one logical LLM call, across its retries.
+
+    Create it before the first attempt, report the backend, waits, the first
+    token, usage and retries as they happen, then call finish() exactly once.
+    Time to first token is only known for streamed calls; `hedge` marks the
+    duplicate request of a hedged call.
+    """
+
+    def __init__(self, model, stream=False, stage=None, hedge=False):
+        self.started = time.perf_counter()
+        self.record = {
+            "ts": time.time(),
+            "stage": stage or current_stage(),
+            "provider": "groq",
+            "model": model,
+            "stream": stream,
+            "hedge": hedge,
+            "queue_wait": 0.0,
+            "ttft": None,
+            "latency": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "total_tokens": None,
+            "cost_usd": None,
+            "retries": 0,
+            "fallback_to": None,
+            "status": "ok",
+            "error": None,
+        }
+        self._finished = False
+        self._backend = None
+
+    def routed(self, provider, model):
+        """The backend serving the next attempt; switching backends is recorded in fallback_to."""
+        if self._backend is not None and self._backend != (provider, model):
+            self.record["fallback_to"] = f"{provider}/{model}"
+        self._backend = (provider, model)
+        self.record["provider"] = provider
+        self.record["model"] = model
+
+    def waited(self, seconds):
+        self.record["queue_wait"] += seconds or 0.0
+
+    def first_token(self):
+        if self.record["ttft"] is None:
+            self.record["ttft"] = time.perf_counter() - self.started
+
+    def usage(self, usage):
+        if usage is None:
+            return
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            self.record[field] = getattr(usage, field, None)
+
+    def retry(self):
+        self.record["retries"] += 1
+
+    def finish(self, error=None):
+        if self._finished:
+            return
+        self._finished = True
+        record = self.record
+        record["latency"] = time.perf_counter() - self.started
+        record["cost_usd"] = call_cost(record["model"], record["prompt_tokens"], record["completion_tokens"])
+        if isinstance(error, (asyncio.CancelledError, CancelledError)):
+            # The losing half of a hedged call (or an abandoned task)
+            record["status"] = "cancelled"
+        elif error is not None:
+            record["status"] = "error"
+            record["error"] = f"{type(error).__name__}: {error}"
+        emit(record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(error=exc)
+
+
+class RunTrace:
+    """Everything one pipeline run did: stage timings plus the call records made inside it."""
+
+    def __init__(self):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self._clock = time.perf_counter()
+        self.latency = None
+        self.cached = False
+        # Deadline summary of a latency-SLO run (see deadline.Deadline)
+        self.deadline = None
+        # Upload size before/after preprocessing, and how agent_3's scrub was handled
+        # (skip/fragments/full, hits, residual terms); None when the stage didn't run
+        self.image_stats = None
+        self.ip_report = None
+        self.stages = []
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add_call(self, record):
+        with self._lock:
+            self.calls.append(record)
+
+    def add_stage(self, name, seconds, cached=False):
+        with self._lock:
+            self.stages.append({"stage": name, "seconds": seconds, "cached": cached})
+
+    def finish(self):
+        self.latency = time.perf_counter() - self._clock
+
+    def summary(self):
+        """Plain dict (JSON-ready) with per-stage and total latency, tokens and cost."""
+        with self._lock:
+            stages = [dict(stage) for stage in self.stages]
+            calls = [dict(call) for call in self.calls]
+        for stage in stages:
+            own = [call for call in calls if call["stage"] == stage["stage"]]
+            stage.update(_totals(own))
+        return {
+            "run_id": self.run_id,
+            "started": self.started,
+            "latency": self.latency,
+            "cached": self.cached,
+            "deadline": self.deadline,
+            "image_stats": self.image_stats,
+            "ip_report": self.ip_report,
+            "stages": stages,
+            "calls": calls,
+            "totals": _totals(calls),
+        }
+
+
+def _totals(calls):
+    def total(field):
+        values = [call[field] for call in calls if call[field] is not None]
+        return sum(values) if values else None
+
+    return {
+        "calls": len(calls),
+        "retries": sum(call["retries"] for call in calls),
+        "fallbacks": sum(1 for call in calls if call["fallback_to"]),
+        "hedges": sum(1 for call in calls if call["hedge"]),
+        "prompt_tokens": total("prompt_tokens"),
+        "completion_tokens": total("completion_tokens"),
+        "cost_usd": total("cost_usd"),
+    }
+
+
+@contextmanager
+def run_trace():
+    """Collect calls made inside the block (this thread or asyncio task) into a RunTrace."""
+    trace = RunTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.finish()
+        _current_trace.reset(token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def annotate_run(**fields):
+    """Set RunTrace attributes (image_stats, ip_report) on the current run trace, if there is one."""
+    trace = _current_trace.get()
+    if trace is not None:
+        for name, value in fields.items():
+            setattr(trace, name, value)
+
+
+def trace_stage(name, seconds, cached=False):
+    """Record a finished stage on the current run trace, if there is one."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(name, seconds, cached)
+
+
+class JsonlSink:
+    """Hook that appends each call record as one JSON line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as handle:
+                handle.write(line)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class PrometheusExporter:
+    """
+    Hook that aggregates call records into Prometheus text-format metrics.
+
+    render() returns the exposition text; with `path` it is also rewritten after
+    every call (node_exporter textfile collector), and serve() exposes /metrics.
+    """
+
+    def __init__(self, path=None, prefix="grok_llm", buckets=LATENCY_BUCKETS):
+        self.path = path
+        self.prefix = prefix
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        # Serialises write() so the newest snapshot is the one left on disk
+        self._write_lock = threading.Lock()
+        self._server = None
+
+    def __call__(self, record):
+        labels = (
+            ("stage", record.get("stage") or "none"),
+            ("provider", record.get("provider") or "unknown"),
+            ("model", record.get("model") or "unknown"),
+        )
+        with self._lock:
+            self._inc("calls_total", labels + (("status", record["status"]),), 1)
+            self._inc("retries_total", labels, record["retries"])
+            self._inc("queue_wait_seconds_total", labels, record["queue_wait"])
+            if record["prompt_tokens"] is not None:
+                self._inc("tokens_total", labels + (("type", "prompt"),), record["prompt_tokens"])
+            if record["completion_tokens"] is not None:
+                self._inc("tokens_total", labels + (("type", "completion"),), record["completion_tokens"])
+            if record["cost_usd"] is not None:
+                self._inc("cost_usd_total", labels, record["cost_usd"])
+            self._observe("latency_seconds", labels, record["latency"])
+            if record["ttft"] is not None:
+                self._observe("ttft_seconds", labels, record["ttft"])
+        if self.path:
+            self.write(self.path)
+
+    def _inc(self, name, labels, value):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def _observe(self, name, labels, value):
+        series = self.histograms.setdefault(name, {})
+        series.setdefault(labels, _Histogram(self.buckets)).observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{metric}{_labels(labels)} {value:g}")
+            for name, series in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{metric}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{metric}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{metric}_sum{_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{metric}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Atomically replace `path` with the current metrics. Each write gets its
+        own temp file, so other threads or processes sharing `path` can't
+        interleave into it.
+        """
+        with self._write_lock:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(path)),
+                                             prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                             delete=False) as handle:
+                handle.write(self.render())
+            try:
+                # NamedTemporaryFile is private to us; collectors need to read the result
+                os.chmod(handle.name, 0o644)
+                os.replace(handle.name, path)
+            except OSError:
+                os.remove(handle.name)
+                raise
+
+    def serve(self, port=9464, host="127.0.0.1"):
+        """Expose /metrics on a background thread."""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                body = exporter.render().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+
+def _labels(pairs):
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,51 @@
+import asyncio
+from async_engine import AsyncGrokAgenticEngine
+
+
+def make_engine():
+    return AsyncGrokAgenticEngine(api_key="test-key", catalog=False, ip_detector=False, panel_detector=False,
+                                  hedge=False, structured=False)
+
+
+def test_run_batch_yields_every_result():
+    engine = make_engine()
+
+    async def run_engine(path, status_callback=None):
+        if path == "bad":
+            raise ValueError(path)
+        return f"prompt for {path}"
+
+    engine.run_engine = run_engine
+
+    async def go():
+        return [item async for item in engine.run_batch(["a", "bad", "c"], concurrency=2)]
+
+    results = {path: (result, type(error)) for path, result, error in asyncio.run(go())}
+    assert results == {"a": ("prompt for a", type(None)), "bad": (None, ValueError), "c": ("prompt for c", type(None))}
+
+
+def test_closing_run_batch_cancels_images_in_flight():
+    engine = make_engine()
+    cancelled = []
+
+    async def run_engine(path, status_callback=None):
+        if path == "fast":
+            return "done"
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(path)
+            raise
+
+    engine.run_engine = run_engine
+
+    async def go():
+        batch = engine.run_batch(["slow-1", "slow-2", "fast"], concurrency=3)
+        async for path, result, error in batch:
+            assert path == "fast"
+            break
+        await batch.aclose()
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(go()) == []
+    assert sorted(cancelled) == ["slow-1", "slow-2"]
@@ -0,0 +1,89 @@
+import os
+import json
+import pytest
+import batch_cli
+from batch_cli import iter_records, run_batch
+
+
+def make_images(directory, names):
+    for name in names:
+        (directory / name).write_bytes(b"image")
+    return [str(directory / name) for name in sorted(names)]
+
+
+def fake_worker(calls, fail=(), stop_after=None):
+    """Stands in for make_worker: records what ran, fails the ids in `fail`, interrupts after `stop_after` calls."""
+    def make_worker(task, mode, cache):
+        def run(record):
+            if stop_after is not None and len(calls) >= stop_after:
+                raise KeyboardInterrupt
+            calls.append(record["id"])
+            result = {"id": record["id"], "image": record["image"], "task": task, "elapsed": 0.0}
+            if record["id"] in fail:
+                result["error"] = "RuntimeError: boom"
+            else:
+                result["result"] = "prompt"
+            return result
+        return run
+    return make_worker
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as handle:
+        return [json.loads(line) for line in handle]
+
+
+def test_directory_source_is_sorted_and_skips_non_images_and_own_files(tmp_path):
+    images = make_images(tmp_path, ["b.jpg", "a.PNG", "c.webp"])
+    (tmp_path / "notes.txt").write_text("not an image")
+    output = tmp_path / "out.jsonl"
+    output.write_text("")
+    (tmp_path / "out.jsonl.ckpt").write_text("{}")
+    exclude = (str(output), str(output) + ".ckpt", str(output) + ".ckpt.tmp")
+    assert [record["image"] for record in iter_records(str(tmp_path), exclude=exclude)] == images
+
+
+def test_interrupted_run_resumes_without_repeating_records(tmp_path, monkeypatch):
+    images = make_images(tmp_path, [f"{index}.jpg" for index in range(5)])
+    output = str(tmp_path / "out" / "results.jsonl")
+    os.makedirs(os.path.dirname(output))
+    calls = []
+    monkeypatch.setattr(batch_cli, "make_worker", fake_worker(calls, stop_after=2))
+    with pytest.raises(KeyboardInterrupt):
+        run_batch(str(tmp_path), output, "prompt", "standard", 1, None, progress=lambda message: None)
+
+    monkeypatch.setattr(batch_cli, "make_worker", fake_worker(calls))
+    assert run_batch(str(tmp_path), output, "prompt", "standard", 1, None, progress=lambda message: None) == (5, 0)
+    assert calls == images
+    assert [line["id"] for line in read_lines(output)] == images
+
+
+def test_failed_records_are_retried_on_resume(tmp_path, monkeypatch):
+    images = make_images(tmp_path, [f"{index}.jpg" for index in range(4)])
+    output = str(tmp_path / "out" / "results.jsonl")
+    os.makedirs(os.path.dirname(output))
+    monkeypatch.setattr(batch_cli, "make_worker", fake_worker([], fail={images[1]}))
+    assert run_batch(str(tmp_path), output, "prompt", "standard", 2, None, progress=lambda message: None) == (4, 1)
+
+    calls = []
+    monkeypatch.setattr(batch_cli, "make_worker", fake_worker(calls))
+    assert run_batch(str(tmp_path), output, "prompt", "standard", 2, None, progress=lambda message: None) == (4, 0)
+    assert calls == [images[1]]
+    lines = read_lines(output)
+    assert len(lines) == 5
+    assert lines[-1]["id"] == images[1] and "error" not in lines[-1]
+
+
+def test_checkpoint_without_output_starts_over(tmp_path, monkeypatch):
+    images = make_images(tmp_path, [f"{index}.jpg" for index in range(3)])
+    output = str(tmp_path / "out" / "results.jsonl")
+    os.makedirs(os.path.dirname(output))
+    monkeypatch.setattr(batch_cli, "make_worker", fake_worker([]))
+    run_batch(str(tmp_path), output, "prompt", "standard", 1, None, progress=lambda message: None)
+    os.remove(output)
+
+    calls = []
+    monkeypatch.setattr(batch_cli, "make_worker", fake_worker(calls))
+    assert run_batch(str(tmp_path), output, "prompt", "standard", 1, None, progress=lambda message: None) == (3, 0)
+    assert calls == images
+    assert [line["id"] for line in read_lines(output)] == images
@@ -0,0 +1,42 @@
+import json
+import pytest
+from handoff import FIELDS, IP_FIELD, HandoffError, parse_handoff, _close_truncated
+
+
+@pytest.mark.parametrize("text, closed", [
+    ('{"subject": "a woman', '{"subject": "a woman"}'),
+    ('{"subject": "a", "ip_mentions": ["Batman", "Rob', '{"subject": "a", "ip_mentions": ["Batman", "Rob"]}'),
+    ('{"subject": "a",', '{"subject": "a"}'),
+    ('{"subject": "a \\', '{"subject": "a "}'),
+    ('{"subject": "quoted \\" and {[ brackets', '{"subject": "quoted \\" and {[ brackets"}'),
+    ('{"camera": {"lens": "35mm"}, "style": [', '{"camera": {"lens": "35mm"}, "style": []}'),
+])
+def test_close_truncated_closes_what_is_open(text, closed):
+    assert _close_truncated(text) == closed
+    json.loads(closed)
+
+
+def test_parse_handoff_normalises_fields():
+    reply = ('Here you go:\n```json\n{"subject": " a woman ", "costume": ["black coat", "red scarf"], '
+             '"camera": {"lens": "35mm"}, "ip_mentions": "Batman"}\n```')
+    handoff = parse_handoff(reply)
+    assert set(handoff) == set(FIELDS) | {IP_FIELD}
+    assert handoff["subject"] == "a woman"
+    assert handoff["costume"] == "black coat; red scarf"
+    assert handoff["camera"] == "lens: 35mm"
+    assert handoff["pose"] == ""
+    assert handoff[IP_FIELD] == ["Batman"]
+
+
+def test_parse_handoff_repairs_a_reply_cut_off_by_max_tokens():
+    handoff = parse_handoff('{"subject": "a woman", "pose": "standing", "costume": "a long bl')
+    assert handoff["costume"] == "a long bl"
+    # A key cut off before its value is dropped rather than failing the whole reply
+    handoff = parse_handoff('{"subject": "a woman", "pose": "standing", "cost')
+    assert (handoff["subject"], handoff["pose"], handoff["costume"]) == ("a woman", "standing", "")
+
+
+@pytest.mark.parametrize("reply", ["no json here", '{"ip_mentions": ["Batman"]}', '{"subject": ""}', "{,,,"])
+def test_parse_handoff_rejects_replies_without_a_description(reply):
+    with pytest.raises(HandoffError):
+        parse_handoff(reply)
@@ -0,0 +1,152 @@
+import time
+import asyncio
+import threading
+import pytest
+from hedging import HedgeLeg, HedgePolicy, hedged, ahedged
+
+
+class FakeHealth:
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+
+    def percentile(self, percentile, min_samples):
+        return self.cutoff
+
+
+class FakeBackend:
+    def __init__(self, wait=0.0):
+        self.wait = wait
+
+    def expected_wait(self, tokens, now):
+        return self.wait
+
+
+def policy(**kwargs):
+    settings = dict(min_delay=0.0, max_rate=1.0, burst=2.0)
+    settings.update(kwargs)
+    return HedgePolicy(**settings)
+
+
+def test_delay_waits_for_enough_samples_and_respects_min_delay():
+    hedge = policy(min_delay=1.0)
+    assert hedge.delay(FakeHealth(None)) is None
+    assert hedge.delay(FakeHealth(0.2)) == 1.0
+    assert hedge.delay(FakeHealth(3.5)) == 3.5
+
+
+def test_credits_limit_the_hedge_rate():
+    hedge = policy(max_rate=0.5, burst=1.0)
+    hedge.delay(FakeHealth(1.0))
+    assert not hedge.admit(FakeBackend(), 10)
+    hedge.delay(FakeHealth(1.0))
+    assert hedge.admit(FakeBackend(), 10)
+    # The credit is spent; more calls are needed to earn the next one
+    assert not hedge.admit(FakeBackend(), 10)
+    assert hedge.snapshot()["hedges"] == 1
+
+
+def test_a_throttled_spare_is_never_hedged_to():
+    hedge = policy()
+    hedge.delay(FakeHealth(1.0))
+    assert not hedge.admit(FakeBackend(wait=2.0), 10)
+    assert hedge.snapshot()["credits"] == 1.0
+
+
+def blocking_leg(closed, name="primary"):
+    """A call that only ends when its leg is cancelled (its 'stream' closed)."""
+    def call(leg):
+        released = threading.Event()
+        leg.on_cancel(lambda: (closed.append(name), released.set()))
+        released.wait(10)
+        raise ConnectionError("stream closed")
+    return call
+
+
+def test_fast_primary_is_not_hedged():
+    hedge = policy()
+    calls = []
+    assert hedged(lambda leg: "first", lambda leg: calls.append("second"), 1.0, lambda: True, hedge) == "first"
+    assert calls == []
+
+
+def test_backup_wins_and_the_slow_primary_is_closed():
+    hedge = policy()
+    closed = []
+    result = hedged(blocking_leg(closed), lambda leg: "backup", 0.01, lambda: True, hedge)
+    assert result == "backup"
+    assert closed == ["primary"]
+    assert hedge.snapshot()["hedge_wins"] == 1
+
+
+def test_primary_wins_and_the_backup_is_closed():
+    hedge = policy()
+    closed = []
+    primary_may_finish = threading.Event()
+
+    def primary(leg):
+        primary_may_finish.wait(10)
+        return "primary"
+
+    def backup(leg):
+        primary_may_finish.set()
+        return blocking_leg(closed, "backup")(leg)
+
+    assert hedged(primary, backup, 0.01, lambda: True, hedge) == "primary"
+    assert closed == ["backup"]
+    assert hedge.snapshot()["hedge_wins"] == 0
+
+
+def test_without_credit_the_primary_is_awaited():
+    finish = threading.Event()
+
+    def primary(leg):
+        finish.wait(10)
+        return "primary"
+
+    def admit():
+        finish.set()
+        return False
+
+    assert hedged(primary, lambda leg: pytest.fail("hedged without credit"), 0.01, admit, policy()) == "primary"
+
+
+def test_error_is_raised_only_when_both_sides_fail():
+    def fail(message):
+        def call(leg):
+            raise RuntimeError(message)
+        return call
+
+    def slow_fail(leg):
+        time.sleep(0.05)
+        raise RuntimeError("primary")
+
+    assert hedged(slow_fail, lambda leg: "backup", 0.01, lambda: True, policy()) == "backup"
+    with pytest.raises(RuntimeError):
+        hedged(slow_fail, fail("backup"), 0.01, lambda: True, policy())
+
+
+def test_leg_cancelled_before_registering_closes_immediately():
+    leg = HedgeLeg()
+    leg.cancel()
+    closed = []
+    leg.on_cancel(lambda: closed.append(True))
+    assert leg.cancelled and closed == [True]
+
+
+def test_async_hedge_cancels_the_loser():
+    hedge = policy()
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append("primary")
+            raise
+
+    async def fast():
+        return "backup"
+
+    assert asyncio.run(ahedged(slow, fast, 0.01, lambda: True, hedge)) == "backup"
+    assert cancelled == ["primary"]
+    assert hedge.snapshot()["hedge_wins"] == 1
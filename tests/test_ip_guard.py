@@ -0,0 +1,57 @@
+from ip_guard import IPDetector, ScrubPlan, face_hair_detector, guarded_scrub
+
+
+def terms(detector, text):
+    return [(match.term, text[match.start:match.end]) for match in detector.find(text)]
+
+
+def test_detector_only_matches_whole_words():
+    detector = IPDetector(["Thor", "Marvel", "Iron Man"])
+    assert terms(detector, "Thor stands in a Marvel poster.") == [("Thor", "Thor"), ("Marvel", "Marvel")]
+    assert terms(detector, "A thorough, marvellous author with an ironman medal.") == []
+    assert terms(detector, "(thor), MARVEL-style, thor's hammer") == [
+        ("Thor", "thor"), ("Marvel", "MARVEL"), ("Thor", "thor")]
+
+
+def test_detector_handles_overlapping_and_multi_word_terms():
+    detector = IPDetector(["Iron Man", "Man", "Spider-Man", "Spider"])
+    text = "Iron Man meets Spider-Man."
+    assert terms(detector, text) == [("Iron Man", "Iron Man"), ("Man", "Man"), ("Spider-Man", "Spider-Man"),
+                                     ("Spider", "Spider"), ("Man", "Man")]
+    assert terms(detector, "Ironman meets Spiderman.") == []
+
+
+def test_detector_keeps_offsets_when_lowercasing_changes_length():
+    detector = IPDetector(["Thor"])
+    text = "İstanbul poster of Thor."
+    assert terms(detector, text) == [("Thor", "Thor")]
+
+
+def test_face_hair_terms_flag_sentences_without_ip():
+    plan = ScrubPlan(IPDetector(["Batman"]), "A man in a grey coat. He has blue eyes. The street is wet.",
+                     redact=face_hair_detector())
+    assert plan.mode == "fragments"
+    assert list(plan.fragments.values()) == ["He has blue eyes."]
+    # "eyelet" and "bunting" are costume words that merely start like "eye" and "bun"
+    assert ScrubPlan(IPDetector(["Batman"]), "Eyelet lace and bunting.", redact=face_hair_detector()).mode == "skip"
+
+
+def test_guarded_scrub_skips_clean_text_and_rescrubs_residue():
+    detector = IPDetector(["Batman"])
+    calls = []
+
+    def scrub_full(text):
+        calls.append(text)
+        return text.replace("Batman", "a caped vigilante")
+
+    def scrub_fragments(lines):
+        # Leaves the name in place, so the guard has to fall back to a full scrub
+        return lines
+
+    result, report = guarded_scrub(detector, "Rain on a rooftop.", scrub_full, scrub_fragments)
+    assert (result, report["mode"], calls) == ("Rain on a rooftop.", "skip", [])
+
+    text = "Batman waits. Rain falls. The city glows. Nobody moves."
+    result, report = guarded_scrub(detector, text, scrub_full, scrub_fragments)
+    assert result == "a caped vigilante waits. Rain falls. The city glows. Nobody moves."
+    assert report["mode"] == "fragments" and report["retried"] and report["residual"] == []
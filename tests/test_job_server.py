@@ -0,0 +1,127 @@
+import json
+import base64
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import grok_engine
+import job_server
+from job_server import JobService, JobServer
+
+
+class FakeEngine:
+    def __init__(self, cache=None, stream=False):
+        self.cache = cache
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Start a JobServer on a free port whose jobs run `task(image_bytes, progress)` instead of the pipeline."""
+    monkeypatch.setattr(grok_engine, "GrokAgenticEngine", FakeEngine)
+    servers = []
+
+    def start(task, workers=1, queue_size=4):
+        monkeypatch.setattr(job_server, "run_task",
+                            lambda engine, name, image_bytes, options, progress, cache=None: task(image_bytes, progress))
+        server = JobServer(JobService(workers=workers, queue_size=queue_size), port=0).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown(drain=False, timeout=5)
+
+
+def request(server, method, path, body=None, content_type="application/json"):
+    """(status, parsed JSON body) for one request."""
+    data = body if body is None or isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(server.base_url + path, data=data, method=method,
+                                 headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def submit(server, image=b"image"):
+    return request(server, "POST", "/jobs", {"image_base64": base64.b64encode(image).decode("ascii")})
+
+
+def test_submit_poll_and_stream_round_trip(serve):
+    def task(image_bytes, progress):
+        progress("Describing", "agent_1")
+        progress("Describing", "agent_1", "half a prom")
+        return {"prompt": f"prompt for {image_bytes.decode()}"}
+
+    server = serve(task)
+    status, accepted = submit(server, b"cat.jpg")
+    assert status == 202 and accepted["links"]["result"] == f"/jobs/{accepted['id']}/result"
+
+    with urllib.request.urlopen(server.base_url + accepted["links"]["events"], timeout=10) as response:
+        assert response.headers["Content-Type"] == "text/event-stream"
+        stream = response.read().decode("utf-8")
+    events = [block.split("\n")[0] for block in stream.split("\n\n") if block.startswith("event:")]
+    assert events[0] == "event: progress" and events[-1] == "event: done"
+    assert '"result": {"prompt": "prompt for cat.jpg"}' in stream
+
+    status, snapshot = request(server, "GET", f"/jobs/{accepted['id']}")
+    assert (status, snapshot["status"], snapshot["stage"]) == (200, "done", "agent_1")
+    assert request(server, "GET", accepted["links"]["result"]) == (200, {"prompt": "prompt for cat.jpg"})
+
+
+def test_result_is_pending_then_failed_jobs_report_their_error(serve):
+    release = threading.Event()
+
+    def task(image_bytes, progress):
+        release.wait(10)
+        raise RuntimeError("model went away")
+
+    server = serve(task)
+    job_id = submit(server)[1]["id"]
+    status, body = request(server, "GET", f"/jobs/{job_id}/result")
+    assert status == 202 and body["status"] in ("queued", "running")
+    release.set()
+    job = server.service.get(job_id)
+    while job.status not in job_server.FINISHED:
+        job.wait(job.version, 5)
+    assert request(server, "GET", f"/jobs/{job_id}/result") == (
+        409, {"error": "RuntimeError: model went away", "status": "failed"})
+
+
+def test_full_queue_answers_429(serve):
+    started, release = threading.Event(), threading.Event()
+
+    def task(image_bytes, progress):
+        started.set()
+        release.wait(10)
+        return {"prompt": "done"}
+
+    server = serve(task, workers=1, queue_size=1)
+    try:
+        assert submit(server)[0] == 202
+        assert started.wait(5)
+        assert submit(server)[0] == 202
+        status, body = submit(server)
+        assert status == 429 and "full" in body["error"]
+    finally:
+        release.set()
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (b"[]", "application/json"),
+    (b'"x"', "application/json"),
+    (b"3", "application/json"),
+    (b"{not json", "application/json"),
+    (b'{"image_base64": 123}', "application/json"),
+    (b'{"image_base64": "***"}', "application/json"),
+    (b'{"image_base64": "aW1hZ2U=", "task": "paint"}', "application/json"),
+    (b'{"image_base64": "aW1hZ2U=", "deadline": -1}', "application/json"),
+    (b"", "image/jpeg"),
+])
+def test_bad_submissions_answer_400(serve, body, content_type):
+    server = serve(lambda image_bytes, progress: {"prompt": "unused"})
+    status, reply = request(server, "POST", "/jobs", body, content_type)
+    assert status == 400 and reply["error"]
+    # The connection handler survived: the server still answers
+    assert request(server, "GET", "/health")[0] == 200
@@ -0,0 +1,59 @@
+import uuid
+from key_pool import KeyPool, load_api_keys
+
+
+def fresh_pool(count=2):
+    # Limiters are process-wide per (key, model), so every test gets keys and a model of its own
+    return KeyPool([f"test-key-{uuid.uuid4().hex}" for _ in range(count)]), f"test/model-{uuid.uuid4().hex[:8]}"
+
+
+def test_load_api_keys_merges_sources_without_duplicates(monkeypatch):
+    monkeypatch.setenv("GROQ_API_KEYS", "b, c;a\nd")
+    monkeypatch.setenv("GROQ_API_KEY", "e")
+    assert load_api_keys("a", extra=["b"]) == ["a", "b", "c", "d", "e"]
+
+
+def test_choose_spreads_calls_across_keys():
+    pool, model = fresh_pool(3)
+    chosen = []
+    for _ in range(3):
+        key = pool.choose(model, 1000)
+        pool.limiter(key, model).acquire(1000)
+        chosen.append(key)
+    assert sorted(key.label for key in chosen) == sorted(key.label for key in pool.keys)
+
+
+def test_throttled_key_is_passed_over_until_it_resets():
+    pool, model = fresh_pool()
+    first, second = pool.keys
+    pool.limiter(first, model).penalize({"retry-after": "30"})
+    assert pool.choose(model) is second
+    assert pool.expected_wait(model) == 0.0
+    # The block is per model: other models still use the first key
+    other_model = model + "-other"
+    pool.limiter(second, other_model).acquire(3000)
+    assert pool.choose(other_model) is first
+
+
+def test_benched_key_is_skipped_for_every_model():
+    pool, model = fresh_pool()
+    first, second = pool.keys
+    pool.bench(pool.limiter(first, model))
+    # Roomier than the second key everywhere, but revoked keys stay out of rotation
+    pool.limiter(second, model).acquire(3000)
+    for name in (model, model + "-other", model + "-third"):
+        assert pool.choose(name) is second
+    assert first.benched_for() > 0 and second.benched_for() == 0
+    assert pool.expected_wait(model + "-other") == 0.0
+
+
+def test_bench_expires_and_a_fully_benched_pool_still_answers():
+    pool, model = fresh_pool()
+    first, second = pool.keys
+    pool.limiter(second, model).acquire(3000)
+    pool.bench(pool.limiter(first, model), seconds=0)
+    assert pool.choose(model) is first
+    pool.bench(pool.limiter(first, model), seconds=60)
+    pool.bench(pool.limiter(second, model), seconds=30)
+    assert pool.choose(model) is second
+    assert 29 < pool.expected_wait(model) <= 30
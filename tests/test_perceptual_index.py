@@ -0,0 +1,74 @@
+import io
+import random
+import numpy as np
+import PIL.Image
+import pytest
+from perceptual_index import MultiIndexHash, PerceptualIndex, hamming, image_hashes
+from result_cache import ResultCache
+
+
+def near(value, flips, rng):
+    for position in rng.sample(range(64), flips):
+        value ^= 1 << position
+    return value
+
+
+@pytest.mark.parametrize("radius", [0, 3, 4, 6, 9, 12])
+def test_search_matches_brute_force(radius):
+    rng = random.Random(radius)
+    stored = []
+    for _ in range(300):
+        stored.append(rng.getrandbits(64))
+    # Plenty of neighbours at and around the radius, spread across the chunks
+    centre = rng.getrandbits(64)
+    stored += [near(centre, flips, rng) for flips in range(0, 16) for _ in range(4)]
+    index = MultiIndexHash()
+    for item, value in enumerate(stored):
+        index.add(value, item)
+
+    for query in [centre] + [rng.getrandbits(64) for _ in range(5)]:
+        expected = sorted((hamming(query, value), item) for item, value in enumerate(stored)
+                          if hamming(query, value) <= radius)
+        found = index.search(query, radius)
+        assert sorted(found) == expected
+        assert [distance for distance, _ in found] == sorted(distance for distance, _ in found)
+
+
+def photo(seed=0, size=(640, 480)):
+    """Smooth, structured test image: blurred random blobs rather than noise, like a photo."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    return PIL.Image.fromarray(small).resize(size, PIL.Image.BICUBIC)
+
+
+def jpeg(image, quality=92, size=None):
+    if size is not None:
+        image = image.resize(size, PIL.Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def test_resized_and_recompressed_copy_is_served_from_the_cache():
+    cache = ResultCache(":memory:")
+    index = PerceptualIndex(":memory:")
+    original = photo()
+    cache.put("result-key", "stored prompt")
+    index.add("pipeline-v1", image_hashes(jpeg(original)), "result-key")
+
+    copy = jpeg(original, quality=55, size=(320, 240))
+    assert index.find("pipeline-v1", image_hashes(copy), cache)[0] == "stored prompt"
+    # Only within the same settings, and not for a different picture
+    assert index.find("pipeline-v2", image_hashes(copy), cache) == (None, None)
+    assert index.find("pipeline-v1", image_hashes(jpeg(photo(seed=1))), cache) == (None, None)
+    assert index.stats()["hits"] == 1
+
+
+def test_evicted_results_are_not_served(tmp_path):
+    cache = ResultCache(":memory:")
+    path = str(tmp_path / "phash.sqlite3")
+    hashes = image_hashes(jpeg(photo()))
+    PerceptualIndex(path).add("pipeline-v1", hashes, "gone")
+    # Reloaded from disk, but the cache no longer has the result it points at
+    assert PerceptualIndex(path).lookup("pipeline-v1", hashes) == [(0, "gone")]
+    assert PerceptualIndex(path).find("pipeline-v1", hashes, cache) == (None, None)
@@ -0,0 +1,123 @@
+import time
+import asyncio
+import providers
+from providers import BackendHealth, BREAKER_FAILURES
+
+
+def opened(name="test/breaker"):
+    health = BackendHealth(name)
+    for _ in range(BREAKER_FAILURES):
+        health.failure()
+    return health
+
+
+def test_breaker_opens_after_consecutive_failures():
+    health = BackendHealth("test/breaker")
+    for _ in range(BREAKER_FAILURES - 1):
+        health.failure()
+    assert health.state == BackendHealth.CLOSED
+    health.failure()
+    assert health.state == BackendHealth.OPEN
+    assert not health.available()
+
+
+def test_success_resets_the_failure_count():
+    health = BackendHealth("test/breaker")
+    for _ in range(BREAKER_FAILURES - 1):
+        health.failure()
+    health.success(0.1)
+    health.failure()
+    assert health.state == BackendHealth.CLOSED
+
+
+def test_half_open_lets_one_probe_through():
+    health = opened()
+    health.reopen_at = time.monotonic() - 1
+    assert health.available()
+    assert health.begin() is True
+    assert health.state == BackendHealth.HALF_OPEN
+    assert not health.available()
+    # Only the call that moved it to half-open is the probe
+    assert health.begin() is False
+
+
+def test_probe_success_closes():
+    health = opened()
+    health.reopen_at = time.monotonic() - 1
+    health.begin()
+    health.success(0.1)
+    assert health.state == BackendHealth.CLOSED
+    assert health.available()
+
+
+def test_probe_failure_reopens_for_longer():
+    health = opened()
+    first = health.open_for
+    health.reopen_at = time.monotonic() - 1
+    health.begin()
+    health.failure()
+    assert health.state == BackendHealth.OPEN
+    assert health.open_for == first * 2
+    assert not health.available()
+
+
+def test_released_probe_hands_over_to_the_next_call():
+    health = opened()
+    health.reopen_at = time.monotonic() - 1
+    health.begin()
+    health.release()
+    assert health.state == BackendHealth.OPEN
+    assert health.available()
+    assert health.begin() is True
+
+
+def test_release_after_a_verdict_is_a_no_op():
+    health = opened()
+    health.reopen_at = time.monotonic() - 1
+    health.begin()
+    health.success(0.1)
+    health.release()
+    assert health.state == BackendHealth.CLOSED
+
+
+class HangingCompletions:
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.with_raw_response = self
+
+    async def create(self, **params):
+        self.started.set()
+        await asyncio.sleep(3600)
+
+
+class HangingClient:
+    def __init__(self):
+        self.completions = HangingCompletions()
+        self.chat = self
+
+
+def test_cancelled_probe_releases_the_breaker():
+    from async_engine import AsyncGrokAgenticEngine
+
+    engine = AsyncGrokAgenticEngine(api_key="test-key", catalog=False, ip_detector=False, panel_detector=False,
+                                    hedge=False, structured=False)
+    client = engine.client = HangingClient()
+    model = "test/cancelled-probe-model"
+    health = providers.get_health("groq", model)
+    for _ in range(BREAKER_FAILURES):
+        health.failure()
+    health.reopen_at = time.monotonic() - 1
+
+    async def go():
+        task = asyncio.ensure_future(engine._routed_call(model, [{"role": "user", "content": "hi"}], 0.2, None))
+        await client.completions.started.wait()
+        assert health.state == BackendHealth.HALF_OPEN
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(go())
+    assert health.state == BackendHealth.OPEN
+    assert health.available()
@@ -0,0 +1,73 @@
+import pytest
+from rate_limiter import ModelRateLimiter, parse_duration, estimate_tokens
+
+
+def limiter(rpm=30, tpm=1000):
+    return ModelRateLimiter("test/model", rpm, tpm)
+
+
+def tokens_level(limiter):
+    return limiter.snapshot()["tokens_available"]
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("2m59.56s", 179.56), ("7.66s", 7.66), ("120ms", 0.12), ("1h", 3600.0), ("3", 3.0), ("soon", None), (None, None),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == (pytest.approx(seconds) if seconds is not None else None)
+
+
+def test_estimate_counts_text_images_and_completion():
+    messages = [{"role": "user", "content": [{"type": "text", "text": "x" * 400},
+                                             {"type": "image_url", "image_url": {"url": "data:"}}]}]
+    assert estimate_tokens(messages, max_tokens=100) == 100 + 1200 + 100
+
+
+def test_usage_correction_gives_back_the_unused_estimate():
+    budget = limiter()
+    assert budget.reserve(400) == 0.0
+    budget.record_usage(400, 100)
+    assert tokens_level(budget) == pytest.approx(900, abs=5)
+
+
+def test_oversized_estimate_is_only_credited_what_was_debited():
+    budget = limiter(tpm=1000)
+    # Only a full bucket (1000) is debited for a 5000-token estimate...
+    assert budget.reserve(5000) == 0.0
+    assert tokens_level(budget) == pytest.approx(0, abs=5)
+    # ...so only 1000 - 300 comes back, not 5000 - 300
+    budget.record_usage(5000, 300)
+    assert tokens_level(budget) == pytest.approx(700, abs=5)
+
+
+def test_usage_correction_never_exceeds_the_reported_remaining_tokens():
+    budget = limiter(tpm=1000)
+    budget.reserve(400)
+    budget.update_from_headers({"x-ratelimit-remaining-tokens": "200"})
+    assert tokens_level(budget) == pytest.approx(200, abs=5)
+    # The server's count already includes this call; adding 300 back would undo the re-sync
+    budget.record_usage(400, 100)
+    assert tokens_level(budget) == pytest.approx(200, abs=5)
+
+
+def test_headers_resize_the_bucket_and_block_on_an_empty_daily_quota():
+    budget = limiter(tpm=1000)
+    budget.update_from_headers({"x-ratelimit-limit-tokens": "500", "x-ratelimit-limit-requests": "1000",
+                                "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "30s"})
+    snapshot = budget.snapshot()
+    assert snapshot["tokens_per_minute"] == 500 and snapshot["tokens_available"] <= 500
+    assert 29 < budget.expected_wait(1) <= 30
+    assert budget.headroom() == 0.0
+
+
+def test_reservations_space_out_callers_and_penalize_honours_retry_after():
+    budget = limiter(rpm=60, tpm=100000)
+    waits = [budget.reserve(1) for _ in range(61)]
+    # 60 requests fit the minute; the 61st waits for one to refill (1 per second)
+    assert waits[:60] == [0.0] * 60 and waits[60] == pytest.approx(1.0, abs=0.05)
+
+    budget = limiter()
+    assert budget.penalize({"retry-after": "12"}) == 12.0
+    assert 11 < budget.expected_wait(1) <= 12
+    assert budget.penalize(None, fallback_delay=3.0) == 3.0
+    assert budget.snapshot()["rejections"] == 2
@@ -0,0 +1,98 @@
+import pytest
+import result_cache
+import prompt_gen
+from pipeline import Stage
+from result_cache import ResultCache, fingerprint
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(result_cache, "time", fake)
+    return fake
+
+
+def test_hit_and_miss(clock):
+    cache = ResultCache(":memory:")
+    assert cache.get("key") is None
+    cache.put("key", "prompt")
+    assert cache.get("key") == "prompt"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResultCache(":memory:", ttl=60)
+    cache.put("key", "prompt")
+    clock.now += 59
+    assert cache.get("key") == "prompt"
+    # Reading doesn't extend an entry's life; age counts from when it was written
+    clock.now += 2
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_is_evicted_first(clock):
+    cache = ResultCache(":memory:", max_entries=2)
+    cache.put("a", "A")
+    clock.now += 1
+    cache.put("b", "B")
+    clock.now += 1
+    cache.get("a")
+    clock.now += 1
+    cache.put("c", "C")
+    assert [cache.get(key) for key in ("a", "b", "c")] == ["A", None, "C"]
+
+
+def test_byte_bound_evicts_until_it_fits(clock):
+    cache = ResultCache(":memory:", max_bytes=10)
+    for key in ("a", "b", "c"):
+        cache.put(key, key * 4)
+        clock.now += 1
+    # 12 bytes > 10: only the oldest goes
+    assert [cache.get(key) for key in ("a", "b", "c")] == [None, "bbbb", "cccc"]
+    cache.put("big", "x" * 10)
+    assert cache.stats()["entries"] == 1 and cache.get("big") == "x" * 10
+
+
+def test_stage_key_changes_with_model_temperature_and_prompt():
+    base = dict(name="agent_2", run=None, inputs=("agent_1",), model="model-a", temperature=0.1, prompt="Describe.")
+    key = Stage(**base).fingerprint()
+    assert Stage(**base).fingerprint() == key
+    for change in ({"model": "model-b"}, {"temperature": 0.2}, {"prompt": "Describe it."}):
+        assert Stage(**dict(base, **change)).fingerprint() != key
+    assert Stage(**base).cache_key(["digest-1"]) != Stage(**base).cache_key(["digest-2"])
+
+
+def test_prompt_key_changes_with_model_temperature_and_prompt(monkeypatch):
+    # Pin the resolved models so the catalog isn't consulted
+    monkeypatch.setattr(prompt_gen, "_resolved_models", {"vision": "vision-a", "guardian": "guardian-a"})
+    image = b"image bytes"
+    key = prompt_gen.prompt_cache_key(image, "Human-Aesthetic Narrative")
+    assert prompt_gen.prompt_cache_key(image, "Human-Aesthetic Narrative") == key
+    assert prompt_gen.prompt_cache_key(b"other image", "Human-Aesthetic Narrative") != key
+
+    changes = [
+        lambda: monkeypatch.setitem(prompt_gen._resolved_models, "vision", "vision-b"),
+        lambda: monkeypatch.setattr(prompt_gen, "GUARDIAN_TEMPERATURE", prompt_gen.GUARDIAN_TEMPERATURE + 0.1),
+        lambda: monkeypatch.setattr(prompt_gen, "GUARDIAN_SYSTEM_PROMPT", prompt_gen.GUARDIAN_SYSTEM_PROMPT + " "),
+    ]
+    seen = {key}
+    for change in changes:
+        change()
+        changed = prompt_gen.prompt_cache_key(image, "Human-Aesthetic Narrative")
+        assert changed not in seen
+        seen.add(changed)
+
+
+def test_fingerprint_is_order_stable_for_dicts():
+    assert fingerprint({"a": 1, "b": 2}) == fingerprint({"b": 2, "a": 1})
+    assert fingerprint("a", 1) != fingerprint("a", "1")